@@ -265,9 +265,9 @@ def upload_file():
     if file.filename == '':
         return jsonify({'error': 'No selected file'}), 400
 
-    # Check if the file is a PDF
-    if not file.filename.endswith('.pdf'):
-        return jsonify({'error': 'Only .pdf files are currently supported'}), 400
+    # Check if the file is a PDF or plain text, the types course indexing reads
+    if not file.filename.endswith(('.pdf', '.txt')):
+        return jsonify({'error': 'Only .pdf and .txt files are currently supported'}), 400
 
     course_id = request.form.get('course_id')
     if not course_id:
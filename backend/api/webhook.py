@@ -73,9 +73,10 @@ async def function_call_handler(payload):
     print(f"function call handler called: {name} - {parameters}")
 
     if name == 'getDetailedContent':
-        context = get_detailed_content.get_detailed_content(user_course_data['course_id'],
-                                                           user_course_data['username'],
-                                                           parameters['userQuery'])
+        context = await get_detailed_content.aget_detailed_content(user_course_data['course_id'],
+                                                                  user_course_data['username'],
+                                                                  parameters['userQuery'],
+                                                                  assistant_id=assistant_id)
         return context
     elif name == 'goToStartingSlide':
         context = slides_navigation.go_to_starting_slide(
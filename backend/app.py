@@ -10,12 +10,15 @@ from routes.course_info_routes import course_info_bp
 from routes.delete_course_routes import delete_course_bp
 from api import api as api_blueprint
 import utils.user_utils as user_utils
-from utils.load_and_process_index import process_course_context_s3
+from utils.indexing_queue import enqueue_course_indexing, get_indexing_room
 from s3_context_manager import ContextManager as S3ContextManager
 import utils.s3_utils as s3_utils
+from utils.course_cache import get_course_cache
+from utils.query_embedding_cache import get_query_embedding_cache
+from utils.retrieval_cache import get_retrieval_cache
 from chatbot import ChatBot
 import os
-from utils.socket_utils import init_socketio
+from utils.socket_utils import init_socketio, SOCKETIO_MESSAGE_QUEUE
 from functions.slides_navigation import update_viewing_slide, go_to_starting_slide
 
 app = Flask(__name__)
@@ -29,7 +32,8 @@ CORS(app,
      }},
      supports_credentials=True)
 app.secret_key = os.getenv("FLASK_SECRET_KEY", "supersecretkey")
-socketio = SocketIO(app, cors_allowed_origins="*")
+# With a message queue, indexing workers in other processes can emit to this server's clients
+socketio = SocketIO(app, cors_allowed_origins="*", message_queue=SOCKETIO_MESSAGE_QUEUE or None)
 init_socketio(socketio)  # Pass socketio instance to the utility module
 
 app.secret_key = os.getenv("FLASK_SECRET_KEY", "supersecretkey")  # Add for session management
@@ -73,7 +77,8 @@ def initialize_chatbot():
             print(f"No saved indices found for course: {course_title}")
             # Optionally process context if indices don't exist
             # new_context_manager.load_and_process_context_by_path(course_dir)
-            process_course_context_s3(new_context_manager.s3_bucket, username, course_title, API_KEY)
+            # The chatbot answers without course context until the queued build is published
+            enqueue_course_indexing(new_context_manager.s3_bucket, username, course_title)
 
         # Load the course configuration to get the system prompt
         # config_path = os.path.join(course_dir, "course_config.json")
@@ -130,9 +135,13 @@ def get_ai_response():
     if not course_title:
         return jsonify({'error': 'course_title required in request'}), 400
 
-    # Get chatbot from session (or recreate from course data)
-    chatbot = ChatBot(context_manager=S3ContextManager(user=username, course_title=course_title, api_key=API_KEY))
-    
+    # Get chatbot from session (or recreate from course data); the course's indices come
+    # from the process-wide course cache rather than being reloaded from S3 every turn
+    context_manager = S3ContextManager(user=username, course_title=course_title, api_key=API_KEY)
+    if not context_manager.load_saved_indices():
+        print(f"No saved indices found for course: {course_title}, answering without course context")
+    chatbot = ChatBot(context_manager=context_manager, api_key=API_KEY)
+
     response = chatbot.process_message(user_input)
 
     print(f"AI response time: {time.time() - start:.2f}s")
@@ -171,6 +180,21 @@ def get_ai_response():
         return jsonify(response)
     
 
+@app.route('/api/course-cache/stats', methods=['GET'])
+def course_cache_stats():
+    return jsonify(get_course_cache().stats())
+
+
+@app.route('/api/query-embedding-cache/stats', methods=['GET'])
+def query_embedding_cache_stats():
+    return jsonify(get_query_embedding_cache().stats())
+
+
+@app.route('/api/retrieval-cache/stats', methods=['GET'])
+def retrieval_cache_stats():
+    return jsonify(get_retrieval_cache().stats())
+
+
 # Socket.IO event handlers
 @socketio.on('connect')
 def handle_connect():
@@ -184,6 +208,15 @@ def handle_join(data):
         join_room(assistant_id)
         print(f"User joined course room: {assistant_id}")
 
+@socketio.on('join_course_indexing')
+def handle_join_course_indexing(data):
+    # Owner of a course follows its indexing_progress events
+    username = user_utils.get_current_user(request)
+    course_id = data.get('course_id')
+    if username and course_id:
+        join_room(get_indexing_room(username, course_id))
+        print(f"User {username} watching indexing of course: {course_id}")
+
 @socketio.on('disconnect')
 def handle_disconnect():
     print('Client disconnected')
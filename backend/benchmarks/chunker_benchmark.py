@@ -0,0 +1,111 @@
+"""
+Chunker microbenchmark.
+
+Generates a synthetic book and reports chunking throughput (MB/s) and chunk
+counts of the shared line chunker, the structure-aware chunker and the
+previous per-line implementation.
+
+Usage (from the backend directory):
+    python -m benchmarks.chunker_benchmark --size-mb 5 --repeat 3
+"""
+import argparse
+import random
+import time
+
+import tiktoken
+
+from utils.chunker import split_text_into_chunks, split_text_into_section_chunks
+
+
+def generate_book(size_bytes, seed=0):
+    """Build heading/paragraph text with occasional quotes and very long lines."""
+    rng = random.Random(seed)
+    words = ["constructor", "pointer", "reference", "object", "memory", "class", "template",
+             "inheritance", "virtual", "exception", "iterator", "vector", "the", "a", "of",
+             "and", "to", "is", "in", "that", "naïve", "résumé", "λ-calculus", "参考"]
+    parts = []
+    size = 0
+    chapter = 0
+    while size < size_bytes:
+        if rng.random() < 0.02:
+            chapter += 1
+            line = f"# Chapter {chapter}: {' '.join(rng.choices(words, k=4)).title()}"
+        elif rng.random() < 0.05:
+            line = '"' + " ".join(rng.choices(words, k=12)) + '"'
+        elif rng.random() < 0.005:
+            # Scanned books often contain whole pages without line breaks
+            line = " ".join(rng.choices(words, k=6000))
+        else:
+            line = " ".join(rng.choices(words, k=rng.randint(5, 30))) + "."
+        parts.append(line)
+        size += len(line.encode('utf-8')) + 1
+    return "\n".join(parts)
+
+
+def legacy_split(text, max_tokens=2000):
+    """The chunker previously inlined in process_course_context_s3."""
+    encoder = tiktoken.encoding_for_model("gpt-4")
+    chunks = []
+    current_chunk = []
+    current_token_count = 0
+
+    for line in text.split('\n'):
+        line_tokens = len(encoder.encode(line + '\n'))
+        if current_token_count + line_tokens > max_tokens:
+            if current_chunk:
+                chunks.append('\n'.join(current_chunk))
+                current_chunk = []
+                current_token_count = 0
+            while line_tokens > max_tokens:
+                chunks.append(line[:len(line) // 2])
+                line = line[len(line) // 2:]
+                line_tokens = len(encoder.encode(line + '\n'))
+            current_chunk.append(line)
+            current_token_count = line_tokens
+        else:
+            current_chunk.append(line)
+            current_token_count += line_tokens
+
+    if current_chunk:
+        chunks.append('\n'.join(current_chunk))
+    return chunks
+
+
+def time_chunker(fn, text, max_tokens, repeat):
+    best = float('inf')
+    chunks = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        chunks = fn(text, max_tokens)
+        best = min(best, time.perf_counter() - start)
+    return best, chunks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=float, default=5.0)
+    parser.add_argument("--max-tokens", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--skip-legacy", action="store_true")
+    args = parser.parse_args()
+
+    text = generate_book(int(args.size_mb * 1024 * 1024))
+    size_mb = len(text.encode('utf-8')) / (1024 * 1024)
+    encoder = tiktoken.encoding_for_model("gpt-4")
+    print(f"Synthetic book: {size_mb:.2f} MB, {text.count(chr(10)) + 1} lines")
+
+    candidates = [("shared chunker", split_text_into_chunks),
+                  ("structure-aware chunker",
+                   lambda text, max_tokens: [c.text for c in split_text_into_section_chunks(text, max_tokens)])]
+    if not args.skip_legacy:
+        candidates.append(("legacy per-line chunker", legacy_split))
+
+    for name, fn in candidates:
+        seconds, chunks = time_chunker(fn, text, args.max_tokens, args.repeat)
+        over_budget = sum(1 for chunk in chunks if len(encoder.encode_ordinary(chunk)) > args.max_tokens)
+        print(f"{name:>24}: {seconds:.2f} s, {size_mb / seconds:.2f} MB/s, "
+              f"{len(chunks)} chunks, {over_budget} over budget")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""
+Recall-vs-size report for the compact embedding storage modes.
+
+Embeds a course's chunks once at full size (through the shared embedding
+cache, so re-runs are free), then builds an index for each storage layout and
+compares its serialized size and recall@k against exact float32 search.
+Queries are one line sampled from each of --queries random chunks, so the
+ground-truth neighbours are the passages a student question would land on.
+
+Shortened API embeddings (EMBEDDING_REQUEST_DIMENSION) are simulated by
+truncating and L2-normalizing the full vectors, which is how text-embedding-3
+models produce their shortened output. PCA layouts also store their
+projection matrix (stored x 3072 floats), so they only pay off on large courses.
+
+Usage (from the backend directory):
+    python -m benchmarks.embedding_storage_report --username alice --course-id <uuid>
+    python -m benchmarks.embedding_storage_report --synthetic 5000
+"""
+import argparse
+import random
+import time
+
+import faiss
+import numpy as np
+
+import utils.index_factory as index_factory
+
+# (label, API dimension or None for full, PCA components or 0, encoding)
+LAYOUTS = [
+    ("fp32 3072 (baseline)", None, 0, index_factory.ENCODING_FP32),
+    ("fp16 3072", None, 0, index_factory.ENCODING_FP16),
+    ("sq8 3072", None, 0, index_factory.ENCODING_SQ8),
+    ("fp32 api-1024", 1024, 0, index_factory.ENCODING_FP32),
+    ("fp16 api-1024", 1024, 0, index_factory.ENCODING_FP16),
+    ("sq8 api-1024", 1024, 0, index_factory.ENCODING_SQ8),
+    ("sq8 api-512", 512, 0, index_factory.ENCODING_SQ8),
+    ("fp16 pca-768", None, 768, index_factory.ENCODING_FP16),
+    ("sq8 pca-768", None, 768, index_factory.ENCODING_SQ8),
+    ("sq8 pca-384", None, 384, index_factory.ENCODING_SQ8),
+]
+
+
+def shorten(vectors, dimension):
+    """Truncate and re-normalize, matching the API's shortened embeddings."""
+    short = np.ascontiguousarray(vectors[:, :dimension])
+    faiss.normalize_L2(short)
+    return short
+
+
+def load_course_texts(username, course_id, num_queries, seed):
+    from utils.course_cache import load_course_state_from_s3
+    from utils.s3_utils import S3_BUCKET_NAME
+
+    state = load_course_state_from_s3(S3_BUCKET_NAME, username, course_id)
+    if state is None:
+        raise SystemExit(f"No chunks found for course {course_id} of {username}")
+    chunks = [chunk for chunk in state.chunks if chunk.strip()]
+
+    rng = random.Random(seed)
+    queries = []
+    for chunk in rng.sample(chunks, min(num_queries, len(chunks))):
+        lines = [line for line in chunk.split('\n') if len(line.split()) >= 5] or [chunk[:300]]
+        queries.append(rng.choice(lines))
+    return chunks, queries
+
+
+def embed_texts(texts):
+    import openai
+    from utils.embedding_cache import EmbeddingCache, EMBEDDING_CACHE_ENABLED
+    from utils.embedding_engine import EmbeddingEngine, EMBEDDING_MODEL, EMBEDDING_DIMENSION
+
+    cache = EmbeddingCache(EMBEDDING_MODEL, EMBEDDING_DIMENSION) if EMBEDDING_CACHE_ENABLED else None
+    engine = EmbeddingEngine(openai.OpenAI(), dimension=EMBEDDING_DIMENSION, cache=cache)
+    return engine.embed(texts)
+
+
+def synthetic_vectors(num_chunks, num_queries, dimension=3072, seed=0):
+    """Clustered unit vectors with a decaying spectrum, roughly like real embeddings."""
+    rng = np.random.default_rng(seed)
+    scales = (1.0 / np.sqrt(np.arange(1, dimension + 1))).astype('float32')
+    centers = rng.standard_normal((max(1, num_chunks // 50), dimension)).astype('float32') * scales
+    labels = rng.integers(0, len(centers), num_chunks)
+    chunks = centers[labels] + 0.5 * rng.standard_normal((num_chunks, dimension)).astype('float32') * scales
+    picked = rng.integers(0, num_chunks, num_queries)
+    queries = chunks[picked] + 0.3 * rng.standard_normal((num_queries, dimension)).astype('float32') * scales
+    chunks, queries = chunks.astype('float32'), queries.astype('float32')
+    faiss.normalize_L2(chunks)
+    faiss.normalize_L2(queries)
+    return chunks, queries
+
+
+def recall_at_k(found, truth, k):
+    hits = sum(len(set(f[:k]) & set(t[:k])) for f, t in zip(found, truth))
+    return hits / (len(truth) * k)
+
+
+def build_report(chunk_vectors, query_vectors, k, index_type):
+    """:return: List of (label, bytes, recall@k, ms per query)"""
+    exact = faiss.IndexFlatL2(chunk_vectors.shape[1])
+    exact.add(chunk_vectors)
+    _, truth = exact.search(query_vectors, k)
+
+    rows = []
+    for label, api_dimension, pca_dimension, encoding in LAYOUTS:
+        vectors, queries = chunk_vectors, query_vectors
+        if api_dimension:
+            vectors, queries = shorten(chunk_vectors, api_dimension), shorten(query_vectors, api_dimension)
+
+        index_factory.FAISS_VECTOR_ENCODING = encoding
+        index_factory.FAISS_PCA_DIMENSION = pca_dimension
+        index = index_factory.build_index(vectors, index_type=index_type)
+        size = len(faiss.serialize_index(index))
+
+        start = time.perf_counter()
+        _, found = index.search(queries, k)
+        ms_per_query = (time.perf_counter() - start) * 1000 / len(queries)
+        rows.append((f"{label} [{index_factory.describe_index(index)['stored_dimension']}d]",
+                     size, recall_at_k(found, truth, k), ms_per_query))
+    return rows
+
+
+def format_report(rows, k, num_chunks, num_queries):
+    baseline = rows[0][1]
+    lines = [f"{num_chunks} chunks, {num_queries} queries, recall@{k} against exact float32 search", "",
+             f"| layout | index size | vs fp32 | recall@{k} | ms/query |",
+             "|---|---:|---:|---:|---:|"]
+    for label, size, recall, ms in rows:
+        lines.append(f"| {label} | {size / (1024 * 1024):.2f} MB | {baseline / size:.1f}x | {recall:.3f} | {ms:.2f} |")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--username")
+    parser.add_argument("--course-id")
+    parser.add_argument("--synthetic", type=int, default=0, help="Use N synthetic chunk vectors instead of a course")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--index-type", default=index_factory.INDEX_TYPE_FLAT, choices=index_factory.INDEX_TYPES)
+    parser.add_argument("--output", help="Also write the markdown table to this file")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.synthetic:
+        chunk_vectors, query_vectors = synthetic_vectors(args.synthetic, args.queries, seed=args.seed)
+    elif args.username and args.course_id:
+        chunks, queries = load_course_texts(args.username, args.course_id, args.queries, args.seed)
+        chunk_vectors = embed_texts(chunks)
+        query_vectors = embed_texts(queries)
+    else:
+        parser.error("pass --username and --course-id, or --synthetic N")
+
+    rows = build_report(chunk_vectors, query_vectors, args.k, args.index_type)
+    report = format_report(rows, args.k, len(chunk_vectors), len(query_vectors))
+    print(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,378 @@
+"""
+Retrieval microbenchmark.
+
+Generates synthetic course text (100 KB, 1 MB and 10 MB by default) and times
+each stage of ContextManager and of process_course_context_s3 separately,
+reporting latency percentiles and peak memory. Runs fully offline: a
+deterministic hashing embedder replaces the OpenAI API and an in-memory store
+replaces S3. Only the tokenizer files cached by tiktoken are needed.
+
+Peak memory is the largest Python heap growth (tracemalloc, which also sees
+NumPy buffers) within a stage, measured in a separate pass so tracing does not
+distort the timings, plus the peak RSS of the whole process.
+
+Usage (from the backend directory):
+    python -m benchmarks.retrieval_benchmark --sizes 100KB 1MB 10MB --queries 200
+    python -m benchmarks.retrieval_benchmark --sizes 1MB --json results.json
+    EMBEDDING_REQUEST_DIMENSION=1024 python -m benchmarks.retrieval_benchmark
+"""
+import os
+
+# The embedding cache, artifact cache and Redis tiers are bypassed so every run
+# measures the same work
+os.environ.setdefault("OPENAI_API_KEY", "offline-benchmark")
+os.environ["EMBEDDING_CACHE_ENABLED"] = "false"
+os.environ["ARTIFACT_CACHE_ENABLED"] = "false"
+os.environ["QUERY_EMBEDDING_CACHE_REDIS"] = "false"
+
+import io
+import re
+import sys
+import json
+import time
+import zlib
+import random
+import shutil
+import argparse
+import tempfile
+import resource
+import tracemalloc
+import contextlib
+from collections import defaultdict
+from types import SimpleNamespace
+
+import numpy as np
+from botocore.exceptions import ClientError
+
+from benchmarks.chunker_benchmark import generate_book
+from utils.embedding_engine import EMBEDDING_DIMENSION
+from utils.query_embedding_cache import get_query_embedding, get_query_embedding_cache
+from utils.bm25_index import BM25Index, HYBRID_CANDIDATES
+from utils.context_assembler import CONTEXT_TOKEN_BUDGET
+import utils.s3_utils as s3_utils
+import utils.load_and_process_index as load_and_process_index
+import utils.index_factory as index_factory
+import context_manager
+
+BENCHMARK_BUCKET = "retrieval-benchmark"
+PERCENTILES = (50, 90, 99)
+
+
+class HashingEmbedder:
+    """
+    Deterministic offline stand-in for an OpenAI client's embeddings endpoint.
+    Words are feature-hashed into signed buckets, so texts sharing words get
+    similar vectors. Like the API, it returns the model's full dimension unless
+    "dimensions" is passed; latency optionally simulates the round trip.
+    """
+
+    def __init__(self, dimension=EMBEDDING_DIMENSION, latency=0.0):
+        self.dimension = dimension
+        self.latency = latency
+        self.embeddings = self
+        self.calls = 0
+
+    def embed_text(self, text, dimension):
+        vector = np.zeros(dimension, dtype='float32')
+        for word in re.findall(r"\w+", text.lower()):
+            h = zlib.crc32(word.encode('utf-8'))
+            vector[h % dimension] += 1.0 if h & 0x80000000 else -1.0
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def create(self, model, input, dimensions=None, **kwargs):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        texts = [input] if isinstance(input, str) else input
+        dimension = dimensions or self.dimension
+        return SimpleNamespace(data=[SimpleNamespace(embedding=self.embed_text(text, dimension).tolist())
+                                     for text in texts])
+
+
+class _Body:
+    def __init__(self, data):
+        self._stream = io.BytesIO(data)
+
+    def read(self, size=-1):
+        return self._stream.read(size)
+
+
+class InMemoryS3:
+    """The subset of the boto3 S3 client used by the indexing pipeline."""
+
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body, ContentType=None):
+        self.objects[Key] = bytes(Body)
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None):
+        with open(Filename, 'rb') as f:
+            self.objects[Key] = f.read()
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        return {'Body': _Body(self.objects[Key])}
+
+    def get_paginator(self, operation_name):
+        objects = self.objects
+
+        class Paginator:
+            def paginate(self, Bucket, Prefix):
+                yield {'Contents': [{'Key': key} for key in sorted(objects) if key.startswith(Prefix)]}
+
+        return Paginator()
+
+
+class StageRecorder:
+    """Collects per-stage latencies and, when tracing, per-stage peak heap growth."""
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.latencies = defaultdict(list)
+        self.peak_bytes = defaultdict(int)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.latencies[name].append(time.perf_counter() - start)
+            if self.trace_memory:
+                self.peak_bytes[name] = max(self.peak_bytes[name], tracemalloc.get_traced_memory()[1] - baseline)
+
+    def wrap(self, name, fn):
+        def timed(*args, **kwargs):
+            with self.stage(name):
+                return fn(*args, **kwargs)
+        return timed
+
+    def wrap_generator(self, name, fn):
+        """Time only the work done inside the generator, accumulated into one sample per call."""
+        def timed(*args, **kwargs):
+            iterator = iter(fn(*args, **kwargs))
+            elapsed = 0.0
+            try:
+                while True:
+                    start = time.perf_counter()
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        break
+                    finally:
+                        elapsed += time.perf_counter() - start
+                    yield item
+            finally:
+                self.latencies[name].append(elapsed)
+        return timed
+
+
+@contextlib.contextmanager
+def patched(obj, name, value):
+    original = getattr(obj, name)
+    setattr(obj, name, value)
+    try:
+        yield
+    finally:
+        setattr(obj, name, original)
+
+
+@contextlib.contextmanager
+def quiet(verbose):
+    """Silence the pipeline's progress prints unless --verbose is given."""
+    if verbose:
+        yield
+    else:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+
+
+def parse_size(text):
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*(KB|MB|B)?", text.upper())
+    if not match:
+        raise argparse.ArgumentTypeError(f"Invalid size: {text}")
+    scale = {"KB": 1024, "MB": 1024 * 1024}.get(match.group(2), 1)
+    return int(float(match.group(1)) * scale)
+
+
+def make_queries(chunks, count, seed=0):
+    """A mix of exact quotes, perturbed quotes, keyword queries and free-form questions."""
+    rng = random.Random(seed)
+    lines = [line for chunk in chunks for line in chunk.split('\n') if line.strip()]
+    quotes = [line for line in lines if line.startswith('"')] or lines
+    queries = []
+    for i in range(count):
+        kind = i % 4
+        if kind == 0:
+            queries.append(rng.choice(quotes))
+        elif kind == 1:
+            words = rng.choice(quotes).split()
+            words[rng.randrange(len(words))] = "something"
+            queries.append(" ".join(words))
+        elif kind == 2:
+            queries.append(" ".join(rng.sample(rng.choice(lines).split(), 2)))
+        else:
+            queries.append(f"can you explain {' '.join(rng.choice(lines).split()[:6])} question {i}")
+    return queries
+
+
+def benchmark_context_manager(text, queries_count, embedder, recorder, max_chunks, verbose):
+    """Build and query a local ContextManager, timing each retrieval stage."""
+    uploads_dir = tempfile.mkdtemp(prefix="retrieval_benchmark_")
+    try:
+        with quiet(verbose):
+            cm = context_manager.ContextManager(uploads_dir=uploads_dir, api_key="offline-benchmark")
+            cm.client = embedder
+            cm.client_embedding = embedder
+
+            with recorder.stage("cm.chunking"):
+                cm.chunks = cm.split_into_chunks(text)
+            with recorder.stage("cm.embed_and_faiss_build"):
+                cm.build_faiss_index()
+            with recorder.stage("cm.inverted_index_build"):
+                cm.build_inverted_index()
+            with recorder.stage("cm.bm25_build"):
+                cm.build_bm25_index()
+
+            get_query_embedding_cache().clear()
+            num_candidates = max(max_chunks, HYBRID_CANDIDATES)
+            for query in make_queries(cm.chunks, queries_count):
+                normalized_query = query.lower()
+                with recorder.stage("query.exact_match"):
+                    _ = normalized_query in cm.inverted_index
+                with recorder.stage("query.fuzzy_match"):
+                    cm.find_approximate_quote_match(normalized_query)
+                with recorder.stage("query.bm25_search"):
+                    lexical_results = cm.bm25_index.search(normalized_query, num_candidates)
+                with recorder.stage("query.embedding"):
+                    query_embedding_np = get_query_embedding(embedder, query, cm.faiss_index.d)
+                with recorder.stage("query.faiss_search"):
+                    indices, vectors = cm._search_with_vectors(query_embedding_np, num_candidates)
+                with recorder.stage("query.context_assembly"):
+                    ranked_ids = cm._fuse_with_vector_results(indices, lexical_results)
+                    cm._assemble_context(ranked_ids, max_chunks, CONTEXT_TOKEN_BUDGET, vectors)
+                with recorder.stage("query.get_relevant_chunks"):
+                    cm.get_relevant_chunks(query, max_chunks)
+        return len(cm.chunks)
+    finally:
+        shutil.rmtree(uploads_dir, ignore_errors=True)
+
+
+def benchmark_s3_pipeline(text, embedder, recorder, verbose):
+    """Run process_course_context_s3 against an in-memory S3, timing its stages."""
+    module = load_and_process_index
+    store = InMemoryS3()
+    prefix = s3_utils.get_course_s3_folder("benchmark", "course")
+    store.put_object(Bucket=BENCHMARK_BUCKET, Key=f"{prefix}book.txt", Body=text.encode('utf-8'))
+
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(patched(s3_utils, "s3_client", store))
+        stack.enter_context(patched(module.openai, "OpenAI", lambda **kwargs: embedder))
+        stack.enter_context(patched(module, "iter_fetched_objects",
+                                    recorder.wrap_generator("s3.fetch_objects", module.iter_fetched_objects)))
+        stack.enter_context(patched(module, "iter_document_chunks",
+                                    recorder.wrap_generator("s3.chunking_incl_read", module.iter_document_chunks)))
+        stack.enter_context(patched(module, "_add_chunk_embeddings",
+                                    recorder.wrap("s3.embed_batch", module._add_chunk_embeddings)))
+        stack.enter_context(patched(module, "add_chunks_to_inverted_index",
+                                    recorder.wrap("s3.inverted_index_add", module.add_chunks_to_inverted_index)))
+        stack.enter_context(patched(BM25Index, "add_documents",
+                                    recorder.wrap("s3.bm25_add", BM25Index.add_documents)))
+        stack.enter_context(patched(index_factory, "rebuild_index",
+                                    recorder.wrap("s3.faiss_finalize", index_factory.rebuild_index)))
+        stack.enter_context(patched(module, "upload_local_file_to_s3",
+                                    recorder.wrap("s3.upload_chunks", module.upload_local_file_to_s3)))
+        stack.enter_context(patched(module, "_upload_index_artifacts",
+                                    recorder.wrap("s3.upload_indices", module._upload_index_artifacts)))
+        stack.enter_context(quiet(verbose))
+        with recorder.stage("s3.process_course_context_s3"):
+            ok = module.process_course_context_s3(BENCHMARK_BUCKET, "benchmark", "course", "offline-benchmark")
+    if not ok:
+        raise RuntimeError("process_course_context_s3 failed")
+    # Per-chunk stages are reported as totals per run
+    for name in ("s3.inverted_index_add", "s3.bm25_add", "s3.embed_batch"):
+        recorder.latencies[name] = [sum(recorder.latencies[name])]
+
+
+def summarize(recorder):
+    rows = {}
+    for name, samples in sorted(recorder.latencies.items()):
+        values = np.asarray(samples) * 1000
+        row = {"count": len(samples), "total_ms": float(values.sum()), "max_ms": float(values.max())}
+        for p in PERCENTILES:
+            row[f"p{p}_ms"] = float(np.percentile(values, p))
+        if name in recorder.peak_bytes:
+            row["peak_mb"] = recorder.peak_bytes[name] / (1024 * 1024)
+        rows[name] = row
+    return rows
+
+
+def format_table(size_label, num_chunks, rows, peak_rss_mb):
+    header = f"{'stage':<32}{'n':>6}" + "".join(f"{f'p{p} ms':>11}" for p in PERCENTILES) \
+        + f"{'max ms':>11}{'total ms':>12}{'peak MB':>10}"
+    lines = [f"== {size_label}: {num_chunks} chunks, peak RSS {peak_rss_mb:.0f} MB ==", header]
+    for name, row in rows.items():
+        peak = f"{row['peak_mb']:.1f}" if "peak_mb" in row else "-"
+        lines.append(f"{name:<32}{row['count']:>6}" + "".join(f"{row[f'p{p}_ms']:>11.2f}" for p in PERCENTILES)
+                     + f"{row['max_ms']:>11.2f}{row['total_ms']:>12.1f}{peak:>10}")
+    return "\n".join(lines)
+
+
+def run_size(size_bytes, args):
+    text = generate_book(size_bytes, seed=args.seed)
+    embedder = HashingEmbedder(latency=args.embedding_latency_ms / 1000)
+
+    recorder = StageRecorder()
+    num_chunks = benchmark_context_manager(text, args.queries, embedder, recorder, args.max_chunks, args.verbose)
+    benchmark_s3_pipeline(text, embedder, recorder, args.verbose)
+
+    if not args.skip_memory:
+        # Separate traced pass: tracemalloc slows allocation-heavy stages considerably
+        traced = StageRecorder(trace_memory=True)
+        tracemalloc.start()
+        try:
+            benchmark_context_manager(text, min(args.queries, 20), embedder, traced, args.max_chunks, args.verbose)
+            benchmark_s3_pipeline(text, embedder, traced, args.verbose)
+        finally:
+            tracemalloc.stop()
+        recorder.peak_bytes = traced.peak_bytes
+
+    return num_chunks, summarize(recorder)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", default=["100KB", "1MB", "10MB"])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--max-chunks", type=int, default=5)
+    parser.add_argument("--embedding-latency-ms", type=float, default=0.0,
+                        help="Simulated API latency per embeddings request")
+    parser.add_argument("--skip-memory", action="store_true", help="Skip the traced memory pass")
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true", help="Show the pipeline's own progress output")
+    args = parser.parse_args()
+
+    results = {}
+    for size_label in args.sizes:
+        num_chunks, rows = run_size(parse_size(size_label), args)
+        # ru_maxrss is reported in kilobytes on Linux
+        peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        results[size_label] = {"chunks": num_chunks, "peak_rss_mb": peak_rss_mb, "stages": rows}
+        print(format_table(size_label, num_chunks, rows, peak_rss_mb))
+        print()
+        sys.stdout.flush()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,4 @@
-import tiktoken
 import openai
-import faiss
-import numpy as np
-from difflib import SequenceMatcher  # For fuzzy matching
 import time
 import os
 from flask import Flask, request, Response, jsonify
@@ -10,40 +6,31 @@ from flask_cors import CORS
 from werkzeug.utils import secure_filename
 
 import tempfile
-import os
 import edge_tts
 import asyncio
+from utils.embedding_engine import EmbeddingEngine
+from utils.query_embedding_cache import get_query_embedding, aget_query_embedding
+from utils.chunker import split_document_into_chunks
+import utils.index_factory as index_factory
+from utils.quote_index import QuoteIndex
+from utils.bm25_index import BM25Index, HYBRID_CANDIDATES, reciprocal_rank_fusion
+from utils.context_assembler import AssembledContext, CONTEXT_TOKEN_BUDGET, assemble_context
 
 class ContextManager:
     def __init__(self, context_file="./uploads/context.txt"):
         self.context_file = context_file
         self.chunks = []
         self.inverted_index = {}
+        self.quote_index = QuoteIndex()
+        self.bm25_index = BM25Index()
         self.client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        self.async_client = openai.AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
         self.faiss_index = None
         self.load_and_process_context()
 
     def split_into_chunks(self, text: str, max_tokens: int = 2000) -> list:
         """Split text into smaller chunks based on token count."""
-        encoder = tiktoken.encoding_for_model("gpt-4")
-        chunks = []
-        current_chunk = []
-        current_token_count = 0
-
-        for line in text.split('\n'):
-            line_tokens = len(encoder.encode(line + '\n'))
-            if current_token_count + line_tokens > max_tokens:
-                if current_chunk:
-                    chunks.append('\n'.join(current_chunk))
-                current_chunk = [line]
-                current_token_count = line_tokens
-            else:
-                current_chunk.append(line)
-                current_token_count += line_tokens
-
-        if current_chunk:
-            chunks.append('\n'.join(current_chunk))
-        return chunks
+        return split_document_into_chunks(text, max_tokens)
 
     def load_and_process_context(self):
         """Load context file, process into chunks, build FAISS index and inverted index."""
@@ -65,6 +52,10 @@ class ContextManager:
             self.build_inverted_index()
             print(f"Inverted index build time: {time.time() - inverted_index_time:.2f} seconds")
 
+            bm25_time = time.time()
+            self.build_bm25_index()
+            print(f"BM25 index build time: {time.time() - bm25_time:.2f} seconds")
+
             print(f"Total context processing time: {time.time() - start_time:.2f} seconds")
 
         except Exception as e:
@@ -77,85 +68,164 @@ class ContextManager:
             quotes = self.extract_quotes_from_chunk(chunk)
             for quote in quotes:
                 self.inverted_index[quote.lower()] = i
+        self.quote_index = QuoteIndex(self.inverted_index)
+
+    def build_bm25_index(self):
+        """Build the BM25 keyword index over chunks."""
+        self.bm25_index = BM25Index.from_chunks(self.chunks)
 
     def extract_quotes_from_chunk(self, chunk):
         """Extract well-known phrases or quotes from a chunk for indexing."""
         return [line for line in chunk.split('\n') if line.startswith('"')]
 
+    def _find_approximate_quote_id(self, query: str, threshold=0.7):
+        """Chunk ID of the closest quote in the inverted index, or None below the similarity threshold."""
+        # Only the quotes sharing the most character trigrams with the query are scored
+        quote = self.quote_index.best_match(query.lower(), threshold)
+        return self.inverted_index[quote] if quote is not None else None
+
     def find_approximate_quote_match(self, query: str, threshold=0.7):
         """Find the closest quote in the inverted index based on similarity threshold."""
-        best_match = None
-        best_score = 0
-        query_lower = query.lower()
-
-        for quote, index in self.inverted_index.items():
-            similarity = SequenceMatcher(None, query_lower, quote).ratio()
-            if similarity > best_score and similarity >= threshold:
-                best_score = similarity
-                best_match = self.chunks[index]
-
-        return best_match
-
-    def get_relevant_chunks(self, query: str, max_chunks: int = 5) -> str:
-        """Retrieve the most relevant chunks based on user query using inverted index, fuzzy matching, and FAISS."""
-        query_time = time.time()
-
+        chunk_id = self._find_approximate_quote_id(query, threshold)
+        return self.chunks[chunk_id] if chunk_id is not None else None
+
+    def _match_without_embedding(self, normalized_query: str, max_chunks: int):
+        """
+        Retrieval steps that need no query embedding: exact quote, fuzzy quote and BM25.
+        :return: (ranked chunk IDs or None, BM25 results to fuse with the vector ranking)
+        """
         # Step 1: Check for exact match in inverted index
-        normalized_query = query.lower()
         if normalized_query in self.inverted_index:
             exact_match_time = time.time()
             chunk_index = self.inverted_index[normalized_query]
             print(f"Exact match time: {time.time() - exact_match_time:.2f} seconds")
-            print(f"Total query processing time: {time.time() - query_time:.2f} seconds")
-            return self.chunks[chunk_index]
+            return [chunk_index], []
 
         # Step 2: Fuzzy match for approximate quotes (case-insensitive)
         fuzzy_time = time.time()
-        approximate_match = self.find_approximate_quote_match(normalized_query)
+        approximate_match = self._find_approximate_quote_id(normalized_query)
         print(f"Fuzzy matching time: {time.time() - fuzzy_time:.2f} seconds")
-        if approximate_match:
+        if approximate_match is not None:
+            return [approximate_match], []
+
+        # Step 3: BM25 keyword ranking; a confident lexical hit skips the query embedding
+        lexical_time = time.time()
+        lexical_results = self.bm25_index.search(normalized_query, max(max_chunks, HYBRID_CANDIDATES))
+        print(f"BM25 search time: {time.time() - lexical_time:.2f} seconds")
+        if self.bm25_index.is_confident(normalized_query, lexical_results):
+            return [i for i, _ in lexical_results], lexical_results
+        return None, lexical_results
+
+    def _search_with_vectors(self, query_embedding_np, k: int):
+        """
+        FAISS search that also returns the stored vectors of the hits, which the
+        context assembler compares to drop near-duplicate chunks.
+        :return: (chunk IDs, dict of chunk ID to vector)
+        """
+        _, indices, vectors = index_factory.search_and_reconstruct(self.faiss_index, query_embedding_np, k)
+        if vectors is None:
+            return indices[0], {}
+        hits = {int(i): vectors[0][rank] for rank, i in enumerate(indices[0]) if i >= 0}
+        return indices[0], hits
+
+    def _fuse_with_vector_results(self, indices, lexical_results) -> list:
+        """Step 4: fuse the FAISS ranking with the BM25 ranking by reciprocal rank."""
+        # Approximate indices return -1 when fewer results than requested are found
+        vector_ranking = [int(i) for i in indices if i >= 0]
+        return reciprocal_rank_fusion([vector_ranking, [i for i, _ in lexical_results]])
+
+    def _assemble_context(self, ranked_ids, max_chunks: int, token_budget: int, vectors=None) -> AssembledContext:
+        """Step 5: fit the best non-redundant chunks into the token budget."""
+        assembly_time = time.time()
+        context = assemble_context(self.chunks, ranked_ids, max_chunks, token_budget, vectors)
+        print(f"Context assembly time: {time.time() - assembly_time:.2f} seconds, "
+              f"{len(context.chunk_ids)} chunks, {context.tokens_used}/{token_budget} tokens, "
+              f"{context.duplicates_dropped} near-duplicates dropped")
+        return context
+
+    def get_relevant_context(self, query: str, max_chunks: int = 5,
+                             token_budget: int = CONTEXT_TOKEN_BUDGET) -> AssembledContext:
+        """
+        Retrieve the most relevant chunks based on user query using inverted index, fuzzy matching,
+        BM25 and FAISS, and assemble them into at most token_budget tokens.
+        """
+        if self.faiss_index is None:
+            return AssembledContext("", [], 0, token_budget)
+        query_time = time.time()
+
+        normalized_query = query.lower()
+        ranked_ids, lexical_results = self._match_without_embedding(normalized_query, max_chunks)
+        if ranked_ids is not None:
+            context = self._assemble_context(ranked_ids, max_chunks, token_budget)
             print(f"Total query processing time: {time.time() - query_time:.2f} seconds")
-            return approximate_match
+            return context
 
-        # Step 3: Fall back to FAISS if no exact or approximate match is found
+        # Step 4: Fall back to FAISS if no quote or confident keyword match is found
         faiss_search_time = time.time()
         try:
-            query_embedding = self.client.embeddings.create(
-                model="text-embedding-3-large",
-                input=query
-            ).data[0].embedding
-            query_embedding_np = np.array(query_embedding).astype('float32').reshape(1, -1)
-
-            _, indices = self.faiss_index.search(query_embedding_np, max_chunks)
-            relevant_chunks = "\n\n".join([self.chunks[i] for i in indices[0]])
+            # Match the index's input dimension in case it was built from shortened embeddings;
+            # repeated questions are served from the query embedding cache
+            query_embedding_np = get_query_embedding(self.client, query, self.faiss_index.d)
+
+            indices, vectors = self._search_with_vectors(query_embedding_np, max(max_chunks, HYBRID_CANDIDATES))
+            ranked_ids = self._fuse_with_vector_results(indices, lexical_results)
             print(f"FAISS search time: {time.time() - faiss_search_time:.2f} seconds")
+            context = self._assemble_context(ranked_ids, max_chunks, token_budget, vectors)
             print(f"Total query processing time: {time.time() - query_time:.2f} seconds")
-            return relevant_chunks
+            return context
 
         except Exception as e:
             print(f"Error getting relevant chunks: {str(e)}")
-            return self.chunks[0] if self.chunks else ""
+            return self._assemble_context([0] if len(self.chunks) else [], 1, token_budget)
+
+    def get_relevant_chunks(self, query: str, max_chunks: int = 5) -> str:
+        """Context text of get_relevant_context within the default token budget."""
+        return self.get_relevant_context(query, max_chunks).text
+
+    async def aget_relevant_context(self, query: str, max_chunks: int = 5,
+                                    token_budget: int = CONTEXT_TOKEN_BUDGET) -> AssembledContext:
+        """
+        Async variant of get_relevant_context. The query embedding is awaited on the
+        async OpenAI client, and CPU-bound matching, FAISS search and assembly run in worker threads.
+        """
+        if self.faiss_index is None:
+            return AssembledContext("", [], 0, token_budget)
+        query_time = time.time()
+
+        normalized_query = query.lower()
+        ranked_ids, lexical_results = await asyncio.to_thread(
+            self._match_without_embedding, normalized_query, max_chunks)
+        if ranked_ids is not None:
+            context = await asyncio.to_thread(self._assemble_context, ranked_ids, max_chunks, token_budget)
+            print(f"Total query processing time: {time.time() - query_time:.2f} seconds")
+            return context
+
+        faiss_search_time = time.time()
+        try:
+            query_embedding_np = await aget_query_embedding(self.async_client, query, self.faiss_index.d)
+
+            indices, vectors = await asyncio.to_thread(
+                self._search_with_vectors, query_embedding_np, max(max_chunks, HYBRID_CANDIDATES))
+            ranked_ids = self._fuse_with_vector_results(indices, lexical_results)
+            print(f"FAISS search time: {time.time() - faiss_search_time:.2f} seconds")
+            context = await asyncio.to_thread(self._assemble_context, ranked_ids, max_chunks, token_budget, vectors)
+            print(f"Total query processing time: {time.time() - query_time:.2f} seconds")
+            return context
+
+        except Exception as e:
+            print(f"Error getting relevant chunks: {str(e)}")
+            return self._assemble_context([0] if len(self.chunks) else [], 1, token_budget)
+
+    async def aget_relevant_chunks(self, query: str, max_chunks: int = 5) -> str:
+        """Async variant of get_relevant_chunks."""
+        return (await self.aget_relevant_context(query, max_chunks)).text
 
     def build_faiss_index(self):
         """Build a FAISS index with precomputed embeddings of chunks."""
-        embeddings = []
-        for chunk in self.chunks:
-            try:
-                embedding = self.client.embeddings.create(
-                    model="text-embedding-3-large",
-                    input=chunk
-                ).data[0].embedding
-                embeddings.append(embedding)
-            except Exception as e:
-                print(f"Error generating embedding: {str(e)}")
-                embeddings.append([0] * 3072)
-
-        embeddings_np = np.array(embeddings).astype('float32')
-
-        # Initialize FAISS index with the large vector size
-        dimension = embeddings_np.shape[1]
-        self.faiss_index = faiss.IndexFlatL2(dimension)
-        self.faiss_index.add(embeddings_np)
+        embeddings_np = EmbeddingEngine(self.client).embed(self.chunks)
+
+        # Exact index for small courses, IVF / IVF-PQ as the chunk count grows
+        self.faiss_index = index_factory.build_index(embeddings_np)
 
 class builtContext:
     def __init__(self):
@@ -1,12 +1,21 @@
-import tiktoken
 import openai
-import faiss
 import numpy as np
-from difflib import SequenceMatcher
 import time
 import os
+import asyncio
 from dotenv import load_dotenv
 import json
+from utils.course_cache import CourseState, get_course_cache
+from utils.embedding_engine import EmbeddingEngine
+from utils.query_embedding_cache import get_query_embedding, aget_query_embedding
+from utils.chunker import split_document_into_chunks
+import utils.index_factory as index_factory
+from utils.quote_index import QuoteIndex
+from utils.bm25_index import BM25Index, HYBRID_CANDIDATES, reciprocal_rank_fusion
+from utils.context_assembler import AssembledContext, CONTEXT_TOKEN_BUDGET, assemble_context
+from utils.chunk_store import ChunkStore, write_chunk_store_file
+from utils.chunk_provenance import ChunkProvenance, PROVENANCE_NAME
+from utils.retrieval_cache import get_retrieval_cache, local_index_version
 load_dotenv()
 
 # Retrieve API key from environment variables
@@ -24,31 +33,20 @@ class ContextManager:
         self.uploads_dir = uploads_dir
         self.chunks = []
         self.inverted_index = {}
+        self.quote_index = QuoteIndex()
+        self.bm25_index = BM25Index()
         self.faiss_index = None
+        self.provenance = None
+        # Course directory and index version the loaded indices belong to, keying shared retrieval results
+        self.course_key = None
+        self.index_version = None
         self.client = openai.OpenAI(api_key=API_KEY, base_url='https://api.jpgpt.online/v1/chat/completions')
         self.client_embedding = openai.OpenAI(api_key=API_KEY, base_url="https://api.jpgpt.online/v1/embeddings")
+        self.async_client_embedding = openai.AsyncOpenAI(api_key=API_KEY, base_url="https://api.jpgpt.online/v1/embeddings")
 
     def split_into_chunks(self, text: str, max_tokens: int = 2300) -> list:
         """Split text into smaller chunks based on token count."""
-        encoder = tiktoken.encoding_for_model("gpt-4")
-        chunks = []
-        current_chunk = []
-        current_token_count = 0
-
-        for line in text.split('\n'):
-            line_tokens = len(encoder.encode(line + '\n'))
-            if current_token_count + line_tokens > max_tokens:
-                if current_chunk:
-                    chunks.append('\n'.join(current_chunk))
-                current_chunk = [line]
-                current_token_count = line_tokens
-            else:
-                current_chunk.append(line)
-                current_token_count += line_tokens
-
-        if current_chunk:
-            chunks.append('\n'.join(current_chunk))
-        return chunks
+        return split_document_into_chunks(text, max_tokens)
 
     def _load_text_files(self):
         """Read and combine text from all .txt files in the uploads directory."""
@@ -81,14 +79,15 @@ class ContextManager:
             chunk_time = time.time()
             self.chunks = self.split_into_chunks(all_text)
             # Save chunks
-            with open(os.path.join(self.uploads_dir, 'chunks.json'), 'w', encoding='utf-8') as f:
-                json.dump(self.chunks, f, ensure_ascii=False, indent=2)
+            write_chunk_store_file(self.chunks, os.path.join(self.uploads_dir, 'chunks.bin'))
             print(f"Chunking time: {time.time() - chunk_time:.2f} seconds")
 
             faiss_time = time.time()
             self.build_faiss_index()
             # Save FAISS index
-            faiss.write_index(self.faiss_index, os.path.join(self.uploads_dir, 'faiss.index'))
+            index_factory.write_index_file(self.faiss_index, os.path.join(self.uploads_dir, 'faiss.index'))
+            self.course_key = self.uploads_dir
+            self.index_version = local_index_version(os.path.join(self.uploads_dir, 'faiss.index'))
             print(f"FAISS index build time: {time.time() - faiss_time:.2f} seconds")
 
             inverted_index_time = time.time()
@@ -98,6 +97,14 @@ class ContextManager:
                 json.dump(self.inverted_index, f, ensure_ascii=False, indent=2)
             print(f"Inverted index build time: {time.time() - inverted_index_time:.2f} seconds")
 
+            bm25_time = time.time()
+            self.build_bm25_index()
+            # Save BM25 index
+            with open(os.path.join(self.uploads_dir, 'bm25_index.json'), 'w', encoding='utf-8') as f:
+                json.dump(self.bm25_index.to_json(), f, ensure_ascii=False)
+            print(f"BM25 index build time: {time.time() - bm25_time:.2f} seconds")
+            get_course_cache().invalidate(self.uploads_dir)
+
             print(f"Total context processing time: {time.time() - start_time:.2f} seconds")
 
         except Exception as e:
@@ -121,14 +128,15 @@ class ContextManager:
             chunk_time = time.time()
             self.chunks = self.split_into_chunks(all_text)
             # Save chunks
-            with open(os.path.join(self.uploads_dir, 'chunks.json'), 'w', encoding='utf-8') as f:
-                json.dump(self.chunks, f, ensure_ascii=False, indent=2)
+            write_chunk_store_file(self.chunks, os.path.join(self.uploads_dir, 'chunks.bin'))
             print(f"Chunking time: {time.time() - chunk_time:.2f} seconds")
 
             faiss_time = time.time()
             self.build_faiss_index()
             # Save FAISS index
-            faiss.write_index(self.faiss_index, os.path.join(self.uploads_dir, 'faiss.index'))
+            index_factory.write_index_file(self.faiss_index, os.path.join(self.uploads_dir, 'faiss.index'))
+            self.course_key = self.uploads_dir
+            self.index_version = local_index_version(os.path.join(self.uploads_dir, 'faiss.index'))
             print(f"FAISS index build time: {time.time() - faiss_time:.2f} seconds")
 
             inverted_index_time = time.time()
@@ -138,6 +146,14 @@ class ContextManager:
                 json.dump(self.inverted_index, f, ensure_ascii=False, indent=2)
             print(f"Inverted index build time: {time.time() - inverted_index_time:.2f} seconds")
 
+            bm25_time = time.time()
+            self.build_bm25_index()
+            # Save BM25 index
+            with open(os.path.join(self.uploads_dir, 'bm25_index.json'), 'w', encoding='utf-8') as f:
+                json.dump(self.bm25_index.to_json(), f, ensure_ascii=False)
+            print(f"BM25 index build time: {time.time() - bm25_time:.2f} seconds")
+            get_course_cache().invalidate(self.uploads_dir)
+
             print(f"Total context processing time: {time.time() - start_time:.2f} seconds")
 
         except Exception as e:
@@ -149,107 +165,276 @@ class ContextManager:
         try:
             print(f"Loading saved indices for course: {title}")
             course_dir = os.path.join(self.base_uploads_dir, title)
-            
-            # Load chunks
-            with open(os.path.join(course_dir, 'chunks.json'), 'r', encoding='utf-8') as f:
-                self.chunks = json.load(f)
-
-            # Load inverted index
-            with open(os.path.join(course_dir, 'inverted_index.json'), 'r', encoding='utf-8') as f:
-                self.inverted_index = json.load(f)
-
-            # Load FAISS index
-            self.faiss_index = faiss.read_index(os.path.join(course_dir, 'faiss.index'))
 
+            state = get_course_cache().get_or_load(course_dir, lambda: self._read_course_state(course_dir))
+            self._use_course_state(state, course_dir)
             return True
         except Exception as e:
             print(f"Error loading saved indices: {str(e)}")
             return False
 
+    def _use_course_state(self, state: CourseState, course_key):
+        """Search a cached course state, whose indices are shared with other requests and never modified."""
+        self.chunks = state.chunks
+        self.inverted_index = state.inverted_index
+        self.quote_index = state.quote_index
+        self.bm25_index = state.bm25_index
+        self.faiss_index = state.faiss_index
+        self.provenance = state.provenance
+        self.course_key = course_key
+        self.index_version = state.version
+
+    def _read_course_state(self, course_dir):
+        """Read chunks, inverted index and FAISS index of a course from disk."""
+        # Load chunks: memory-mapped and decoded on access, or chunks.json for courses processed earlier
+        chunks_path = os.path.join(course_dir, 'chunks.bin')
+        if os.path.exists(chunks_path):
+            chunks = ChunkStore.open_file(chunks_path)
+        else:
+            with open(os.path.join(course_dir, 'chunks.json'), 'r', encoding='utf-8') as f:
+                chunks = json.load(f)
+
+        # Load inverted index
+        with open(os.path.join(course_dir, 'inverted_index.json'), 'r', encoding='utf-8') as f:
+            inverted_index = json.load(f)
+
+        # Load BM25 index, if the course was processed after it was introduced
+        bm25_index = None
+        bm25_path = os.path.join(course_dir, 'bm25_index.json')
+        if os.path.exists(bm25_path):
+            with open(bm25_path, 'r', encoding='utf-8') as f:
+                bm25_index = BM25Index.from_json(json.load(f))
+
+        # Load FAISS index
+        index_path = os.path.join(course_dir, 'faiss.index')
+        # Read first, so a rebuild that replaces the file meanwhile is seen as a newer version
+        version = local_index_version(index_path)
+        # Memory-mapped: the index is rebuilt rather than modified in place
+        faiss_index = index_factory.read_index_file(index_path, mmap=True)
+
+        # Load chunk provenance, present for courses indexed from S3
+        provenance = None
+        provenance_path = os.path.join(course_dir, PROVENANCE_NAME)
+        if os.path.exists(provenance_path):
+            with open(provenance_path, 'rb') as f:
+                provenance = ChunkProvenance.from_bytes(f.read())
+
+        state = CourseState(chunks, inverted_index, faiss_index, os.path.getsize(index_path), bm25_index, provenance)
+        state.version = version
+        return state
+
     def build_inverted_index(self):
         """Build an inverted index for quotes and important phrases."""
+        # Start from a fresh dict: the previous one may be shared through the course cache
+        self.inverted_index = {}
         for i, chunk in enumerate(self.chunks):
             quotes = self.extract_quotes_from_chunk(chunk)
             for quote in quotes:
                 self.inverted_index[quote.lower()] = i
+        self.quote_index = QuoteIndex(self.inverted_index)
+
+    def build_bm25_index(self):
+        """Build the BM25 keyword index over chunks."""
+        self.bm25_index = BM25Index.from_chunks(self.chunks)
 
     def extract_quotes_from_chunk(self, chunk):
         """Extract well-known phrases or quotes from a chunk for indexing."""
         return [line for line in chunk.split('\n') if line.startswith('"')]
 
+    def _find_approximate_quote_id(self, query: str, threshold=0.65):
+        """Chunk ID of the closest quote in the inverted index, or None below the similarity threshold."""
+        # Only the quotes sharing the most character trigrams with the query are scored
+        quote = self.quote_index.best_match(query.lower(), threshold)
+        return self.inverted_index[quote] if quote is not None else None
+
     def find_approximate_quote_match(self, query: str, threshold=0.65):
         """Find the closest quote in the inverted index based on similarity threshold."""
-        best_match = None
-        best_score = 0
-        query_lower = query.lower()
-
-        for quote, index in self.inverted_index.items():
-            similarity = SequenceMatcher(None, query_lower, quote).ratio()
-            if similarity > best_score and similarity >= threshold:
-                best_score = similarity
-                best_match = self.chunks[index]
-
-        return best_match
-
-    def get_relevant_chunks(self, query: str, max_chunks: int = 5) -> str:
-        if self.faiss_index == None:
-            return ""
-        """Retrieve the most relevant chunks based on user query using inverted index, fuzzy matching, and FAISS."""
-        query_time = time.time()
-
+        chunk_id = self._find_approximate_quote_id(query, threshold)
+        return self.chunks[chunk_id] if chunk_id is not None else None
+
+    def _scope_ids(self, source=None, section=None):
+        """
+        Chunk IDs a search is limited to: those from the source file and/or under the
+        section heading path. None searches the whole course, also when the course has
+        no provenance or nothing matches the scope.
+        """
+        if (source is None and section is None) or self.provenance is None:
+            return None
+        scope_ids = self.provenance.select(source, section)
+        if not len(scope_ids):
+            print(f"No chunks in scope source={source!r} section={section!r}, searching the whole course")
+            return None
+        return scope_ids
+
+    @staticmethod
+    def _in_scope(chunk_id, scope_ids) -> bool:
+        if scope_ids is None:
+            return True
+        # Scope IDs are sorted
+        position = np.searchsorted(scope_ids, chunk_id)
+        return bool(position < len(scope_ids) and scope_ids[position] == chunk_id)
+
+    def _match_without_embedding(self, normalized_query: str, max_chunks: int, scope_ids=None):
+        """
+        Retrieval steps that need no query embedding: exact quote, fuzzy quote and BM25.
+        :return: (ranked chunk IDs or None, BM25 results to fuse with the vector ranking)
+        """
         # Step 1: Check for exact match in inverted index
-        normalized_query = query.lower()
-        if normalized_query in self.inverted_index:
+        exact_match = self.inverted_index.get(normalized_query)
+        if exact_match is not None and self._in_scope(exact_match, scope_ids):
             exact_match_time = time.time()
             chunk_index = self.inverted_index[normalized_query]
             print(f"Exact match time: {time.time() - exact_match_time:.2f} seconds")
-            print(f"Total query processing time: {time.time() - query_time:.2f} seconds")
-            return self.chunks[chunk_index]
+            return [chunk_index], []
 
         # Step 2: Fuzzy match for approximate quotes (case-insensitive)
         fuzzy_time = time.time()
-        approximate_match = self.find_approximate_quote_match(normalized_query)
+        approximate_match = self._find_approximate_quote_id(normalized_query)
         print(f"Fuzzy matching time: {time.time() - fuzzy_time:.2f} seconds")
-        if approximate_match:
+        if approximate_match is not None and self._in_scope(approximate_match, scope_ids):
+            return [approximate_match], []
+
+        # Step 3: BM25 keyword ranking; a confident lexical hit skips the query embedding
+        lexical_time = time.time()
+        lexical_results = self.bm25_index.search(normalized_query, max(max_chunks, HYBRID_CANDIDATES), scope_ids)
+        print(f"BM25 search time: {time.time() - lexical_time:.2f} seconds")
+        if self.bm25_index.is_confident(normalized_query, lexical_results):
+            return [i for i, _ in lexical_results], lexical_results
+        return None, lexical_results
+
+    def _search_with_vectors(self, query_embedding_np, k: int, scope_ids=None):
+        """
+        FAISS search that also returns the stored vectors of the hits, which the
+        context assembler compares to drop near-duplicate chunks.
+        :param scope_ids: Optional chunk IDs to search among
+        :return: (chunk IDs, dict of chunk ID to vector)
+        """
+        _, indices, vectors = index_factory.search_and_reconstruct(self.faiss_index, query_embedding_np, k, scope_ids)
+        if vectors is None:
+            return indices[0], {}
+        hits = {int(i): vectors[0][rank] for rank, i in enumerate(indices[0]) if i >= 0}
+        return indices[0], hits
+
+    def _fuse_with_vector_results(self, indices, lexical_results) -> list:
+        """Step 4: fuse the FAISS ranking with the BM25 ranking by reciprocal rank."""
+        # Approximate indices return -1 when fewer results than requested are found
+        vector_ranking = [int(i) for i in indices if i >= 0]
+        return reciprocal_rank_fusion([vector_ranking, [i for i, _ in lexical_results]])
+
+    def _assemble_context(self, ranked_ids, max_chunks: int, token_budget: int, vectors=None) -> AssembledContext:
+        """Step 5: fit the best non-redundant chunks into the token budget."""
+        assembly_time = time.time()
+        context = assemble_context(self.chunks, ranked_ids, max_chunks, token_budget, vectors)
+        print(f"Context assembly time: {time.time() - assembly_time:.2f} seconds, "
+              f"{len(context.chunk_ids)} chunks, {context.tokens_used}/{token_budget} tokens, "
+              f"{context.duplicates_dropped} near-duplicates dropped")
+        return context
+
+    def get_relevant_context(self, query: str, max_chunks: int = 5,
+                             token_budget: int = CONTEXT_TOKEN_BUDGET, source=None, section=None) -> AssembledContext:
+        """
+        Retrieve the most relevant chunks based on user query using inverted index, fuzzy matching,
+        BM25 and FAISS, and assemble them into at most token_budget tokens.
+        :param source: Optional S3 key of a source file to limit the search to
+        :param section: Optional section heading path (list of titles, or joined with " > ") to limit the search to
+        """
+        if self.faiss_index is None:
+            return AssembledContext("", [], 0, token_budget)
+        query_time = time.time()
+
+        # Step 0: Another worker may have answered the question already for this index version
+        cached_ids = get_retrieval_cache().get(self.course_key, self.index_version, query, max_chunks, token_budget,
+                                               source, section)
+        if cached_ids is not None:
+            context = self._assemble_context(cached_ids, max_chunks, token_budget)
+            print(f"Retrieval cache hit, total query processing time: {time.time() - query_time:.2f} seconds")
+            return context
+
+        normalized_query = query.lower()
+        scope_ids = self._scope_ids(source, section)
+        ranked_ids, lexical_results = self._match_without_embedding(normalized_query, max_chunks, scope_ids)
+        if ranked_ids is not None:
+            context = self._assemble_context(ranked_ids, max_chunks, token_budget)
+            print(f"Total query processing time: {time.time() - query_time:.2f} seconds")
+            return context
+
+        # Step 4: Fall back to FAISS if no quote or confident keyword match is found
+        faiss_search_time = time.time()
+        try:
+            # Match the index's input dimension in case it was built from shortened embeddings;
+            # repeated questions are served from the query embedding cache
+            query_embedding_np = get_query_embedding(self.client_embedding, query, self.faiss_index.d)
+
+            indices, vectors = self._search_with_vectors(query_embedding_np, max(max_chunks, HYBRID_CANDIDATES),
+                                                         scope_ids)
+            ranked_ids = self._fuse_with_vector_results(indices, lexical_results)
+            print(f"FAISS search time: {time.time() - faiss_search_time:.2f} seconds")
+            context = self._assemble_context(ranked_ids, max_chunks, token_budget, vectors)
+            # Only results that needed an embedding and a vector search are worth sharing
+            get_retrieval_cache().put(self.course_key, self.index_version, query, max_chunks, token_budget,
+                                      context.chunk_ids, source, section)
+            print(f"Total query processing time: {time.time() - query_time:.2f} seconds")
+            return context
+
+        except Exception as e:
+            print(f"Error getting relevant chunks: {str(e)}")
+            return self._assemble_context([0] if len(self.chunks) else [], 1, token_budget)
+
+    def get_relevant_chunks(self, query: str, max_chunks: int = 5, source=None, section=None) -> str:
+        """Context text of get_relevant_context within the default token budget."""
+        return self.get_relevant_context(query, max_chunks, source=source, section=section).text
+
+    async def aget_relevant_context(self, query: str, max_chunks: int = 5, token_budget: int = CONTEXT_TOKEN_BUDGET,
+                                    source=None, section=None) -> AssembledContext:
+        """
+        Async variant of get_relevant_context. The query embedding is awaited on the
+        async OpenAI client, and CPU-bound matching, FAISS search and assembly run in worker threads.
+        """
+        if self.faiss_index is None:
+            return AssembledContext("", [], 0, token_budget)
+        query_time = time.time()
+
+        cached_ids = await get_retrieval_cache().aget(self.course_key, self.index_version, query, max_chunks,
+                                                      token_budget, source, section)
+        if cached_ids is not None:
+            context = await asyncio.to_thread(self._assemble_context, cached_ids, max_chunks, token_budget)
+            print(f"Retrieval cache hit, total query processing time: {time.time() - query_time:.2f} seconds")
+            return context
+
+        normalized_query = query.lower()
+        scope_ids = self._scope_ids(source, section)
+        ranked_ids, lexical_results = await asyncio.to_thread(
+            self._match_without_embedding, normalized_query, max_chunks, scope_ids)
+        if ranked_ids is not None:
+            context = await asyncio.to_thread(self._assemble_context, ranked_ids, max_chunks, token_budget)
             print(f"Total query processing time: {time.time() - query_time:.2f} seconds")
-            return approximate_match
+            return context
 
-        # Step 3: Fall back to FAISS if no exact or approximate match is found
         faiss_search_time = time.time()
         try:
-            query_embedding = self.client_embedding.embeddings.create(
-                model="text-embedding-3-large",
-                input=query
-            ).data[0].embedding
-            query_embedding_np = np.array(query_embedding).astype('float32').reshape(1, -1)
-
-            _, indices = self.faiss_index.search(query_embedding_np, max_chunks)
-            relevant_chunks = "\n\n".join([self.chunks[i] for i in indices[0]])
+            query_embedding_np = await aget_query_embedding(self.async_client_embedding, query, self.faiss_index.d)
+
+            indices, vectors = await asyncio.to_thread(
+                self._search_with_vectors, query_embedding_np, max(max_chunks, HYBRID_CANDIDATES), scope_ids)
+            ranked_ids = self._fuse_with_vector_results(indices, lexical_results)
             print(f"FAISS search time: {time.time() - faiss_search_time:.2f} seconds")
+            context = await asyncio.to_thread(self._assemble_context, ranked_ids, max_chunks, token_budget, vectors)
+            await get_retrieval_cache().aput(self.course_key, self.index_version, query, max_chunks, token_budget,
+                                             context.chunk_ids, source, section)
             print(f"Total query processing time: {time.time() - query_time:.2f} seconds")
-            return relevant_chunks
+            return context
 
         except Exception as e:
             print(f"Error getting relevant chunks: {str(e)}")
-            return self.chunks[0] if self.chunks else ""
+            return self._assemble_context([0] if len(self.chunks) else [], 1, token_budget)
+
+    async def aget_relevant_chunks(self, query: str, max_chunks: int = 5, source=None, section=None) -> str:
+        """Async variant of get_relevant_chunks."""
+        return (await self.aget_relevant_context(query, max_chunks, source=source, section=section)).text
 
     def build_faiss_index(self):
         """Build a FAISS index with precomputed embeddings of chunks."""
-        embeddings = []
-        for chunk in self.chunks:
-            try:
-                embedding = self.client.embeddings.create(
-                    model="text-embedding-3-large",
-                    input=chunk
-                ).data[0].embedding
-                embeddings.append(embedding)
-            except Exception as e:
-                print(f"Error generating embedding: {str(e)}")
-                embeddings.append([0] * 3072)
-
-        embeddings_np = np.array(embeddings).astype('float32')
-
-        # Initialize FAISS index with the large vector size
-        dimension = embeddings_np.shape[1]
-        self.faiss_index = faiss.IndexFlatL2(dimension)
-        self.faiss_index.add(embeddings_np)
\ No newline at end of file
+        embeddings_np = EmbeddingEngine(self.client).embed(self.chunks)
+
+        # Exact index for small courses, IVF / IVF-PQ as the chunk count grows
+        self.faiss_index = index_factory.build_index(embeddings_np)
\ No newline at end of file
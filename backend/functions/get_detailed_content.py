@@ -1,7 +1,10 @@
 from s3_context_manager import ContextManager as S3ContextManager
 import utils.s3_utils as s3_utils
+import utils.slide_context as slide_context
+import functions.slides_navigation as slides_navigation
 from dotenv import load_dotenv
 import os
+import asyncio
 
 load_dotenv()
 
@@ -9,7 +12,41 @@ API_KEY = os.getenv("OPENAI_API_KEY")
 
 s3_bucket = "jasmintechs-tutorion"
 
-def get_detailed_content(course_title, user, user_query):
+def _get_current_slide_context(course_title, user, user_query, assistant_id):
+    """Context from the precomputed chunks of the slide being presented, or None to run a full search."""
+    if assistant_id is None:
+        return None
+    try:
+        slide_index = slides_navigation.get_current_slide(assistant_id)
+        context = slide_context.get_slide_context(user, course_title, slide_index, user_query, bucket_name=s3_bucket)
+    except Exception as e:
+        print(f"Slide context lookup failed, falling back to a full search: {e}")
+        return None
+    return context.text if context is not None else None
+
+
+def get_detailed_content(course_title, user, user_query, assistant_id=None):
+    """
+    :param assistant_id: Assistant presenting the course; questions about its current
+        slide are answered from the slide's precomputed context when possible
+    """
+    context = _get_current_slide_context(course_title, user, user_query, assistant_id)
+    if context is not None:
+        return context
     s3_context_manager = S3ContextManager(user, course_title, api_key=API_KEY)
     s3_context_manager.load_saved_indices()
     return s3_context_manager.get_relevant_chunks(user_query)
+
+
+async def aget_detailed_content(course_title, user, user_query, assistant_id=None):
+    """Async variant of get_detailed_content for the async webhook handlers."""
+    # The slide context lookup reads Redis and S3, so it runs in a worker thread
+    context = await asyncio.to_thread(_get_current_slide_context, course_title, user, user_query, assistant_id)
+    if context is not None:
+        return context
+    s3_context_manager = S3ContextManager(user, course_title, api_key=API_KEY)
+    # Index loading reads S3 (or the local caches), so it runs in a worker thread
+    await asyncio.to_thread(s3_context_manager.load_saved_indices)
+    if hasattr(s3_context_manager, "aget_relevant_chunks"):
+        return await s3_context_manager.aget_relevant_chunks(user_query)
+    return await asyncio.to_thread(s3_context_manager.get_relevant_chunks, user_query)
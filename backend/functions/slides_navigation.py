@@ -1,10 +1,10 @@
 import json
-import redis
 from utils.socket_utils import emit_slide_change
 import utils.s3_utils as s3_utils
+from utils.redis_utils import get_redis_client
 
-# Initialize Redis connection
-redis_client = redis.Redis(host='localhost', port=6379, db=0)
+# Slide positions live in the Redis instance shared with the caches and locks
+redis_client = get_redis_client()
 
 
 def get_slides(course_id, username):
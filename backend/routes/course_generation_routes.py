@@ -2,7 +2,7 @@ from flask import Blueprint, request, jsonify
 import os
 import tempfile
 import json
-from utils import user_utils, s3_utils
+from utils import user_utils, s3_utils, slide_context
 from course_content_generation.gemini_course_outline_generator import CourseOutlineGenerator
 from course_content_generation.gemini_slide_speech_generator import process_course_outline
 
@@ -173,6 +173,8 @@ def generate_slides():
                     bucket_name='jasmintechs-tutorion',
                     s3_key=f"user_data/{username}/{course_id}/slides.json"
                 )
+                slide_context.refresh_slide_context('jasmintechs-tutorion', username, course_id,
+                                                    os.getenv("OPENAI_API_KEY"), slides_data)
             
             # Upload individual section files and images
             for root, dirs, files in os.walk(output_dir):
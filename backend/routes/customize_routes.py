@@ -6,7 +6,8 @@ import json
 from flask_cors import cross_origin
 from s3_context_manager import ContextManager as S3ContextManager
 from chatbot import ChatBot
-import utils.load_and_process_index as faiss_utils
+import utils.indexing_queue as indexing_queue
+import utils.slide_context as slide_context
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -96,10 +97,14 @@ def customize_course():
         
         # chatbot.context_manager.load_and_process_context_by_path(course_dir)
 
-        faiss_utils.process_course_context_s3("jasmintechs-tutorion", username, title, os.getenv("OPENAI_API_KEY"))
-        print(f"Course context processed for {title} in S3.")
+        # Indexing workers build the course index; progress is emitted to the course's indexing room
+        indexing_status = indexing_queue.enqueue_course_indexing("jasmintechs-tutorion", username, title)
+        print(f"Course context indexing queued for {title}: job {indexing_status['job_id']}")
 
-        return jsonify({'message': 'Course customized successfully and system prompt updated.'}), 200
+        return jsonify({
+            'message': 'Course customized successfully and system prompt updated.',
+            'indexing': indexing_status
+        }), 202
     except Exception as e:
         print(f"Error in customize_course: {str(e)}")
         return jsonify({'error': str(e)}), 500
@@ -126,7 +131,13 @@ def generate_course_materials():
         # user_folder = user_utils.get_user_folder("../uploads", username)
         # course_dir = os.path.join(user_folder, course_title)
         # chatbot_instance.context_manager.load_and_process_context_by_path(course_dir)
-        faiss_utils.process_course_context_s3("jasmintechs-tutorion", username, course_id, os.getenv("api_key"))
+        # Uploads keep the index current, so the syllabus is generated from the published index.
+        # Without one, or while a build is pending, the build is queued and the client retries
+        # once the course's indexing room reports it done.
+        indexing_status = indexing_queue.get_indexing_status("jasmintechs-tutorion", username, course_id)
+        if indexing_queue.is_indexing_active(indexing_status) or not context_manager.load_saved_indices():
+            indexing_status = indexing_queue.enqueue_course_indexing("jasmintechs-tutorion", username, course_id)
+            return jsonify({'message': 'Course is being indexed', 'indexing': indexing_status}), 202
 
         # Generate materials
         syllabus_response = chatbot_instance.process_message(
@@ -215,8 +226,9 @@ def generate_course_slides():
             print(f"Successfully loaded saved indices for course: {course_id}")
         else:
             print(f"No saved indices found for course: {course_id}")
-            # Optionally process context if indices don't exist
-            faiss_utils.process_course_context_s3("jasmintechs-tutorion", username, course_id, os.getenv("api_key"))
+            # Slides need the course index; queue its build and let the client retry when it is done
+            indexing_status = indexing_queue.enqueue_course_indexing("jasmintechs-tutorion", username, course_id)
+            return jsonify({'message': 'Course is being indexed', 'indexing': indexing_status}), 202
         """
         slides_response = chatbot_instance.process_message(
             f'''You are an expert educational slide designer and content generator. Your task is to create the best, most dynamic, and beautiful markdown slides for an educational course. Each slide should be concise, engaging, and reflect current best practices.
@@ -284,6 +296,7 @@ def generate_course_slides():
         # XXXX
 
         s3_utils.upload_json_to_s3(pre_slides, "jasmintechs-tutorion", s3_utils.get_s3_file_path(username, course_id, "slides.json"))
+        slide_context.refresh_slide_context("jasmintechs-tutorion", username, course_id, api_key, pre_slides)
 
         print("*Slides response*:", slides_response)
         return pre_slides
@@ -440,3 +453,17 @@ def get_course_structure():
             'error': str(e)
         }), 500
         
+
+
+@customize_bp.route('/customize/indexing-status', methods=['GET'])
+@cross_origin(supports_credentials=True)
+def get_indexing_status():
+    course_id = request.args.get('course_id')
+    username = user_utils.get_current_user(request)
+    if not username or not course_id:
+        return jsonify({'error': 'Missing required parameters'}), 400
+
+    status = indexing_queue.get_indexing_status("jasmintechs-tutorion", username, course_id)
+    if status is None:
+        return jsonify({'error': 'No indexing job found for this course'}), 404
+    return jsonify(status), 200
@@ -1,6 +1,7 @@
 from flask import Blueprint, request, jsonify
 import utils.user_utils as user_utils  # Assuming this utility gets the current username
 import utils.s3_utils as s3_utils  # Assuming this utility interacts with S3
+import utils.packed_index as packed_index
 
 delete_course_bp = Blueprint('delete_course', __name__)
 
@@ -20,7 +21,10 @@ def delete_course():
     if not course_id or not title:
         return jsonify({'error': 'id and title are required'}), 400
 
-    response = s3_utils.delete_folder_from_s3("jasmintechs-tutorion", s3_utils.get_course_s3_folder(username, title))
+    course_folder = s3_utils.get_course_s3_folder(username, title)
+    # Packed courses also keep their index in a shared shard outside the course folder
+    packed_index.remove_deleted_course("jasmintechs-tutorion", course_folder)
+    response = s3_utils.delete_folder_from_s3("jasmintechs-tutorion", course_folder)
 
     if response:
         return jsonify({'message': 'Course deleted successfully'})
@@ -0,0 +1,34 @@
+import utils.s3_utils as s3_utils
+from context_manager import ContextManager as LocalContextManager
+from utils.course_cache import get_course_state
+
+
+class ContextManager(LocalContextManager):
+    """
+    Retrieval over a course indexed to S3. Indices are read from the version its index
+    manifest names, or from its packed index shard, through the process-wide course cache,
+    so repeated requests for a course reuse one loaded state.
+    """
+
+    def __init__(self, user, course_title, api_key=None, s3_bucket=s3_utils.S3_BUCKET_NAME):
+        super().__init__(api_key=api_key)
+        self.s3_bucket = s3_bucket
+        self.user = user
+        self.course_title = course_title
+
+    def load_saved_indices(self):
+        """
+        Load the course's published index from the course cache.
+        :return: True if the course has a searchable index, False if it was never indexed
+        """
+        try:
+            state = get_course_state(self.user, self.course_title, self.s3_bucket)
+        except Exception as e:
+            print(f"Error loading indices of course {self.course_title} from S3: {str(e)}")
+            return False
+        if state is None or state.faiss_index is None:
+            print(f"No published index for course {self.course_title}")
+            return False
+        course_key = f"{self.s3_bucket}/{s3_utils.get_course_s3_folder(self.user, self.course_title)}"
+        self._use_course_state(state, course_key)
+        return True
@@ -0,0 +1,96 @@
+import os
+import hashlib
+import logging
+import tempfile
+import threading
+from typing import Optional
+
+import utils.s3_utils as s3_utils
+
+logger = logging.getLogger(__name__)
+
+ARTIFACT_CACHE_ENABLED = os.getenv("ARTIFACT_CACHE_ENABLED", "true").lower() == "true"
+ARTIFACT_CACHE_DIR = os.getenv("ARTIFACT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "artifact_cache"))
+
+
+def _key_dir(bucket_name: str, key: str, cache_dir: str) -> str:
+    digest = hashlib.sha256(f"{bucket_name}/{key}".encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, digest[:2], digest)
+
+
+def _remove_stale_versions(key_dir: str, current_name: Optional[str]) -> None:
+    # Unlinking is safe even if another process still has an old version mapped
+    for name in os.listdir(key_dir):
+        if name != current_name and not name.endswith('.tmp'):
+            try:
+                os.remove(os.path.join(key_dir, name))
+            except OSError:
+                pass
+
+
+def _find_cached_version(key_dir: str) -> Optional[str]:
+    if not os.path.isdir(key_dir):
+        return None
+    for name in os.listdir(key_dir):
+        if not name.endswith('.tmp'):
+            return os.path.join(key_dir, name)
+    return None
+
+
+def get_local_artifact_path(bucket_name: str, key: str, cache_dir: str = ARTIFACT_CACHE_DIR,
+                            immutable: bool = False) -> Optional[str]:
+    """
+    Return a local path holding the current version of an S3 object. A cached copy is
+    revalidated with a conditional GET, which downloads the object only when its ETag
+    differs. Files are named by the ETag of the response that wrote them and never
+    rewritten in place, so they can be memory-mapped and shared between workers through
+    the page cache. Keys that are never overwritten, such as versioned index artifacts,
+    can pass immutable=True to skip the request once the file is cached.
+    :return: Local file path, or None if the object does not exist or could not be fetched
+    """
+    key_dir = _key_dir(bucket_name, key, cache_dir)
+    cached = _find_cached_version(key_dir)
+    if immutable and cached is not None:
+        return cached
+
+    cached_etag = os.path.splitext(os.path.basename(cached))[0] if cached is not None else None
+    tmp_path = os.path.join(key_dir, f"download.{os.getpid()}.{threading.get_ident()}.tmp")
+    etag, downloaded = s3_utils.download_s3_object(bucket_name, key, tmp_path, if_none_match=cached_etag)
+    if etag is None:
+        return None
+    if not downloaded:
+        return cached
+
+    name = f"{etag}{os.path.splitext(key)[1]}"
+    path = os.path.join(key_dir, name)
+    try:
+        # Concurrent downloads of the same version write identical content
+        os.replace(tmp_path, path)
+        _remove_stale_versions(key_dir, name)
+    except OSError as e:
+        logger.warning(f"Could not store {key} in the artifact cache: {e}")
+        return None
+    return path
+
+
+def read_artifact_bytes(bucket_name: str, key: str, immutable: bool = False) -> Optional[bytes]:
+    """Read an S3 object through the local artifact cache, falling back to a direct GET."""
+    if ARTIFACT_CACHE_ENABLED:
+        path = get_local_artifact_path(bucket_name, key, immutable=immutable)
+        if path is not None:
+            with open(path, 'rb') as f:
+                return f.read()
+    return s3_utils.read_binary_from_s3_if_exists(bucket_name, key)
+
+
+def remove_local_artifacts(bucket_name: str, keys, cache_dir: str = ARTIFACT_CACHE_DIR) -> None:
+    """Delete cached copies of keys that will not be read again, e.g. artifacts of a replaced index version."""
+    for key in keys:
+        key_dir = _key_dir(bucket_name, key, cache_dir)
+        if not os.path.isdir(key_dir):
+            continue
+        _remove_stale_versions(key_dir, None)
+        try:
+            os.rmdir(key_dir)
+        except OSError:
+            pass
@@ -0,0 +1,170 @@
+import os
+import re
+import sys
+import math
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Lexical results are returned without a query embedding when the top chunk contains
+# every query term and leads the runner-up by at least this fraction of its score
+BM25_CONFIDENCE_MARGIN = float(os.getenv("BM25_CONFIDENCE_MARGIN", "0.35"))
+BM25_MIN_CONFIDENT_TERMS = int(os.getenv("BM25_MIN_CONFIDENT_TERMS", "2"))
+# Candidates taken from each ranking before reciprocal-rank fusion
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "20"))
+RRF_K = 60
+
+_TOKEN_PATTERN = re.compile(r"\w+")
+STOPWORDS = frozenset("""
+a an and are as at be but by can could did do does for from had has have how i if in into is it its
+me my of on or our so that the their them then there these they this those to was we were what when
+where which who whom why will with would you your about explain tell please
+""".split())
+
+
+def tokenize(text: str) -> List[str]:
+    return [term for term in _TOKEN_PATTERN.findall(text.lower()) if term not in STOPWORDS]
+
+
+def reciprocal_rank_fusion(rankings: Iterable[Sequence[int]], k: int = RRF_K) -> List[int]:
+    """Merge ranked lists of chunk IDs, scoring each ID by sum(1 / (k + rank))."""
+    scores: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=lambda chunk_id: -scores[chunk_id])
+
+
+class BM25Index:
+    """
+    Okapi BM25 over course chunks, addressed by chunk ID.
+    Postings hold ascending chunk IDs with their term frequencies; chunks removed
+    from a course keep their ID with a zero length so IDs stay aligned with the chunk store.
+    """
+
+    def __init__(self, doc_lengths: Optional[List[int]] = None,
+                 postings: Optional[Dict[str, Tuple[List[int], List[int]]]] = None):
+        self.doc_lengths: List[int] = list(doc_lengths or [])
+        self.postings: Dict[str, Tuple[List[int], List[int]]] = postings or {}
+        self._arrays: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        self._lengths: Optional[np.ndarray] = None
+
+    @classmethod
+    def from_chunks(cls, chunks: Sequence[str]) -> "BM25Index":
+        index = cls()
+        index.add_documents(chunks, 0)
+        return index
+
+    @classmethod
+    def from_json(cls, data: dict) -> "BM25Index":
+        postings = {term: (ids, tfs) for term, (ids, tfs) in data.get("postings", {}).items()}
+        return cls(data.get("doc_lengths", []), postings)
+
+    def to_json(self) -> dict:
+        return {
+            "doc_lengths": self.doc_lengths,
+            "postings": {term: [ids, tfs] for term, (ids, tfs) in self.postings.items()},
+        }
+
+    @property
+    def nbytes(self) -> int:
+        """Approximate resident size, used for course cache accounting."""
+        size = sys.getsizeof(self.doc_lengths) + 28 * len(self.doc_lengths)
+        for term, (ids, _) in self.postings.items():
+            size += sys.getsizeof(term) + 2 * (sys.getsizeof(ids) + 36 * len(ids))
+        return size
+
+    def add_documents(self, chunks: Sequence[str], start_id: int) -> None:
+        """Index chunks whose IDs start at start_id, which must be past every indexed ID."""
+        if len(self.doc_lengths) < start_id + len(chunks):
+            self.doc_lengths.extend([0] * (start_id + len(chunks) - len(self.doc_lengths)))
+        for chunk_id, chunk in enumerate(chunks, start=start_id):
+            counts = Counter(tokenize(chunk))
+            self.doc_lengths[chunk_id] = sum(counts.values())
+            for term, tf in counts.items():
+                ids, tfs = self.postings.setdefault(term, ([], []))
+                ids.append(chunk_id)
+                tfs.append(tf)
+        self._arrays.clear()
+        self._lengths = None
+
+    def remove_range(self, start: int, end: int) -> None:
+        """Drop chunk IDs in [start, end)."""
+        for term in list(self.postings):
+            ids, tfs = self.postings[term]
+            kept = [(chunk_id, tf) for chunk_id, tf in zip(ids, tfs) if not start <= chunk_id < end]
+            if len(kept) == len(ids):
+                continue
+            if kept:
+                self.postings[term] = ([chunk_id for chunk_id, _ in kept], [tf for _, tf in kept])
+            else:
+                del self.postings[term]
+        for chunk_id in range(start, min(end, len(self.doc_lengths))):
+            self.doc_lengths[chunk_id] = 0
+        self._arrays.clear()
+        self._lengths = None
+
+    def _term_arrays(self, term: str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        arrays = self._arrays.get(term)
+        if arrays is None and term in self.postings:
+            ids, tfs = self.postings[term]
+            arrays = (np.asarray(ids, dtype='int64'), np.asarray(tfs, dtype='float32'))
+            self._arrays[term] = arrays
+        return arrays
+
+    def search(self, query: str, k: int, ids: Optional[np.ndarray] = None) -> List[Tuple[int, float]]:
+        """
+        :param ids: Optional chunk IDs to rank among, e.g. the chunks of one section
+        :return: Up to k (chunk ID, score) pairs with a positive score, best first
+        """
+        if self._lengths is None:
+            self._lengths = np.asarray(self.doc_lengths, dtype='float32')
+        lengths = self._lengths
+        num_docs = int(np.count_nonzero(lengths))
+        if not num_docs or k <= 0:
+            return []
+        avg_length = float(lengths.sum()) / num_docs
+
+        scores = np.zeros(len(lengths), dtype='float32')
+        for term in set(tokenize(query)):
+            arrays = self._term_arrays(term)
+            if arrays is None:
+                continue
+            term_ids, tfs = arrays
+            idf = math.log(1 + (num_docs - len(term_ids) + 0.5) / (len(term_ids) + 0.5))
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[term_ids] / avg_length)
+            scores[term_ids] += idf * tfs * (BM25_K1 + 1) / (tfs + norm)
+        if ids is not None:
+            # Statistics stay course-wide so scores are comparable with unfiltered searches
+            ids = np.asarray(ids, dtype='int64')
+            selected = np.zeros(len(scores), dtype=bool)
+            selected[ids[ids < len(scores)]] = True
+            scores[~selected] = 0
+
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [(int(chunk_id), float(scores[chunk_id])) for chunk_id in top if scores[chunk_id] > 0]
+
+    def is_confident(self, query: str, results: List[Tuple[int, float]]) -> bool:
+        """
+        Whether the lexical ranking alone is trustworthy: the query names enough
+        indexed terms, the top chunk contains all of them, and it clearly outscores
+        the runner-up.
+        """
+        terms = set(tokenize(query))
+        if not results or len(terms) < BM25_MIN_CONFIDENT_TERMS:
+            return False
+        top_id, top_score = results[0]
+        for term in terms:
+            arrays = self._term_arrays(term)
+            if arrays is None:
+                return False
+            ids = arrays[0]
+            position = np.searchsorted(ids, top_id)
+            if position >= len(ids) or ids[position] != top_id:
+                return False
+        return len(results) == 1 or results[1][1] <= top_score * (1 - BM25_CONFIDENCE_MARGIN)
@@ -0,0 +1,148 @@
+import io
+import sys
+import json
+from typing import Dict, Iterable, List, Optional, Sequence, Union
+
+import numpy as np
+
+from utils.chunker import Chunk, SECTION_PATH_SEPARATOR
+
+# Sidecar next to chunks.bin recording where every chunk came from
+PROVENANCE_NAME = "chunk_provenance.npz"
+PROVENANCE_COLUMNS = ("source", "line_start", "line_end", "section", "tokens")
+# Source of chunks removed from the course, whose IDs stay reserved like their empty texts
+REMOVED_SOURCE = -1
+
+
+class ChunkProvenance:
+    """
+    Source file, line range, section and token count of every chunk of a course,
+    stored column by column: element i of each int32 column describes chunk ID i.
+    Source keys and section heading paths are stored once in tables that the
+    "source" and "section" columns index into, so selecting the chunks of a file or
+    section compares integers instead of strings.
+    """
+
+    def __init__(self, sources: Optional[List[str]] = None, sections: Optional[List[List[str]]] = None,
+                 columns: Optional[Dict[str, np.ndarray]] = None):
+        self.sources: List[str] = list(sources or [])
+        self.sections: List[List[str]] = [list(section) for section in sections or []]
+        self._source_ids = {key: i for i, key in enumerate(self.sources)}
+        self._section_ids = {tuple(section): i for i, section in enumerate(self.sections)}
+        columns = columns or {}
+        self._columns = {name: np.asarray(columns.get(name, ()), dtype='int32') for name in PROVENANCE_COLUMNS}
+
+    def __len__(self):
+        return len(self._columns["source"])
+
+    @property
+    def nbytes(self) -> int:
+        size = sum(column.nbytes for column in self._columns.values())
+        size += sum(sys.getsizeof(key) for key in self.sources)
+        return size + sum(sum(sys.getsizeof(title) for title in section) for section in self.sections)
+
+    def _source_id(self, key: str) -> int:
+        if key not in self._source_ids:
+            self._source_ids[key] = len(self.sources)
+            self.sources.append(key)
+        return self._source_ids[key]
+
+    def _section_id(self, section: Sequence[str]) -> int:
+        section = tuple(section)
+        if section not in self._section_ids:
+            self._section_ids[section] = len(self.sections)
+            self.sections.append(list(section))
+        return self._section_ids[section]
+
+    def add_chunks(self, source_key: str, start_id: int, chunks: Iterable[Chunk]) -> None:
+        """
+        Record the chunks of one source file, whose IDs start at start_id. IDs between the
+        last recorded chunk and start_id are recorded as removed.
+        """
+        if start_id < len(self):
+            raise ValueError(f"Chunk IDs from {start_id} are already recorded")
+        self.pad(start_id)
+        source = self._source_id(source_key)
+        self._append_rows([(source, chunk.line_start, chunk.line_end, self._section_id(chunk.section),
+                            chunk.token_count) for chunk in chunks])
+
+    def pad(self, num_chunks: int) -> None:
+        """Record chunk IDs up to num_chunks that have no provenance yet as removed."""
+        self._append_rows([(REMOVED_SOURCE, 0, 0, 0, 0)] * (num_chunks - len(self)))
+
+    def _append_rows(self, rows: List[tuple]) -> None:
+        if not rows:
+            return
+        new_rows = np.asarray(rows, dtype='int32')
+        for i, name in enumerate(PROVENANCE_COLUMNS):
+            self._columns[name] = np.concatenate([self._columns[name], new_rows[:, i]])
+
+    def remove_range(self, start: int, end: int) -> None:
+        """Mark chunk IDs in [start, end) as removed."""
+        self._columns["source"] = self._columns["source"].copy()
+        self._columns["source"][max(0, start):end] = REMOVED_SOURCE
+
+    def get(self, chunk_id: int) -> Optional[Dict]:
+        """:return: Provenance of a chunk, or None for removed or unknown IDs"""
+        if not 0 <= chunk_id < len(self) or self._columns["source"][chunk_id] == REMOVED_SOURCE:
+            return None
+        row = {name: int(self._columns[name][chunk_id]) for name in PROVENANCE_COLUMNS}
+        return {
+            "source": self.sources[row["source"]],
+            "lines": [row["line_start"], row["line_end"]],
+            "section": self.sections[row["section"]] if self.sections else [],
+            "tokens": row["tokens"],
+        }
+
+    def select(self, source: Optional[str] = None,
+               section: Union[str, Sequence[str], None] = None) -> np.ndarray:
+        """
+        IDs of the chunks from a source file and/or under a section, in ascending order.
+        :param source: S3 key of the source file
+        :param section: Heading path prefix, as a list of titles or joined with " > ";
+            ["Week 3"] selects the chunks of Week 3 and all its subsections
+        """
+        mask = self._columns["source"] != REMOVED_SOURCE
+        if source is not None:
+            mask &= self._columns["source"] == self._source_ids.get(source, REMOVED_SOURCE)
+        if section is not None:
+            if isinstance(section, str):
+                section = section.split(SECTION_PATH_SEPARATOR) if section else []
+            prefix = list(section)
+            matching = [i for i, path in enumerate(self.sections) if path[:len(prefix)] == prefix]
+            mask &= np.isin(self._columns["section"], matching)
+        return np.flatnonzero(mask).astype('int64')
+
+    def to_json(self) -> Dict:
+        return {"sources": self.sources, "sections": self.sections,
+                **{name: self._columns[name].tolist() for name in PROVENANCE_COLUMNS}}
+
+    @classmethod
+    def from_json(cls, data: Dict) -> "ChunkProvenance":
+        return cls(data["sources"], data["sections"], {name: data[name] for name in PROVENANCE_COLUMNS})
+
+    def to_bytes(self) -> bytes:
+        tables = json.dumps({"sources": self.sources, "sections": self.sections}).encode('utf-8')
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, tables=np.frombuffer(tables, dtype='uint8'), **self._columns)
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "ChunkProvenance":
+        with np.load(io.BytesIO(data), allow_pickle=False) as arrays:
+            tables = json.loads(arrays["tables"].tobytes().decode('utf-8'))
+            columns = {name: arrays[name] for name in PROVENANCE_COLUMNS}
+        return cls(tables["sources"], tables["sections"], columns)
+
+    @classmethod
+    def from_sources(cls, sources: Dict[str, Dict], num_chunks: int) -> "ChunkProvenance":
+        """
+        Provenance of courses indexed before the sidecar existed, from the per-file chunk
+        ranges of index_sources.json. Sections, lines and token counts are unknown there.
+        """
+        provenance = cls()
+        for key, chunk_range in sorted(sources.items(), key=lambda item: item[1]["start"]):
+            start, end = chunk_range["start"], chunk_range["end"]
+            provenance.add_chunks(key, start, [Chunk("") for _ in range(start, end)])
+        provenance.pad(num_chunks)
+        return provenance
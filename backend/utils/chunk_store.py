@@ -0,0 +1,294 @@
+import os
+import mmap
+import struct
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, Optional
+
+import numpy as np
+
+import utils.s3_utils as s3_utils
+from utils.artifact_cache import ARTIFACT_CACHE_ENABLED, get_local_artifact_path
+
+# chunks.bin layout: header, (count + 1) little-endian uint64 offsets into the blob,
+# then the UTF-8 chunk texts back to back. Chunk i is blob[offsets[i]:offsets[i + 1]].
+CHUNK_STORE_MAGIC = b"CHNK"
+CHUNK_STORE_VERSION = 1
+_HEADER = struct.Struct("<4sHHQ")  # magic, version, reserved, chunk count
+# Read chunk texts from S3 with ranged GETs instead of downloading chunks.bin into the artifact cache
+CHUNK_STORE_LAZY_S3 = os.getenv("CHUNK_STORE_LAZY_S3", "false").lower() == "true"
+# Decoded chunks kept per store when reading from S3
+CHUNK_STORE_CACHE_SIZE = int(os.getenv("CHUNK_STORE_CACHE_SIZE", "256"))
+# First ranged GET when opening a store from S3; covers the offset tables of courses up to ~8k chunks
+_S3_INITIAL_READ = 64 * 1024
+_S3_FETCH_WORKERS = 8
+
+
+class ChunkStoreWriter:
+    """
+    Streams chunk texts into a chunks.bin file. Texts are spooled to a temporary
+    blob file and the offset table is kept in memory (8 bytes per chunk) until finish().
+    """
+
+    def __init__(self):
+        self._blob = tempfile.TemporaryFile()
+        self._offsets = [0]
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def add(self, chunk: str) -> None:
+        self._offsets.append(self._offsets[-1] + self._blob.write(chunk.encode('utf-8')))
+
+    def extend(self, chunks: Iterable[str]) -> None:
+        for chunk in chunks:
+            self.add(chunk)
+
+    def finish(self, path: str) -> None:
+        """Write the store to path and release the spool file."""
+        with open(path, 'wb') as f:
+            f.write(_HEADER.pack(CHUNK_STORE_MAGIC, CHUNK_STORE_VERSION, 0, len(self)))
+            f.write(np.asarray(self._offsets, dtype='<u8').tobytes())
+            self._blob.seek(0)
+            shutil.copyfileobj(self._blob, f)
+        self.close()
+
+    def close(self) -> None:
+        self._blob.close()
+
+
+def encode_chunk_store(chunks: Iterable[str]) -> bytes:
+    """Serialize chunk texts to the chunks.bin format in memory."""
+    encoded = [chunk.encode('utf-8') for chunk in chunks]
+    offsets = np.zeros(len(encoded) + 1, dtype='<u8')
+    np.cumsum([len(data) for data in encoded], out=offsets[1:])
+    header = _HEADER.pack(CHUNK_STORE_MAGIC, CHUNK_STORE_VERSION, 0, len(encoded))
+    return b"".join([header, offsets.tobytes()] + encoded)
+
+
+def write_chunk_store_file(chunks: Iterable[str], path: str) -> None:
+    """Write a chunks.bin file atomically, so readers that mapped the old file are unaffected."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(encode_chunk_store(chunks))
+    os.replace(tmp_path, path)
+
+
+def _parse_header(data: bytes) -> int:
+    if len(data) < _HEADER.size:
+        raise ValueError("Chunk store is truncated")
+    magic, version, _, count = _HEADER.unpack_from(data)
+    if magic != CHUNK_STORE_MAGIC or version != CHUNK_STORE_VERSION:
+        raise ValueError(f"Not a version {CHUNK_STORE_VERSION} chunk store")
+    return count
+
+
+def _table_end(count: int) -> int:
+    return _HEADER.size + 8 * (count + 1)
+
+
+class ChunkStore(Sequence):
+    """
+    Read-only list of chunk texts backed by a chunks.bin file. Only the header and
+    offset table are read up front; texts are decoded on access, from a local
+    memory map or with S3 byte-range GETs.
+    """
+
+    def __init__(self, offsets: np.ndarray, blob_start: int):
+        self._offsets = offsets
+        self._blob_start = blob_start
+
+    @classmethod
+    def open_file(cls, path: str) -> "ChunkStore":
+        return _MappedChunkStore(path)
+
+    @classmethod
+    def open_s3(cls, bucket_name: str, key: str) -> Optional["ChunkStore"]:
+        """:return: Store reading from S3, or None if the object does not exist"""
+        return _S3ChunkStore.open(bucket_name, key)
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def _range(self, chunk_id: int):
+        if chunk_id < 0:
+            chunk_id += len(self)
+        if not 0 <= chunk_id < len(self):
+            raise IndexError("chunk index out of range")
+        return self._blob_start + int(self._offsets[chunk_id]), self._blob_start + int(self._offsets[chunk_id + 1])
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return self.get_many(range(*item.indices(len(self))))
+        return self._read_chunk(int(item))
+
+    def _read_chunk(self, chunk_id: int) -> str:
+        raise NotImplementedError
+
+    def get_many(self, chunk_ids: Iterable[int]) -> List[str]:
+        """Texts of several chunks, in the order given."""
+        return [self._read_chunk(int(chunk_id)) for chunk_id in chunk_ids]
+
+    def slice(self, start: int, end: int) -> "ChunkStore":
+        """Chunks [start, end) as a store of their own, numbered from 0, reading through this store."""
+        return _ChunkStoreSlice(self, start, end)
+
+    @property
+    def nbytes(self) -> int:
+        """Approximate resident size, used for course cache accounting."""
+        return self._offsets.nbytes
+
+
+class _ChunkStoreSlice(ChunkStore):
+    def __init__(self, parent: ChunkStore, start: int, end: int):
+        super().__init__(parent._offsets[start:end + 1], parent._blob_start)
+        self._parent = parent
+        self._start = start
+
+    def _parent_id(self, chunk_id: int) -> int:
+        if chunk_id < 0:
+            chunk_id += len(self)
+        if not 0 <= chunk_id < len(self):
+            raise IndexError("chunk index out of range")
+        return self._start + chunk_id
+
+    def _read_chunk(self, chunk_id: int) -> str:
+        return self._parent._read_chunk(self._parent_id(chunk_id))
+
+    def get_many(self, chunk_ids: Iterable[int]) -> List[str]:
+        return self._parent.get_many([self._parent_id(int(chunk_id)) for chunk_id in chunk_ids])
+
+    @property
+    def nbytes(self) -> int:
+        # Texts read through the parent are accounted with it
+        return self._offsets.nbytes
+
+
+class _MappedChunkStore(ChunkStore):
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            # The mapping stays valid after the file is closed, replaced or unlinked
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        count = _parse_header(self._mmap)
+        if len(self._mmap) < _table_end(count):
+            raise ValueError(f"Chunk store {path} is truncated")
+        offsets = np.frombuffer(self._mmap, dtype='<u8', count=count + 1, offset=_HEADER.size)
+        super().__init__(offsets, _table_end(count))
+
+    def _read_chunk(self, chunk_id: int) -> str:
+        start, end = self._range(chunk_id)
+        return self._mmap[start:end].decode('utf-8')
+
+
+class _S3ChunkStore(ChunkStore):
+    def __init__(self, bucket_name: str, key: str, etag: str, offsets: np.ndarray, blob_start: int,
+                 cache_size: int = CHUNK_STORE_CACHE_SIZE):
+        super().__init__(offsets, blob_start)
+        self.bucket_name = bucket_name
+        self.key = key
+        # Every read is pinned to the version whose offset table was loaded
+        self.etag = etag
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[int, str]" = OrderedDict()
+        self._cache_bytes = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def open(cls, bucket_name: str, key: str) -> Optional["_S3ChunkStore"]:
+        result = s3_utils.read_s3_byte_range(bucket_name, key, 0, _S3_INITIAL_READ)
+        if result is None:
+            return None
+        head, etag = result
+        count = _parse_header(head)
+        table_end = _table_end(count)
+        if len(head) < table_end:
+            rest = s3_utils.read_s3_byte_range(bucket_name, key, len(head), table_end, etag)
+            if rest is None:
+                raise IOError(f"Could not read the offset table of {bucket_name}/{key}")
+            head += rest[0]
+        offsets = np.frombuffer(head, dtype='<u8', count=count + 1, offset=_HEADER.size)
+        return cls(bucket_name, key, etag, offsets, table_end)
+
+    def _cached(self, chunk_id: int) -> Optional[str]:
+        with self._lock:
+            text = self._cache.get(chunk_id)
+            if text is not None:
+                self._cache.move_to_end(chunk_id)
+            return text
+
+    def _remember(self, chunk_id: int, text: str) -> None:
+        with self._lock:
+            if chunk_id not in self._cache:
+                self._cache_bytes += len(text)
+            self._cache[chunk_id] = text
+            while len(self._cache) > self.cache_size:
+                _, evicted = self._cache.popitem(last=False)
+                self._cache_bytes -= len(evicted)
+
+    def _fetch(self, start: int, end: int) -> bytes:
+        result = s3_utils.read_s3_byte_range(self.bucket_name, self.key, start, end, self.etag)
+        if result is None:
+            raise IOError(f"Could not read bytes {start}-{end - 1} of {self.bucket_name}/{self.key}")
+        return result[0]
+
+    def _read_chunk(self, chunk_id: int) -> str:
+        text = self._cached(chunk_id)
+        if text is None:
+            text = self._fetch(*self._range(chunk_id)).decode('utf-8')
+            self._remember(chunk_id, text)
+        return text
+
+    def get_many(self, chunk_ids: Iterable[int]) -> List[str]:
+        """Fetch uncached chunks concurrently, merging adjacent ones into a single GET."""
+        chunk_ids = [int(chunk_id) for chunk_id in chunk_ids]
+        texts = {chunk_id: self._cached(chunk_id) for chunk_id in chunk_ids}
+        missing = sorted(chunk_id for chunk_id, text in texts.items() if text is None)
+
+        runs = []
+        for chunk_id in missing:
+            if runs and runs[-1][-1] + 1 == chunk_id:
+                runs[-1].append(chunk_id)
+            else:
+                runs.append([chunk_id])
+
+        def fetch_run(run):
+            run_start = self._range(run[0])[0]
+            data = self._fetch(run_start, self._range(run[-1])[1])
+            for chunk_id in run:
+                start, end = self._range(chunk_id)
+                text = data[start - run_start:end - run_start].decode('utf-8')
+                self._remember(chunk_id, text)
+                texts[chunk_id] = text
+
+        if len(runs) == 1:
+            fetch_run(runs[0])
+        elif runs:
+            with ThreadPoolExecutor(max_workers=min(_S3_FETCH_WORKERS, len(runs))) as executor:
+                list(executor.map(fetch_run, runs))
+        return [texts[chunk_id] for chunk_id in chunk_ids]
+
+    @property
+    def nbytes(self) -> int:
+        return self._offsets.nbytes + self._cache_bytes
+
+
+def get_chunks(chunks, chunk_ids: Iterable[int]) -> List[str]:
+    """Texts of chunk_ids from a list or a ChunkStore, batching reads where the store supports it."""
+    if isinstance(chunks, ChunkStore):
+        return chunks.get_many(chunk_ids)
+    return [chunks[chunk_id] for chunk_id in chunk_ids]
+
+
+def load_chunk_store_from_s3(bucket_name: str, key: str, immutable: bool = False) -> Optional[ChunkStore]:
+    """
+    Open a chunks.bin object, through the local artifact cache unless lazy S3 reads
+    are enabled. :return: ChunkStore, or None if the object does not exist
+    """
+    if ARTIFACT_CACHE_ENABLED and not CHUNK_STORE_LAZY_S3:
+        path = get_local_artifact_path(bucket_name, key, immutable=immutable)
+        return ChunkStore.open_file(path) if path is not None else None
+    return ChunkStore.open_s3(bucket_name, key)
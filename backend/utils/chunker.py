@@ -0,0 +1,322 @@
+import os
+import re
+import threading
+from itertools import islice
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import tiktoken
+
+CHUNK_ENCODING_MODEL = "gpt-4"
+# Number of lines tokenized per encode_ordinary_batch call
+ENCODE_BATCH_LINES = 1024
+# Split course files on Markdown headings, paragraphs and code blocks instead of lines only
+STRUCTURED_CHUNKING = os.getenv("STRUCTURED_CHUNKING", "true").lower() == "true"
+# Sections smaller than this are packed together with the following sibling sections
+CHUNK_MIN_SECTION_TOKENS = int(os.getenv("CHUNK_MIN_SECTION_TOKENS", "256"))
+# Number of structural blocks tokenized per encode_ordinary_batch call
+ENCODE_BATCH_BLOCKS = 256
+SECTION_PATH_SEPARATOR = " > "
+
+_HEADING_RE = re.compile(r'^ {0,3}(#{1,6})[ \t]+(.*?)[ \t]*#*[ \t]*$')
+_FENCE_RE = re.compile(r'^ {0,3}(`{3,}|~{3,})')
+
+_encoder = None
+_encoder_lock = threading.Lock()
+
+
+def get_encoder():
+    """Return the process-wide tokenizer used for chunking, loading it once."""
+    global _encoder
+    if _encoder is None:
+        with _encoder_lock:
+            if _encoder is None:
+                _encoder = tiktoken.encoding_for_model(CHUNK_ENCODING_MODEL)
+    return _encoder
+
+
+def _split_tokens(encoder, text: str, tokens: List[int], max_tokens: int) -> List[Tuple[str, int]]:
+    """
+    Cut an already-encoded text into pieces of at most max_tokens tokens,
+    slicing the text at token boundaries instead of re-encoding it.
+    Cut points are moved back to the nearest UTF-8 character boundary.
+    :return: List of (piece, token count)
+    """
+    text_bytes = text.encode('utf-8')
+    offsets = [0]
+    for token_bytes in encoder.decode_tokens_bytes(tokens):
+        offsets.append(offsets[-1] + len(token_bytes))
+
+    pieces = []
+    start_token = 0
+    while start_token < len(tokens):
+        end_token = min(start_token + max_tokens, len(tokens))
+        # A token may end in the middle of a multi-byte character
+        while end_token > start_token + 1 and end_token < len(tokens) \
+                and (text_bytes[offsets[end_token]] & 0xC0) == 0x80:
+            end_token -= 1
+        piece = text_bytes[offsets[start_token]:offsets[end_token]].decode('utf-8', errors='replace')
+        pieces.append((piece, end_token - start_token))
+        start_token = end_token
+    return pieces
+
+
+def split_lines_into_chunks(lines: Iterable[str], max_tokens: int = 2000) -> Iterator[str]:
+    """
+    Group lines into chunks of at most max_tokens tokens, yielding each chunk.
+    Lines are tokenized in batches; a line longer than max_tokens is split at
+    token boundaries into full-size chunks, and its remainder starts the next chunk.
+    """
+    encoder = get_encoder()
+    current_chunk = []
+    current_token_count = 0
+
+    lines = iter(lines)
+    while True:
+        batch = [line + '\n' for line in islice(lines, ENCODE_BATCH_LINES)]
+        if not batch:
+            break
+        for line, tokens in zip(batch, encoder.encode_ordinary_batch(batch)):
+            line_tokens = len(tokens)
+            if current_token_count + line_tokens > max_tokens:
+                if current_chunk:
+                    yield '\n'.join(current_chunk)
+                    current_chunk = []
+                    current_token_count = 0
+                if line_tokens > max_tokens:
+                    pieces = _split_tokens(encoder, line, tokens, max_tokens)
+                    for piece, _ in pieces[:-1]:
+                        yield piece
+                    line, line_tokens = pieces[-1]
+                current_chunk.append(line[:-1] if line.endswith('\n') else line)
+                current_token_count = line_tokens
+            else:
+                current_chunk.append(line[:-1])
+                current_token_count += line_tokens
+
+    if current_chunk:
+        yield '\n'.join(current_chunk)
+
+
+def split_text_into_chunks(text: str, max_tokens: int = 2000) -> List[str]:
+    """Split text into chunks of at most max_tokens tokens on line boundaries."""
+    return list(split_lines_into_chunks(text.split('\n'), max_tokens))
+
+
+class Chunk:
+    """A chunk of text with the heading path of the section and the lines it came from."""
+
+    def __init__(self, text: str, section: Optional[List[str]] = None, token_count: int = 0,
+                 line_start: int = 0, line_end: int = 0):
+        self.text = text
+        # Titles from the outermost heading down, e.g. ["Chapter 2", "Pointers"]; empty before any heading
+        self.section = section or []
+        self.token_count = token_count
+        # First and last line of the source file in the chunk, counted from 1 (0 if unknown)
+        self.line_start = line_start
+        self.line_end = line_end
+
+    @property
+    def section_title(self) -> str:
+        return SECTION_PATH_SEPARATOR.join(self.section)
+
+    @property
+    def embedding_text(self) -> str:
+        """Text to embed: chunks that continue a section are prefixed with its heading path."""
+        if self.section and not _HEADING_RE.match(self.text.split('\n', 1)[0]):
+            return f"{self.section_title}\n\n{self.text}"
+        return self.text
+
+    def __repr__(self):
+        return (f"Chunk(section={self.section_title!r}, tokens={self.token_count}, "
+                f"lines={self.line_start}-{self.line_end})")
+
+
+def _iter_blocks(lines: Iterable[str]) -> Iterator[Tuple[str, str, int, int, int]]:
+    """
+    Group lines into Markdown blocks: headings, paragraphs (runs of non-blank lines)
+    and fenced code blocks, which are kept whole including blank lines.
+    :return: Generator of (kind, text, heading level, first line, last line) with kind
+        "heading", "paragraph" or "code" and lines counted from 1
+    """
+    paragraph = []
+    code = None
+    fence = None
+    start = 0
+    line_number = 0
+    for line_number, line in enumerate(lines, start=1):
+        if code is not None:
+            code.append(line)
+            if line.strip().startswith(fence):
+                yield "code", '\n'.join(code), 0, start, line_number
+                code = None
+            continue
+        fence_match = _FENCE_RE.match(line)
+        heading_match = _HEADING_RE.match(line)
+        if fence_match or heading_match or not line.strip():
+            if paragraph:
+                yield "paragraph", '\n'.join(paragraph), 0, start, line_number - 1
+                paragraph = []
+            if fence_match:
+                fence = fence_match.group(1)
+                code = [line]
+                start = line_number
+            elif heading_match:
+                yield "heading", line.strip(), len(heading_match.group(1)), line_number, line_number
+        else:
+            if not paragraph:
+                start = line_number
+            paragraph.append(line)
+    if paragraph:
+        yield "paragraph", '\n'.join(paragraph), 0, start, line_number
+    if code:
+        # Unterminated fence: keep what was read
+        yield "code", '\n'.join(code), 0, start, line_number
+
+
+def _split_block(text: str, first_line: int, max_tokens: int) -> List[Tuple[str, int, int]]:
+    """
+    Split an oversized block on lines as split_lines_into_chunks does.
+    :return: List of (piece, first line, last line)
+    """
+    pieces = []
+    offset = 0
+    for piece in split_lines_into_chunks(text.split('\n'), max_tokens):
+        # Pieces are consecutive substrings of the block, separated by a newline or nothing
+        found = text.find(piece, offset)
+        start = found if found >= 0 else offset
+        offset = start + len(piece)
+        pieces.append((piece, first_line + text.count('\n', 0, start),
+                       first_line + text.count('\n', 0, max(start, offset - 1))))
+    return pieces
+
+
+def _common_prefix(a: List[str], b: List[str]) -> List[str]:
+    prefix = []
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        prefix.append(x)
+    return prefix
+
+
+def split_lines_into_section_chunks(lines: Iterable[str], max_tokens: int = 2000,
+                                    min_section_tokens: int = CHUNK_MIN_SECTION_TOKENS) -> Iterator[Chunk]:
+    """
+    Chunk Markdown-like text along its structure, yielding Chunk objects of at most
+    max_tokens tokens. Chunks end at headings, so a chunk covers one section, except
+    that sections under min_section_tokens are packed with the following ones (never
+    across a top-level heading). Within a section, chunks end between paragraphs and
+    code blocks; a block larger than max_tokens is split on lines as split_lines_into_chunks does.
+    Each chunk records the heading path shared by everything in it and its line range.
+    """
+    encoder = get_encoder()
+    separator_tokens = len(encoder.encode_ordinary('\n\n'))
+    min_section_tokens = min(min_section_tokens, max_tokens // 2)
+    headings: List[Tuple[int, str]] = []
+    parts: List[str] = []
+    part_tokens = 0
+    has_body = False
+    # Heading path shared by the body blocks of the current chunk
+    chunk_section: Optional[List[str]] = None
+    chunk_lines = [0, 0]
+
+    def current_path():
+        return [title for _, title in headings]
+
+    def flush():
+        nonlocal parts, part_tokens, has_body, chunk_section
+        chunk = None
+        if parts:
+            section = chunk_section if chunk_section is not None else current_path()
+            chunk = Chunk('\n\n'.join(parts), section, part_tokens, chunk_lines[0], chunk_lines[1])
+        parts, part_tokens, has_body, chunk_section = [], 0, False, None
+        return chunk
+
+    def append(text, tokens, first_line, last_line):
+        nonlocal part_tokens
+        if not parts:
+            chunk_lines[0] = first_line
+        chunk_lines[1] = last_line
+        part_tokens += tokens + (separator_tokens if parts else 0)
+        parts.append(text)
+
+    def add_body(text, tokens, first_line, last_line, path):
+        nonlocal has_body, chunk_section
+        append(text, tokens, first_line, last_line)
+        has_body = True
+        chunk_section = path if chunk_section is None else _common_prefix(chunk_section, path)
+
+    blocks = _iter_blocks(lines)
+    while True:
+        batch = list(islice(blocks, ENCODE_BATCH_BLOCKS))
+        if not batch:
+            break
+        token_counts = [len(tokens) for tokens in encoder.encode_ordinary_batch([block[1] for block in batch])]
+        for (kind, text, level, first_line, last_line), tokens in zip(batch, token_counts):
+            if kind == "heading":
+                if has_body and (part_tokens >= min_section_tokens or level == 1):
+                    chunk = flush()
+                    if chunk:
+                        yield chunk
+                while headings and headings[-1][0] >= level:
+                    headings.pop()
+                headings.append((level, _HEADING_RE.match(text).group(2)))
+                if part_tokens + tokens + separator_tokens > max_tokens:
+                    chunk = flush()
+                    if chunk:
+                        yield chunk
+                append(text, tokens, first_line, last_line)
+                continue
+
+            path = current_path()
+            budget = max_tokens - part_tokens - (separator_tokens if parts else 0)
+            if tokens > max_tokens:
+                # Oversized paragraph or code block: split it on lines, filling the open chunk
+                # (typically just its heading) with the first piece; the last piece stays open
+                if budget < max_tokens // 2:
+                    chunk = flush()
+                    if chunk:
+                        yield chunk
+                    budget = max_tokens
+                pieces = _split_block(text, first_line, budget)
+                for piece, piece_start, piece_end in pieces[:-1]:
+                    add_body(piece, len(encoder.encode_ordinary(piece)), piece_start, piece_end, path)
+                    yield flush()
+                text, first_line, last_line = pieces[-1]
+                tokens = len(encoder.encode_ordinary(text))
+            elif tokens > budget:
+                chunk = flush()
+                if chunk:
+                    yield chunk
+            add_body(text, tokens, first_line, last_line, path)
+
+    chunk = flush()
+    if chunk:
+        yield chunk
+
+
+def split_text_into_section_chunks(text: str, max_tokens: int = 2000) -> List[Chunk]:
+    """Split text into structure-aware chunks of at most max_tokens tokens."""
+    return list(split_lines_into_section_chunks(text.split('\n'), max_tokens))
+
+
+def _iter_line_chunks(lines: Iterable[str], max_tokens: int) -> Iterator[Chunk]:
+    """Line-only chunks as Chunk objects; line ranges are approximate where long lines were split."""
+    encoder = get_encoder()
+    line_number = 1
+    for text in split_lines_into_chunks(lines, max_tokens):
+        line_end = line_number + text.count('\n')
+        yield Chunk(text, token_count=len(encoder.encode_ordinary(text)), line_start=line_number, line_end=line_end)
+        line_number = line_end + 1
+
+
+def iter_document_chunks(lines: Iterable[str], max_tokens: int = 2000) -> Iterator[Chunk]:
+    """Chunk a course file with the structure-aware chunker, or on lines only if STRUCTURED_CHUNKING is off."""
+    if STRUCTURED_CHUNKING:
+        return split_lines_into_section_chunks(lines, max_tokens)
+    return _iter_line_chunks(lines, max_tokens)
+
+
+def split_document_into_chunks(text: str, max_tokens: int = 2000) -> List[str]:
+    """Chunk texts of a document, split as iter_document_chunks does."""
+    return [chunk.text for chunk in iter_document_chunks(text.split('\n'), max_tokens)]
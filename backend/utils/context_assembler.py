@@ -0,0 +1,143 @@
+import os
+import logging
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from utils.chunker import get_encoder
+from utils.chunk_store import get_chunks
+from utils.bm25_index import tokenize
+
+logger = logging.getLogger(__name__)
+
+# Tokens of course context placed in a system prompt (five full chunks used to be ~10k)
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "4000"))
+# Ranked candidates considered by MMR, of which at most max_chunks are kept
+CONTEXT_MMR_CANDIDATES = int(os.getenv("CONTEXT_MMR_CANDIDATES", "10"))
+# Weight of relevance against novelty in maximal marginal relevance
+CONTEXT_MMR_LAMBDA = float(os.getenv("CONTEXT_MMR_LAMBDA", "0.7"))
+# Candidates at least this similar to an already selected chunk are dropped as duplicates:
+# cosine similarity of their vectors, or term-set Jaccard similarity when a vector is missing
+CONTEXT_DUPLICATE_SIMILARITY = float(os.getenv("CONTEXT_DUPLICATE_SIMILARITY", "0.92"))
+CONTEXT_DUPLICATE_JACCARD = float(os.getenv("CONTEXT_DUPLICATE_JACCARD", "0.8"))
+CHUNK_SEPARATOR = "\n\n"
+
+
+class AssembledContext:
+    """Context text for a prompt, with the chunks and tokens it used."""
+
+    def __init__(self, text: str, chunk_ids: List[int], tokens_used: int, token_budget: int,
+                 duplicates_dropped: int = 0, truncated: bool = False):
+        self.text = text
+        self.chunk_ids = chunk_ids
+        self.tokens_used = tokens_used
+        self.token_budget = token_budget
+        self.duplicates_dropped = duplicates_dropped
+        self.truncated = truncated
+
+    def to_dict(self) -> Dict:
+        return {
+            "chunk_ids": self.chunk_ids,
+            "tokens_used": self.tokens_used,
+            "token_budget": self.token_budget,
+            "duplicates_dropped": self.duplicates_dropped,
+            "truncated": self.truncated,
+        }
+
+
+def _normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _jaccard(a: frozenset, b: frozenset) -> float:
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+def assemble_context(chunks, ranked_ids: Sequence[int], max_chunks: int = 5,
+                     token_budget: int = CONTEXT_TOKEN_BUDGET,
+                     vectors: Optional[Dict[int, np.ndarray]] = None,
+                     mmr_lambda: float = CONTEXT_MMR_LAMBDA) -> AssembledContext:
+    """
+    Select chunks from a relevance ranking by maximal marginal relevance, dropping
+    near-duplicates, until max_chunks are chosen or the token budget is used up.
+    Selected chunks are joined in ranking order. If the best chunk alone exceeds the
+    budget it is cut to fit.
+    :param chunks: List or ChunkStore of chunk texts
+    :param ranked_ids: Chunk IDs, most relevant first
+    :param vectors: Optional stored vectors by chunk ID, e.g. reconstructed by the FAISS search;
+        chunks without one are compared by their term sets
+    """
+    candidate_ids = []
+    for chunk_id in ranked_ids:
+        if chunk_id not in candidate_ids:
+            candidate_ids.append(int(chunk_id))
+    candidate_ids = candidate_ids[:max(max_chunks, CONTEXT_MMR_CANDIDATES)]
+    texts = dict(zip(candidate_ids, get_chunks(chunks, candidate_ids)))
+    candidate_ids = [chunk_id for chunk_id in candidate_ids if texts[chunk_id].strip()]
+    if not candidate_ids or token_budget <= 0:
+        return AssembledContext("", [], 0, token_budget)
+
+    # Relevance decreases linearly with rank, so MMR trades rank against redundancy
+    relevance = {chunk_id: 1.0 - rank / len(candidate_ids) for rank, chunk_id in enumerate(candidate_ids)}
+    vectors = vectors or {}
+    unit_vectors = {}
+    with_vectors = [chunk_id for chunk_id in candidate_ids if chunk_id in vectors]
+    if with_vectors:
+        normalized = _normalize_rows(np.vstack([vectors[chunk_id] for chunk_id in with_vectors]).astype('float32'))
+        unit_vectors = dict(zip(with_vectors, normalized))
+    term_sets = {}
+
+    def similarity(a: int, b: int):
+        """:return: (similarity, whether it reaches the duplicate threshold for its measure)"""
+        if a in unit_vectors and b in unit_vectors:
+            value = float(np.dot(unit_vectors[a], unit_vectors[b]))
+            return value, value >= CONTEXT_DUPLICATE_SIMILARITY
+        for chunk_id in (a, b):
+            if chunk_id not in term_sets:
+                term_sets[chunk_id] = frozenset(tokenize(texts[chunk_id]))
+        value = _jaccard(term_sets[a], term_sets[b])
+        return value, value >= CONTEXT_DUPLICATE_JACCARD
+
+    encoder = get_encoder()
+    separator_tokens = len(encoder.encode_ordinary(CHUNK_SEPARATOR))
+    selected: List[int] = []
+    pieces: Dict[int, str] = {}
+    tokens_used = 0
+    duplicates_dropped = 0
+    truncated = False
+    remaining = list(candidate_ids)
+    max_similarity = {chunk_id: 0.0 for chunk_id in candidate_ids}
+
+    while remaining and len(selected) < max_chunks:
+        best = max(remaining, key=lambda chunk_id: mmr_lambda * relevance[chunk_id]
+                   - (1 - mmr_lambda) * max_similarity[chunk_id])
+        remaining.remove(best)
+
+        available = token_budget - tokens_used - (separator_tokens if selected else 0)
+        tokens = encoder.encode_ordinary(texts[best])
+        piece = texts[best]
+        if len(tokens) > available:
+            if selected:
+                # A smaller, lower-ranked chunk may still fit
+                continue
+            tokens = tokens[:available]
+            piece = encoder.decode(tokens)
+            truncated = True
+        pieces[best] = piece
+        tokens_used += len(tokens) + (separator_tokens if selected else 0)
+        selected.append(best)
+
+        for chunk_id in list(remaining):
+            value, duplicate = similarity(best, chunk_id)
+            if duplicate:
+                remaining.remove(chunk_id)
+                duplicates_dropped += 1
+            else:
+                max_similarity[chunk_id] = max(max_similarity[chunk_id], value)
+
+    ordered = sorted(selected, key=candidate_ids.index)
+    text = CHUNK_SEPARATOR.join(pieces[chunk_id] for chunk_id in ordered)
+    logger.info(f"Assembled {len(ordered)} chunks in {tokens_used}/{token_budget} tokens "
+                f"({duplicates_dropped} near-duplicates dropped{', truncated' if truncated else ''})")
+    return AssembledContext(text, ordered, tokens_used, token_budget, duplicates_dropped, truncated)
@@ -0,0 +1,305 @@
+import os
+import sys
+import json
+import time
+import threading
+import logging
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional, Union
+
+import utils.s3_utils as s3_utils
+import utils.index_factory as index_factory
+from utils.quote_index import QuoteIndex
+from utils.bm25_index import BM25Index
+from utils.artifact_cache import (ARTIFACT_CACHE_ENABLED, get_local_artifact_path, read_artifact_bytes,
+                                  remove_local_artifacts)
+from utils.chunk_store import ChunkStore, load_chunk_store_from_s3
+from utils.numpy_vector_store import VECTOR_STORE_NAME, load_vector_store_from_s3
+from utils.chunk_provenance import ChunkProvenance, PROVENANCE_NAME
+from utils.index_manifest import INDEX_ARTIFACT_NAMES, manifest_artifact_prefix, read_index_manifest
+from utils.packed_index import get_shard_version, open_packed_course
+
+logger = logging.getLogger(__name__)
+
+# Byte budget shared by every course held in this process (default 512 MB)
+COURSE_CACHE_MAX_BYTES = int(os.getenv("COURSE_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+# Seconds between checks of a cached course's index manifest for a newer version
+INDEX_MANIFEST_CHECK_INTERVAL = float(os.getenv("INDEX_MANIFEST_CHECK_INTERVAL", "30"))
+
+
+class CourseState:
+    """Loaded retrieval state for a single course."""
+
+    def __init__(self, chunks: Union[List[str], ChunkStore], inverted_index: Dict[str, int], faiss_index: Any = None,
+                 index_nbytes: int = 0, bm25_index: Optional[BM25Index] = None,
+                 provenance: Optional[ChunkProvenance] = None):
+        self.chunks = chunks
+        self.inverted_index = inverted_index
+        self.faiss_index = faiss_index
+        # Fuzzy quote lookups, built alongside the inverted index
+        self.quote_index = QuoteIndex(inverted_index)
+        # Courses indexed before bm25_index.json existed get their BM25 index built here
+        self.bm25_index = bm25_index if bm25_index is not None else BM25Index.from_chunks(chunks)
+        # Source file, lines and section of each chunk, for searches scoped to part of the course
+        self.provenance = provenance
+        self.nbytes = self._estimate_nbytes(index_nbytes)
+        # Where the artifacts were loaded from, for states read from S3
+        self.prefix: Optional[str] = None
+        self.version: Optional[str] = None
+        # Shard holding the artifacts of a course stored in the packed index, and the shard
+        # version its chunks and vectors are read from
+        self.packed_shard: Optional[int] = None
+        self.packed_shard_version: Optional[str] = None
+        self.checked_at = time.time()
+
+    def _estimate_nbytes(self, index_nbytes: int) -> int:
+        """Approximate resident size of the state, used for cache accounting."""
+        if isinstance(self.chunks, ChunkStore):
+            # Chunk texts stay on disk or in S3 until a query reads them
+            size = self.chunks.nbytes
+        else:
+            size = sum(sys.getsizeof(chunk) for chunk in self.chunks)
+        size += sum(sys.getsizeof(quote) + 28 for quote in self.inverted_index)
+        size += self.provenance.nbytes if self.provenance is not None else 0
+        return size + self.quote_index.nbytes + self.bm25_index.nbytes + index_nbytes
+
+    def select_chunk_ids(self, source: Optional[str] = None, section=None):
+        """
+        IDs of the chunks from a source file and/or under a section heading path, see
+        ChunkProvenance.select. :return: Array of chunk IDs, or None without provenance
+        """
+        if self.provenance is None:
+            return None
+        return self.provenance.select(source, section)
+
+
+class CourseStateCache:
+    """Thread-safe LRU cache of CourseState objects bounded by a byte budget."""
+
+    def __init__(self, max_bytes: int = COURSE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Hashable, CourseState]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_locks: Dict[Hashable, threading.Lock] = {}
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable) -> Optional[CourseState]:
+        with self._lock:
+            state = self._entries.get(key)
+            if state is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return state
+
+    def put(self, key: Hashable, state: CourseState) -> None:
+        with self._lock:
+            self._remove(key)
+            if state.nbytes > self.max_bytes:
+                logger.warning(f"Course state for {key} ({state.nbytes} bytes) exceeds cache budget, not caching")
+                return
+            self._entries[key] = state
+            self.current_bytes += state.nbytes
+            while self.current_bytes > self.max_bytes:
+                evicted_key, _ = next(iter(self._entries.items()))
+                self._remove(evicted_key)
+                self.evictions += 1
+                logger.info(f"Evicted course state for {evicted_key}")
+
+    def get_or_load(self, key: Hashable, loader: Callable[[], Optional[CourseState]]) -> Optional[CourseState]:
+        """
+        Return the cached state for key, calling loader on a miss.
+        Concurrent misses for the same key share a single load.
+        """
+        state = self.get(key)
+        if state is not None:
+            return state
+
+        with self._lock:
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+
+        with load_lock:
+            # Another thread may have finished loading while we waited
+            with self._lock:
+                state = self._entries.get(key)
+                if state is not None:
+                    self._entries.move_to_end(key)
+                    return state
+            state = loader()
+            if state is not None:
+                self.put(key, state)
+
+        with self._lock:
+            self._load_locks.pop(key, None)
+        return state
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            self._remove(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _remove(self, key: Hashable) -> None:
+        # Caller must hold self._lock
+        state = self._entries.pop(key, None)
+        if state is not None:
+            self.current_bytes -= state.nbytes
+
+
+_course_cache = CourseStateCache()
+
+
+def get_course_cache() -> CourseStateCache:
+    """Return the process-wide course state cache."""
+    return _course_cache
+
+
+def _read_json_artifact(bucket_name: str, key: str, immutable: bool = False):
+    data = read_artifact_bytes(bucket_name, key, immutable)
+    return json.loads(data) if data is not None else None
+
+
+def _load_provenance(bucket_name: str, prefix: str, immutable: bool, num_chunks: int) -> ChunkProvenance:
+    """The course's provenance sidecar, or for courses indexed before it, one built from index_sources.json."""
+    data = read_artifact_bytes(bucket_name, f"{prefix}{PROVENANCE_NAME}", immutable)
+    if data is not None:
+        return ChunkProvenance.from_bytes(data)
+    sources_data = _read_json_artifact(bucket_name, f"{prefix}index_sources.json", immutable) or {}
+    return ChunkProvenance.from_sources(sources_data.get("sources", {}), num_chunks)
+
+
+def _load_packed_course_state(bucket_name: str, base_key: str, shard: int) -> Optional[CourseState]:
+    """State of a course stored in a packed index shard; segments are loaded once for all their courses."""
+    course = open_packed_course(bucket_name, shard, base_key)
+    if course is None:
+        logger.error(f"Packed index shard {shard} does not hold {base_key}")
+        return None
+    index_nbytes = course.vectors.nbytes if course.vectors is not None else 0
+    state = CourseState(course.chunks, course.inverted_index, course.vectors, index_nbytes, course.bm25_index,
+                        course.provenance)
+    state.version = course.version
+    state.packed_shard = shard
+    state.packed_shard_version = course.shard_version
+    return state
+
+
+def load_course_state_from_s3(bucket_name: str, username: str, course_id: str,
+                              mmap: bool = True) -> Optional[CourseState]:
+    """
+    Fetch and deserialize chunks.bin, inverted_index.json, bm25_index.json, faiss.index and the
+    chunk provenance sidecar for a course,
+    from the version named by its index manifest. Artifacts are read through the local
+    artifact cache, where the FAISS index is memory-mapped unless mmap is False (pass
+    False to modify the index). Chunk texts are read lazily; courses indexed before
+    chunks.bin existed load chunks.json. Without FAISS, or for courses built without it,
+    vectors are searched from vectors.npy instead. Courses stored in the packed index are
+    read from their shard.
+    :return: CourseState, or None if the chunks are missing
+    """
+    base_key = s3_utils.get_course_s3_folder(username, course_id)
+    manifest = read_index_manifest(bucket_name, base_key)
+    if manifest is not None and manifest.get("packed_shard") is not None:
+        return _load_packed_course_state(bucket_name, base_key, manifest["packed_shard"])
+    prefix, version = manifest_artifact_prefix(base_key, manifest)
+    # Versioned artifacts are never overwritten, so cached copies need no ETag check
+    immutable = version is not None
+
+    chunks = load_chunk_store_from_s3(bucket_name, f"{prefix}chunks.bin", immutable=immutable)
+    if chunks is None:
+        chunks = _read_json_artifact(bucket_name, f"{prefix}chunks.json")
+    if chunks is None:
+        return None
+    inverted_index = _read_json_artifact(bucket_name, f"{prefix}inverted_index.json", immutable) or {}
+    bm25_data = _read_json_artifact(bucket_name, f"{prefix}bm25_index.json", immutable)
+    bm25_index = BM25Index.from_json(bm25_data) if bm25_data is not None else None
+
+    faiss_index = None
+    index_nbytes = 0
+    if s3_utils.FAISS_AVAILABLE:
+        index_key = f"{prefix}faiss.index"
+        index_path = None
+        if ARTIFACT_CACHE_ENABLED:
+            index_path = get_local_artifact_path(bucket_name, index_key, immutable=immutable)
+        if index_path is not None:
+            faiss_index = index_factory.read_index_file(index_path, mmap=mmap)
+            index_nbytes = os.path.getsize(index_path)
+        else:
+            index_bytes = s3_utils.read_binary_from_s3(bucket_name, index_key)
+            if index_bytes:
+                import numpy as np
+                faiss_index = index_factory.configure_search(
+                    s3_utils.faiss.deserialize_index(np.frombuffer(index_bytes, dtype='uint8')))
+                index_nbytes = len(index_bytes)
+    if faiss_index is None:
+        faiss_index, index_nbytes = load_vector_store_from_s3(bucket_name, f"{prefix}{VECTOR_STORE_NAME}",
+                                                              immutable, mmap)
+
+    provenance = _load_provenance(bucket_name, prefix, immutable, len(chunks))
+
+    state = CourseState(chunks, inverted_index, faiss_index, index_nbytes, bm25_index, provenance)
+    state.prefix = prefix
+    state.version = version
+    return state
+
+
+def get_course_state(username: str, course_id: str,
+                     bucket_name: str = s3_utils.S3_BUCKET_NAME) -> Optional[CourseState]:
+    """
+    Return the retrieval state for a course, loading it from S3 on a cache miss.
+    Every INDEX_MANIFEST_CHECK_INTERVAL seconds a cached state is compared with the
+    course's manifest, and for packed courses with their shard's manifest too, since
+    writes of other courses replace the shard version the state reads from; a newer
+    version is loaded while the cached one keeps serving, then swapped in.
+    """
+    key = (username, course_id)
+    state = _course_cache.get(key)
+    if state is None:
+        return _course_cache.get_or_load(key, lambda: load_course_state_from_s3(bucket_name, username, course_id))
+
+    now = time.time()
+    if now - state.checked_at < INDEX_MANIFEST_CHECK_INTERVAL:
+        return state
+    # Claim this check so concurrent readers keep using the cached state meanwhile
+    state.checked_at = now
+    base_key = s3_utils.get_course_s3_folder(username, course_id)
+    manifest = read_index_manifest(bucket_name, base_key)
+    _, version = manifest_artifact_prefix(base_key, manifest)
+    shard = manifest.get("packed_shard") if manifest is not None else None
+    shard_version = get_shard_version(bucket_name, shard) if shard is not None else None
+    if version == state.version and shard_version == state.packed_shard_version:
+        return state
+    if version == state.version:
+        logger.info(f"Course {key} moved to version {shard_version} of packed index shard {shard}")
+    else:
+        logger.info(f"Course {key} moved from index version {state.version} to {version}")
+    new_state = load_course_state_from_s3(bucket_name, username, course_id)
+    if new_state is None:
+        return state
+    _course_cache.put(key, new_state)
+    if state.version is not None and state.prefix is not None and ARTIFACT_CACHE_ENABLED:
+        # Mapped files stay readable for requests still using the old state
+        remove_local_artifacts(bucket_name, [f"{state.prefix}{name}" for name in INDEX_ARTIFACT_NAMES])
+    return new_state
+
+
+def invalidate_course_state(username: str, course_id: str) -> None:
+    """Drop a course from the cache, e.g. after its indices were rebuilt."""
+    _course_cache.invalidate((username, course_id))
@@ -1,11 +1,13 @@
 import os
 import uuid
 import logging
+import threading
 from datetime import datetime, timezone
-from typing import Optional, Union, Dict, List, Any
+from typing import Optional, Dict, List, Any
 
 import utils.s3_utils as s3_utils
 import utils.load_and_process_index as faiss_utils
+import utils.packed_index as packed_index
 
 
 logger = logging.getLogger(__name__)
@@ -186,6 +188,7 @@ class CourseManager:
                 # Save updated course info
                 s3_utils.upload_json_to_s3(course_info, self.s3_bucket, course_info_key)
                 logger.info(f"Successfully added file '{filename}' metadata to {course_info_key}")
+                self._add_file_to_index(course_id, filename)
                 return True
             else:
                 logger.warning(f"File '{filename}' already exists in metadata for course {course_id}. Skipping add.")
@@ -232,6 +235,7 @@ class CourseManager:
                 # Save updated course info
                 s3_utils.upload_json_to_s3(course_info, self.s3_bucket, course_info_key)
                 logger.info(f"Successfully updated {course_info_key} after removing file.")
+                self._remove_file_from_index(course_id, filename)
                 return True
             else:
                 logger.warning(f"File '{filename}' not found in metadata for course {course_id}. No update needed.")
@@ -242,6 +246,36 @@ class CourseManager:
             return False
 
 
+    def _add_file_to_index(self, course_id: str, filename: str) -> None:
+        """Appends the chunks of an uploaded file to the course's index, off the request thread."""
+        # Incremental updates wait for the course's write lock, which a full build may hold for minutes
+        threading.Thread(target=self._index_uploaded_file, args=(course_id, filename),
+                         name=f"index-add-{course_id}", daemon=True).start()
+
+    def _remove_file_from_index(self, course_id: str, filename: str) -> None:
+        """Removes the chunks of a deleted file from the course's index, off the request thread."""
+        threading.Thread(target=self._unindex_deleted_file, args=(course_id, filename),
+                         name=f"index-remove-{course_id}", daemon=True).start()
+
+    def _index_uploaded_file(self, course_id: str, filename: str) -> None:
+        api_key = self.api_key or os.getenv("OPENAI_API_KEY")
+        s3_key = s3_utils.get_s3_course_materials_path(self.user_email, course_id, filename)
+        try:
+            if faiss_utils.add_file_to_course_index(self.s3_bucket, self.user_email, course_id, s3_key, api_key):
+                logger.info(f"Incrementally indexed '{filename}' for course {course_id}")
+        except Exception as e:
+            # The metadata update already succeeded; a full reprocess will pick the file up
+            logger.error(f"Error indexing file '{filename}' for course {course_id}: {e}")
+
+    def _unindex_deleted_file(self, course_id: str, filename: str) -> None:
+        s3_key = s3_utils.get_s3_course_materials_path(self.user_email, course_id, filename)
+        try:
+            if faiss_utils.remove_file_from_course_index(self.s3_bucket, self.user_email, course_id, s3_key,
+                                                         self.api_key or os.getenv("OPENAI_API_KEY")):
+                logger.info(f"Removed '{filename}' from the index of course {course_id}")
+        except Exception as e:
+            logger.error(f"Error removing file '{filename}' from index of course {course_id}: {e}")
+
     def get_course_info(self, course_id: str) -> Optional[Dict]:
         """Fetches the course_info.json for a given course_id."""
         course_folder = self._get_course_folder(course_id)
@@ -535,6 +569,9 @@ class CourseManager:
         logger.info(f"Deleting course {course_id} for user {self.user_email}")
         try:
             course_folder = self._get_course_folder(course_id)
+            # Packed courses also keep their index in a shared shard outside the course folder
+            if not packed_index.remove_deleted_course(self.s3_bucket, course_folder):
+                logger.warning(f"Could not remove course {course_id} from its packed index shard")
             # 1. Delete the folder from S3
             s3_utils.delete_folder_from_s3(self.s3_bucket, course_folder)
             
@@ -0,0 +1,123 @@
+import os
+import hashlib
+import logging
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import numpy as np
+
+import utils.s3_utils as s3_utils
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() == "true"
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR", os.path.join(tempfile.gettempdir(), "embedding_cache"))
+# The S3 tier stores one object per vector, so a build of n uncached chunks makes n PUTs and a
+# worker with a cold local tier n GETs. Off by default: enable it only where workers share no
+# disk and the embedding calls it saves cost more than those requests.
+EMBEDDING_CACHE_S3 = os.getenv("EMBEDDING_CACHE_S3", "false").lower() == "true"
+EMBEDDING_CACHE_S3_PREFIX = "embedding_cache/"
+EMBEDDING_CACHE_S3_WORKERS = int(os.getenv("EMBEDDING_CACHE_S3_WORKERS", "16"))
+
+
+def text_digest(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Content-addressed cache of embedding vectors keyed by
+    (model, dimension, sha256(text)). Vectors are stored as raw little-endian
+    float32 blobs in a local directory, optionally backed by a shared S3 tier
+    (EMBEDDING_CACHE_S3) of one object per vector.
+    """
+
+    def __init__(self, model: str, dimension: int, bucket_name: str = s3_utils.S3_BUCKET_NAME,
+                 local_dir: str = EMBEDDING_CACHE_DIR, use_s3: bool = EMBEDDING_CACHE_S3,
+                 max_workers: int = EMBEDDING_CACHE_S3_WORKERS):
+        self.model = model
+        self.dimension = dimension
+        self.bucket_name = bucket_name
+        self.local_dir = os.path.join(local_dir, model, str(dimension))
+        self.use_s3 = use_s3
+        self.max_workers = max_workers
+
+    def _relative_path(self, digest: str) -> str:
+        return f"{digest[:2]}/{digest}.f32"
+
+    def _local_path(self, digest: str) -> str:
+        return os.path.join(self.local_dir, digest[:2], f"{digest}.f32")
+
+    def _s3_key(self, digest: str) -> str:
+        return f"{EMBEDDING_CACHE_S3_PREFIX}{self.model}/{self.dimension}/{self._relative_path(digest)}"
+
+    def _decode(self, blob: Optional[bytes]) -> Optional[np.ndarray]:
+        if blob is None or len(blob) != self.dimension * 4:
+            return None
+        return np.frombuffer(blob, dtype='<f4')
+
+    def _read_local(self, digest: str) -> Optional[np.ndarray]:
+        try:
+            with open(self._local_path(digest), 'rb') as f:
+                return self._decode(f.read())
+        except FileNotFoundError:
+            return None
+
+    def _write_local(self, digest: str, blob: bytes) -> None:
+        path = self._local_path(digest)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write then rename so concurrent readers never see a partial vector
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(blob)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Could not write embedding cache entry {path}: {e}")
+
+    def _read_s3(self, digest: str) -> Optional[np.ndarray]:
+        vector = self._decode(s3_utils.read_binary_from_s3_if_exists(self.bucket_name, self._s3_key(digest)))
+        if vector is not None:
+            self._write_local(digest, vector.tobytes())
+        return vector
+
+    def get_many(self, texts: List[str]) -> Dict[int, np.ndarray]:
+        """
+        Look up vectors for texts.
+        :return: Mapping of input position to cached vector; missing positions are absent
+        """
+        digests = [text_digest(text) for text in texts]
+        found: Dict[str, np.ndarray] = {}
+        remote = []
+        for digest in set(digests):
+            vector = self._read_local(digest)
+            if vector is not None:
+                found[digest] = vector
+            else:
+                remote.append(digest)
+
+        if remote and self.use_s3:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                for digest, vector in zip(remote, executor.map(self._read_s3, remote)):
+                    if vector is not None:
+                        found[digest] = vector
+
+        return {i: found[digest] for i, digest in enumerate(digests) if digest in found}
+
+    def put_many(self, texts: List[str], vectors: np.ndarray) -> None:
+        """Store one vector per text in the local tier, and in the S3 tier if it is enabled."""
+        entries = {}
+        for text, vector in zip(texts, vectors):
+            entries[text_digest(text)] = np.asarray(vector, dtype='<f4').tobytes()
+
+        for digest, blob in entries.items():
+            self._write_local(digest, blob)
+
+        if self.use_s3:
+            def upload(item):
+                digest, blob = item
+                s3_utils.upload_bytes_to_s3(blob, self.bucket_name, self._s3_key(digest))
+
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                list(executor.map(upload, entries.items()))
@@ -0,0 +1,137 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from utils.chunker import get_encoder
+
+EMBEDDING_MODEL = "text-embedding-3-large"
+EMBEDDING_DIMENSION = 3072  # text-embedding-3-large dimension
+# Opt-in shortened output from the embeddings API (text-embedding-3 "dimensions" parameter)
+EMBEDDING_REQUEST_DIMENSION = int(os.getenv("EMBEDDING_REQUEST_DIMENSION", str(EMBEDDING_DIMENSION)))
+
+# Request packing and concurrency limits shared by every index builder
+EMBEDDING_BATCH_MAX_INPUTS = int(os.getenv("EMBEDDING_BATCH_MAX_INPUTS", "100"))
+EMBEDDING_BATCH_MAX_TOKENS = int(os.getenv("EMBEDDING_BATCH_MAX_TOKENS", "250000"))
+EMBEDDING_MAX_CONCURRENCY = int(os.getenv("EMBEDDING_MAX_CONCURRENCY", "4"))
+
+
+def _dimension_kwargs(dimension: int) -> Dict[str, int]:
+    # Only ask for shortened embeddings when they differ from the model's native size
+    return {} if dimension == EMBEDDING_DIMENSION else {"dimensions": dimension}
+
+
+def embed_query(client, text: str, dimension: int = EMBEDDING_REQUEST_DIMENSION,
+                model: str = EMBEDDING_MODEL) -> np.ndarray:
+    """
+    Embed a single query as a (1, dimension) float32 array.
+    Pass the index's input dimension so queries match how its chunks were embedded.
+    """
+    response = client.embeddings.create(model=model, input=text, **_dimension_kwargs(dimension))
+    return np.array(response.data[0].embedding, dtype='float32').reshape(1, -1)
+
+
+async def aembed_query(async_client, text: str, dimension: int = EMBEDDING_REQUEST_DIMENSION,
+                       model: str = EMBEDDING_MODEL) -> np.ndarray:
+    """Async variant of embed_query for an openai.AsyncOpenAI client."""
+    response = await async_client.embeddings.create(model=model, input=text, **_dimension_kwargs(dimension))
+    return np.array(response.data[0].embedding, dtype='float32').reshape(1, -1)
+
+
+class EmbeddingEngine:
+    """
+    Embeds texts in token-bounded batches, running a bounded pool of requests
+    concurrently. Output rows are in the same order as the input texts.
+    """
+
+    def __init__(self, client, model: str = EMBEDDING_MODEL, dimension: int = EMBEDDING_REQUEST_DIMENSION,
+                 max_batch_inputs: int = EMBEDDING_BATCH_MAX_INPUTS,
+                 max_batch_tokens: int = EMBEDDING_BATCH_MAX_TOKENS,
+                 max_workers: int = EMBEDDING_MAX_CONCURRENCY, cache=None):
+        self.client = client
+        self.model = model
+        self.dimension = dimension
+        self.max_batch_inputs = max_batch_inputs
+        self.max_batch_tokens = max_batch_tokens
+        self.max_workers = max_workers
+        self.cache = cache  # Optional EmbeddingCache
+        self.stats: Dict[str, float] = {}
+
+    def make_batches(self, texts: List[str]) -> Tuple[List[Tuple[int, int]], int]:
+        """
+        Pack consecutive texts into [start, end) ranges that respect both the
+        input-count and token limits of a single embeddings request.
+        (gpt-4 and text-embedding-3 models share the cl100k_base tokenizer.)
+        :return: (list of ranges, total token count)
+        """
+        token_counts = [len(tokens) for tokens in get_encoder().encode_ordinary_batch(texts)]
+
+        batches = []
+        start = 0
+        batch_tokens = 0
+        for i, count in enumerate(token_counts):
+            if i > start and (i - start >= self.max_batch_inputs or batch_tokens + count > self.max_batch_tokens):
+                batches.append((start, i))
+                start = i
+                batch_tokens = 0
+            batch_tokens += count
+        if start < len(texts):
+            batches.append((start, len(texts)))
+        return batches, sum(token_counts)
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        response = self.client.embeddings.create(model=self.model, input=texts,
+                                                 **_dimension_kwargs(self.dimension))
+        return [e.embedding for e in response.data]
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """
+        Embed texts and return a float32 array of shape (len(texts), dimension).
+        Texts found in the embedding cache are not sent to the API.
+        Rows of a failed request are left as zero vectors.
+        """
+        start_time = time.time()
+        embeddings = np.zeros((len(texts), self.dimension), dtype='float32')
+        if not texts:
+            return embeddings
+
+        cached = self.cache.get_many(texts) if self.cache is not None else {}
+        for i, vector in cached.items():
+            embeddings[i] = vector
+        missing = [i for i in range(len(texts)) if i not in cached]
+        missing_texts = [texts[i] for i in missing]
+
+        batches, total_tokens = self.make_batches(missing_texts)
+        failed = 0
+        embedded = []
+
+        with ThreadPoolExecutor(max_workers=max(1, self.max_workers)) as executor:
+            futures = [executor.submit(self._embed_batch, missing_texts[start:end]) for start, end in batches]
+            for future, (start, end) in zip(futures, batches):
+                try:
+                    vectors = future.result()
+                    embeddings[missing[start:end]] = np.asarray(vectors, dtype='float32')
+                    embedded.extend(missing[start:end])
+                except Exception as e:
+                    failed += 1
+                    print(f"Error generating embeddings for {end - start} chunks: {str(e)}")
+
+        if self.cache is not None and embedded:
+            self.cache.put_many([texts[i] for i in embedded], embeddings[embedded])
+
+        elapsed = time.time() - start_time
+        self.stats = {
+            "inputs": len(texts),
+            "cache_hits": len(cached),
+            "requests": len(batches),
+            "failed_requests": failed,
+            "tokens": total_tokens,
+            "seconds": elapsed,
+            "inputs_per_second": len(texts) / elapsed if elapsed > 0 else 0.0,
+            "tokens_per_second": total_tokens / elapsed if elapsed > 0 else 0.0,
+        }
+        print(f"Embedded {len(texts)} chunks ({len(cached)} cached, {total_tokens} tokens in "
+              f"{len(batches)} requests), {elapsed:.2f} seconds ({self.stats['tokens_per_second']:.0f} tokens/s)")
+        return embeddings
@@ -0,0 +1,417 @@
+import os
+import math
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+from utils.numpy_vector_store import NumpyVectorStore, NUMPY_VECTOR_ENCODING, is_vector_store_file
+
+# Try to import faiss, make it optional
+try:
+    import faiss
+    FAISS_AVAILABLE = True
+except ImportError:
+    FAISS_AVAILABLE = False
+    faiss = None
+
+INDEX_TYPE_FLAT = "flat"
+INDEX_TYPE_IVF_FLAT = "ivf_flat"
+INDEX_TYPE_IVF_PQ = "ivf_pq"
+INDEX_TYPE_HNSW = "hnsw"
+INDEX_TYPES = (INDEX_TYPE_FLAT, INDEX_TYPE_IVF_FLAT, INDEX_TYPE_IVF_PQ, INDEX_TYPE_HNSW)
+# Exact search in NumPy, used for every index when FAISS is not installed
+INDEX_TYPE_NUMPY = "numpy"
+
+# "auto" picks the index type from the number of chunks in the course
+FAISS_INDEX_TYPE = os.getenv("FAISS_INDEX_TYPE", "auto")
+FAISS_IVF_MIN_CHUNKS = int(os.getenv("FAISS_IVF_MIN_CHUNKS", "2000"))
+FAISS_IVF_PQ_MIN_CHUNKS = int(os.getenv("FAISS_IVF_PQ_MIN_CHUNKS", "20000"))
+FAISS_PQ_SUBQUANTIZERS = int(os.getenv("FAISS_PQ_SUBQUANTIZERS", "64"))
+FAISS_PQ_BITS = 8
+# Training each PQ codebook needs at least one vector per centroid
+FAISS_PQ_MIN_TRAINING_VECTORS = 2 ** FAISS_PQ_BITS
+FAISS_HNSW_M = int(os.getenv("FAISS_HNSW_M", "32"))
+
+# Search-time knobs, applied whenever an index is built or loaded
+FAISS_NPROBE = int(os.getenv("FAISS_NPROBE", "16"))
+FAISS_EF_SEARCH = int(os.getenv("FAISS_EF_SEARCH", "64"))
+
+# Opt-in compact storage: float16 or 8-bit scalar-quantized vectors, optionally
+# projected to FAISS_PCA_DIMENSION components with a PCA fitted on the course
+ENCODING_FP32 = "fp32"
+ENCODING_FP16 = "fp16"
+ENCODING_SQ8 = "sq8"
+ENCODING_PQ = "pq"  # implied by INDEX_TYPE_IVF_PQ
+FAISS_VECTOR_ENCODING = os.getenv("FAISS_VECTOR_ENCODING", ENCODING_FP32)
+FAISS_PCA_DIMENSION = int(os.getenv("FAISS_PCA_DIMENSION", "0"))
+# Also publish FAISS-built courses as a NumPy vector store, so processes without FAISS can search them
+NUMPY_VECTOR_EXPORT = os.getenv("NUMPY_VECTOR_EXPORT", "true").lower() == "true"
+# Filtered searches over at most this many chunks of an approximate index score each selected
+# vector, since IVF probing and HNSW graph walks miss most hits of a small selection
+FAISS_FILTER_EXACT_MAX_IDS = int(os.getenv("FAISS_FILTER_EXACT_MAX_IDS", "4096"))
+
+
+def choose_index_type(num_vectors: int) -> str:
+    """
+    Keep exact search for small courses and switch to approximate indices above the thresholds.
+    A forced FAISS_INDEX_TYPE of ivf_pq still falls back to flat for courses too small to train it.
+    """
+    if FAISS_INDEX_TYPE in INDEX_TYPES:
+        index_type = FAISS_INDEX_TYPE
+    elif num_vectors >= FAISS_IVF_PQ_MIN_CHUNKS:
+        index_type = INDEX_TYPE_IVF_PQ
+    elif num_vectors >= FAISS_IVF_MIN_CHUNKS:
+        index_type = INDEX_TYPE_IVF_FLAT
+    else:
+        index_type = INDEX_TYPE_FLAT
+    if index_type == INDEX_TYPE_IVF_PQ and num_vectors < FAISS_PQ_MIN_TRAINING_VECTORS:
+        return INDEX_TYPE_FLAT
+    return index_type
+
+
+def _num_lists(num_vectors: int) -> int:
+    # ~4*sqrt(n) lists, while keeping at least 39 training points per centroid
+    return max(1, min(int(4 * math.sqrt(num_vectors)), num_vectors // 39))
+
+
+def _num_subquantizers(dimension: int) -> int:
+    m = min(FAISS_PQ_SUBQUANTIZERS, dimension)
+    while dimension % m:
+        m -= 1
+    return m
+
+
+def _scalar_quantizer_type(encoding: str):
+    if encoding == ENCODING_FP16:
+        return faiss.ScalarQuantizer.QT_fp16
+    if encoding == ENCODING_SQ8:
+        return faiss.ScalarQuantizer.QT_8bit
+    if encoding == ENCODING_FP32:
+        return None
+    raise ValueError(f"Unknown vector encoding: {encoding}")
+
+
+def _stored_dimension(dimension: int, num_vectors: int, pca_dimension: int) -> int:
+    # A PCA fitted on fewer vectors than output components is rank deficient,
+    # so small courses keep their full vectors
+    if 0 < pca_dimension < dimension and num_vectors >= pca_dimension:
+        return pca_dimension
+    return dimension
+
+
+def _new_core_index(index_type: str, dimension: int, encoding: str, training_vectors: Optional[np.ndarray]):
+    qtype = _scalar_quantizer_type(encoding)
+    if index_type == INDEX_TYPE_FLAT:
+        index = faiss.IndexScalarQuantizer(dimension, qtype, faiss.METRIC_L2) if qtype is not None \
+            else faiss.IndexFlatL2(dimension)
+    elif index_type == INDEX_TYPE_HNSW:
+        index = faiss.IndexHNSWSQ(dimension, qtype, FAISS_HNSW_M) if qtype is not None \
+            else faiss.IndexHNSWFlat(dimension, FAISS_HNSW_M)
+    else:
+        nlist = _num_lists(len(training_vectors))
+        quantizer = faiss.IndexFlatL2(dimension)
+        if index_type == INDEX_TYPE_IVF_FLAT:
+            index = faiss.IndexIVFScalarQuantizer(quantizer, dimension, nlist, qtype, faiss.METRIC_L2) \
+                if qtype is not None else faiss.IndexIVFFlat(quantizer, dimension, nlist, faiss.METRIC_L2)
+        elif index_type == INDEX_TYPE_IVF_PQ:
+            # PQ codes are already compressed, the encoding setting does not apply
+            index = faiss.IndexIVFPQ(quantizer, dimension, nlist, _num_subquantizers(dimension),
+                                     FAISS_PQ_BITS)
+        else:
+            raise ValueError(f"Unknown FAISS index type: {index_type}")
+    if not index.is_trained:
+        index.train(training_vectors)
+    return index
+
+
+def new_index(index_type: str, dimension: int, training_vectors: Optional[np.ndarray] = None,
+              encoding: Optional[str] = None, pca_dimension: Optional[int] = None):
+    """
+    Create an empty index of the given type that accepts explicit IDs.
+    IVF, SQ8 and PCA layouts are trained on training_vectors, normally the course's own embeddings.
+    encoding and pca_dimension default to FAISS_VECTOR_ENCODING and FAISS_PCA_DIMENSION.
+    Without FAISS this is a NumpyVectorStore in the fp32 or fp16 encoding (NUMPY_VECTOR_ENCODING
+    by default); the index type and PCA do not apply.
+    """
+    if not FAISS_AVAILABLE:
+        return NumpyVectorStore(dimension, encoding if encoding in (ENCODING_FP32, ENCODING_FP16)
+                                else NUMPY_VECTOR_ENCODING)
+    encoding = encoding or FAISS_VECTOR_ENCODING
+    pca_dimension = FAISS_PCA_DIMENSION if pca_dimension is None else pca_dimension
+    num_vectors = 0 if training_vectors is None else len(training_vectors)
+
+    pca = None
+    stored_dimension = _stored_dimension(dimension, num_vectors, pca_dimension)
+    if stored_dimension < dimension:
+        pca = faiss.PCAMatrix(dimension, stored_dimension)
+        pca.train(training_vectors)
+        # The full eigenvector matrix is only needed for training; apply() uses the
+        # truncated projection, and keeping it would cost dimension^2 floats per index
+        pca.PCAMat.clear()
+        training_vectors = pca.apply(training_vectors)
+
+    index = _new_core_index(index_type, stored_dimension, encoding, training_vectors)
+    if pca is not None:
+        # Queries keep the full dimension and are projected inside the index
+        index = faiss.IndexPreTransform(pca, index)
+    if index_type in (INDEX_TYPE_FLAT, INDEX_TYPE_HNSW):
+        index = faiss.IndexIDMap2(index)
+    return index
+
+
+def build_index(vectors: np.ndarray, ids: Optional[np.ndarray] = None, index_type: Optional[str] = None):
+    """Build a search index over vectors, choosing its type from the vector count unless given."""
+    vectors = np.ascontiguousarray(vectors, dtype='float32')
+    if ids is None:
+        ids = np.arange(len(vectors), dtype='int64')
+    index_type = index_type or choose_index_type(len(vectors))
+    index = new_index(index_type, vectors.shape[1], vectors)
+    index.add_with_ids(vectors, ids)
+    configure_search(index)
+    return index
+
+
+def _core_index(index):
+    """Strip the ID map and PCA wrappers added by new_index."""
+    if isinstance(index, faiss.IndexIDMap):
+        index = faiss.downcast_index(index.index)
+    if isinstance(index, faiss.IndexPreTransform):
+        index = faiss.downcast_index(index.index)
+    return index
+
+
+def index_type_of(index) -> str:
+    """Inverse of new_index, used for reporting and metadata."""
+    if isinstance(index, NumpyVectorStore):
+        return INDEX_TYPE_NUMPY
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        return INDEX_TYPE_IVF_PQ if isinstance(faiss.downcast_index(ivf), faiss.IndexIVFPQ) else INDEX_TYPE_IVF_FLAT
+    if isinstance(_core_index(index), faiss.IndexHNSW):
+        return INDEX_TYPE_HNSW
+    return INDEX_TYPE_FLAT
+
+
+def _encoding_of(index) -> str:
+    core = _core_index(index)
+    if isinstance(core, faiss.IndexHNSW):
+        core = faiss.downcast_index(core.storage)
+    if isinstance(core, faiss.IndexIVFPQ):
+        return ENCODING_PQ
+    if isinstance(core, (faiss.IndexScalarQuantizer, faiss.IndexIVFScalarQuantizer)):
+        return ENCODING_FP16 if core.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else ENCODING_SQ8
+    return ENCODING_FP32
+
+
+def describe_index(index) -> Dict[str, Any]:
+    """Index layout recorded next to the artifacts, e.g. in index_sources.json."""
+    if isinstance(index, NumpyVectorStore):
+        return {"index_type": INDEX_TYPE_NUMPY, "encoding": index.encoding, "dimension": index.d,
+                "stored_dimension": index.d}
+    return {
+        "index_type": index_type_of(index),
+        "encoding": _encoding_of(index),
+        "dimension": index.d,
+        "stored_dimension": _core_index(index).d,
+    }
+
+
+def configure_search(index, nprobe: int = FAISS_NPROBE, ef_search: int = FAISS_EF_SEARCH):
+    """Apply the nprobe / efSearch knobs to IVF and HNSW indices; no-op for flat ones."""
+    if isinstance(index, NumpyVectorStore):
+        return index
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = min(nprobe, ivf.nlist)
+        return index
+    core = _core_index(index)
+    if isinstance(core, faiss.IndexHNSW):
+        core.hnsw.efSearch = ef_search
+    return index
+
+
+def read_index_file(path: str, mmap: bool = False):
+    """
+    Read an index from a local file and apply the search knobs. With mmap=True flat
+    vector storage and IVF inverted lists are memory-mapped instead of copied into
+    the heap, so workers share pages through the OS page cache; such indices are
+    read-only. Files written from a NumpyVectorStore are loaded as one.
+    """
+    if is_vector_store_file(path):
+        return NumpyVectorStore.open(path, mmap=mmap)
+    if not mmap:
+        return configure_search(faiss.read_index(path))
+    # Flat codes are mapped with IO_FLAG_MMAP_IFC (newer faiss releases); IVF inverted lists only
+    # support the older IO_FLAG_MMAP, which cannot be combined with it
+    flat_codes_flag = getattr(faiss, "IO_FLAG_MMAP_IFC", None)
+    if flat_codes_flag is not None:
+        try:
+            return configure_search(faiss.read_index(path, flat_codes_flag))
+        except RuntimeError:
+            pass
+    return configure_search(faiss.read_index(path, faiss.IO_FLAG_MMAP))
+
+
+def write_index_file(index, path: str) -> None:
+    """Write an index atomically, so processes that have the old file mapped keep a valid copy."""
+    if isinstance(index, NumpyVectorStore):
+        index.save(path)
+        return
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    faiss.write_index(index, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def get_ids(index) -> np.ndarray:
+    """IDs stored in an index built by this module (or positions for a plain index)."""
+    if isinstance(index, NumpyVectorStore):
+        return index.ids
+    if isinstance(index, faiss.IndexIDMap):
+        return faiss.vector_to_array(index.id_map)
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        invlists = ivf.invlists
+        ids = [faiss.rev_swig_ptr(invlists.get_ids(i), invlists.list_size(i)).copy()
+               for i in range(ivf.nlist) if invlists.list_size(i)]
+        return np.concatenate(ids) if ids else np.zeros(0, dtype='int64')
+    return np.arange(index.ntotal, dtype='int64')
+
+
+def reconstruct_vectors(index, ids: np.ndarray) -> np.ndarray:
+    """Fetch stored vectors by ID; compressed or projected indices return their lossy reconstruction."""
+    if not len(ids):
+        return np.zeros((0, index.d), dtype='float32')
+    if isinstance(index, NumpyVectorStore):
+        return np.vstack([index.reconstruct(int(i)) for i in ids])
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is None:
+        return np.vstack([index.reconstruct(int(i)) for i in ids])
+    # IVF lookups by ID need a direct map; drop it afterwards so range removals keep working
+    ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
+    try:
+        # Reconstruct through the outer index so PCA projections are reversed
+        return np.vstack([index.reconstruct(int(i)) for i in ids])
+    finally:
+        ivf.set_direct_map_type(faiss.DirectMap.NoMap)
+
+
+def ensure_explicit_ids(index):
+    """Convert a plain flat index (built before IDs were tracked) into an ID-mapped one."""
+    if isinstance(index, NumpyVectorStore):
+        return index
+    if isinstance(index, faiss.IndexIDMap) or faiss.try_extract_index_ivf(index) is not None:
+        return index
+    id_mapped = new_index(INDEX_TYPE_FLAT, index.d, encoding=ENCODING_FP32, pca_dimension=0)
+    id_mapped.add_with_ids(index.reconstruct_n(0, index.ntotal), np.arange(index.ntotal, dtype='int64'))
+    return id_mapped
+
+
+def _configured_layout(index_type: str, dimension: int, num_vectors: int) -> Dict[str, Any]:
+    return {
+        "index_type": index_type,
+        "encoding": ENCODING_PQ if index_type == INDEX_TYPE_IVF_PQ else FAISS_VECTOR_ENCODING,
+        "dimension": dimension,
+        "stored_dimension": _stored_dimension(dimension, num_vectors, FAISS_PCA_DIMENSION),
+    }
+
+
+def rebuild_index(index, index_type: Optional[str] = None):
+    """
+    Rebuild an index as index_type (chosen from its size by default) with the configured
+    encoding and PCA, training on its own vectors. Returns the index unchanged if it
+    already has that layout. A NumpyVectorStore is only converted to NUMPY_VECTOR_ENCODING.
+    """
+    if isinstance(index, NumpyVectorStore):
+        return index if index.encoding == NUMPY_VECTOR_ENCODING else index.astype(NUMPY_VECTOR_ENCODING)
+    index_type = index_type or choose_index_type(index.ntotal)
+    if describe_index(index) == _configured_layout(index_type, index.d, index.ntotal):
+        return index
+    ids = get_ids(index)
+    return build_index(reconstruct_vectors(index, ids), ids, index_type)
+
+
+def remove_id_range(index, start: int, end: int):
+    """
+    Remove IDs in [start, end) and return the resulting index. HNSW graphs do not
+    support deletion, so they are rebuilt from the remaining vectors instead.
+    """
+    if isinstance(index, NumpyVectorStore):
+        index.remove_id_range(start, end)
+        return index
+    if index_type_of(index) != INDEX_TYPE_HNSW:
+        index.remove_ids(faiss.IDSelectorRange(start, end))
+        return index
+    ids = get_ids(index)
+    keep = ids[(ids < start) | (ids >= end)]
+    return build_index(reconstruct_vectors(index, keep), keep, INDEX_TYPE_HNSW)
+
+
+def to_numpy_store(index, encoding: str = NUMPY_VECTOR_ENCODING) -> NumpyVectorStore:
+    """Copy the vectors and IDs of an index into a NumpyVectorStore, e.g. to export it with the FAISS index."""
+    if isinstance(index, NumpyVectorStore):
+        return index if index.encoding == encoding else index.astype(encoding)
+    store = NumpyVectorStore(index.d, encoding)
+    ids = get_ids(index)
+    store.add_with_ids(reconstruct_vectors(index, ids), ids)
+    return store
+
+
+def _id_selector(ids: np.ndarray):
+    """A range selector for contiguous IDs, such as a source file's chunks, else a batch selector."""
+    if len(ids) and ids[-1] - ids[0] + 1 == len(ids):
+        return faiss.IDSelectorRange(int(ids[0]), int(ids[-1]) + 1)
+    return faiss.IDSelectorBatch(ids)
+
+
+def _search_parameters(index, selector):
+    """Search parameters restricted to selector that keep the index's nprobe / efSearch."""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        return faiss.SearchParametersIVF(sel=selector, nprobe=ivf.nprobe)
+    core = _core_index(index)
+    if isinstance(core, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=core.hnsw.efSearch)
+    return faiss.SearchParameters(sel=selector)
+
+
+def _exact_search_among(index, x: np.ndarray, k: int, ids: np.ndarray):
+    """Exact search over the reconstructed vectors of ids, padded like a FAISS search."""
+    x = np.asarray(x, dtype='float32').reshape(-1, index.d)
+    vectors = reconstruct_vectors(index, ids)
+    distances = (np.einsum('ij,ij->i', x, x)[:, None] - 2.0 * x @ vectors.T
+                 + np.einsum('ij,ij->i', vectors, vectors)[None, :])
+    top = np.argsort(distances, axis=1, kind='stable')[:, :k]
+    found = min(k, len(ids))
+    result_distances = np.full((len(x), k), np.finfo('float32').max, dtype='float32')
+    result_ids = np.full((len(x), k), -1, dtype='int64')
+    result_vectors = np.zeros((len(x), k, index.d), dtype='float32')
+    result_distances[:, :found] = np.maximum(np.take_along_axis(distances, top, axis=1), 0.0)
+    result_ids[:, :found] = ids[top]
+    result_vectors[:, :found] = vectors[top]
+    return result_distances, result_ids, result_vectors
+
+
+def search_and_reconstruct(index, x: np.ndarray, k: int, ids: Optional[np.ndarray] = None):
+    """
+    Search an index and return the stored vectors of the hits, optionally only among
+    the given chunk IDs: the NumPy store reads just those rows, FAISS skips the others
+    through an ID selector, and small selections of approximate indices are searched exactly.
+    :return: (distances, IDs, vectors of shape (queries, k, d)); vectors are None for
+        filtered IVF searches, which FAISS cannot reconstruct
+    """
+    if ids is None:
+        return index.search_and_reconstruct(x, k)
+    ids = np.unique(np.asarray(ids, dtype='int64'))
+    if isinstance(index, NumpyVectorStore):
+        return index.search_and_reconstruct(x, k, ids)
+    if index_type_of(index) != INDEX_TYPE_FLAT and len(ids) <= FAISS_FILTER_EXACT_MAX_IDS:
+        try:
+            return _exact_search_among(index, x, k, ids)
+        except RuntimeError:
+            # Some IDs are no longer in the index
+            return _exact_search_among(index, x, k, ids[np.isin(ids, get_ids(index))])
+    params = _search_parameters(index, _id_selector(ids))
+    if faiss.try_extract_index_ivf(index) is not None:
+        distances, found = index.search(x, k, params=params)
+        return distances, found, None
+    return index.search_and_reconstruct(x, k, params=params)
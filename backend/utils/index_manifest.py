@@ -0,0 +1,87 @@
+import os
+import json
+import uuid
+import logging
+from datetime import datetime, timezone
+from typing import Dict, Optional, Tuple
+
+import utils.s3_utils as s3_utils
+
+logger = logging.getLogger(__name__)
+
+# Small pointer object naming the current artifact version of a course, written after
+# every artifact of that version has been uploaded
+INDEX_MANIFEST_NAME = "index_manifest.json"
+INDEX_VERSIONS_FOLDER = "index_versions/"
+INDEX_ARTIFACT_NAMES = ("chunks.bin", "faiss.index", "vectors.npy", "inverted_index.json", "bm25_index.json",
+                        "index_sources.json", "chunk_provenance.npz")
+# Versions kept per course: the current one, plus older ones that readers may still be loading
+INDEX_VERSIONS_RETAINED = int(os.getenv("INDEX_VERSIONS_RETAINED", "2"))
+
+
+def new_index_version() -> str:
+    """Version names sort by creation time."""
+    return f"{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%f')}-{uuid.uuid4().hex[:8]}"
+
+
+def get_version_prefix(base_key: str, version: str) -> str:
+    return f"{base_key}{INDEX_VERSIONS_FOLDER}{version}/"
+
+
+def read_index_manifest(bucket_name: str, base_key: str) -> Optional[Dict]:
+    """:return: The course's manifest, or None if it was never published"""
+    data = s3_utils.read_binary_from_s3_if_exists(bucket_name, f"{base_key}{INDEX_MANIFEST_NAME}")
+    if data is None:
+        return None
+    try:
+        return json.loads(data)
+    except ValueError as e:
+        logger.warning(f"Ignoring unreadable index manifest of {base_key}: {e}")
+        return None
+
+
+def resolve_artifact_prefix(bucket_name: str, base_key: str) -> Tuple[str, Optional[str]]:
+    """
+    Find where the current artifacts of a course live.
+    :return: (artifact key prefix, version), with version None for courses indexed
+        before manifests existed, whose artifacts sit directly under base_key
+    """
+    return manifest_artifact_prefix(base_key, read_index_manifest(bucket_name, base_key))
+
+
+def manifest_artifact_prefix(base_key: str, manifest: Optional[Dict]) -> Tuple[str, Optional[str]]:
+    """resolve_artifact_prefix for a manifest that was already read."""
+    if manifest is None or not manifest.get("version"):
+        return base_key, None
+    return get_version_prefix(base_key, manifest["version"]), manifest["version"]
+
+
+def publish_index_manifest(bucket_name: str, base_key: str, version: str, info: Optional[Dict] = None) -> bool:
+    """
+    Point the course at version. Call only after every artifact of the version is
+    uploaded: a single PUT replaces the manifest atomically, so readers see either the
+    old or the new version in full. Versions beyond INDEX_VERSIONS_RETAINED are deleted.
+    :return: True if the manifest was written
+    """
+    previous = read_index_manifest(bucket_name, base_key)
+    manifest = {
+        "version": version,
+        "prefix": get_version_prefix(base_key, version),
+        "published_at": datetime.now(timezone.utc).isoformat(),
+        "previous_version": previous.get("version") if previous else None,
+        **(info or {}),
+    }
+    if not s3_utils.upload_json_to_s3(manifest, bucket_name, f"{base_key}{INDEX_MANIFEST_NAME}"):
+        return False
+    _delete_old_versions(bucket_name, base_key, version)
+    return True
+
+
+def _delete_old_versions(bucket_name: str, base_key: str, current_version: str) -> None:
+    versions_prefix = f"{base_key}{INDEX_VERSIONS_FOLDER}"
+    versions = sorted({key[len(versions_prefix):].split('/', 1)[0]
+                       for key in s3_utils.list_files_in_prefix(bucket_name, versions_prefix)})
+    # Versions newer than current_version belong to a concurrent build and are left alone
+    older = [version for version in versions if version < current_version]
+    for version in older[:max(0, len(older) - (INDEX_VERSIONS_RETAINED - 1))]:
+        s3_utils.delete_folder_from_s3(bucket_name, get_version_prefix(base_key, version))
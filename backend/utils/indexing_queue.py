@@ -0,0 +1,255 @@
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from typing import Dict, Optional
+
+import utils.redis_utils as redis_utils
+import utils.slide_context as slide_context
+from utils.redis_utils import get_redis_client
+from utils.socket_utils import emit_indexing_progress
+from utils.load_and_process_index import process_course_context_s3
+
+logger = logging.getLogger(__name__)
+
+# Redis list that web processes push course builds onto and indexing workers pop from
+INDEXING_QUEUE_KEY = os.getenv("INDEXING_QUEUE_KEY", "indexing:queue")
+# Lifetime of a course's build lock; a second request while it is held joins the existing
+# job. Workers refresh it on progress, so it only expires if a worker dies mid-build.
+INDEXING_LOCK_TTL = int(os.getenv("INDEXING_LOCK_TTL", "900"))
+# How long the status of a finished build stays readable
+INDEXING_STATUS_TTL = int(os.getenv("INDEXING_STATUS_TTL", "86400"))
+# Seconds a worker blocks waiting for a job before checking again
+INDEXING_WORKER_POLL_SECONDS = int(os.getenv("INDEXING_WORKER_POLL_SECONDS", "5"))
+# Running workers keep this key alive; without it, builds run in the web process that requested them
+INDEXING_WORKER_HEARTBEAT_KEY = "indexing:worker_heartbeat"
+INDEXING_WORKER_HEARTBEAT_TTL = int(os.getenv("INDEXING_WORKER_HEARTBEAT_TTL", "30"))
+
+STATE_QUEUED = "queued"
+STATE_BUILDING = "building"
+STATE_DONE = "done"
+STATE_FAILED = "failed"
+ACTIVE_STATES = (STATE_QUEUED, STATE_BUILDING)
+
+# Builds run in a thread of this process when Redis is unreachable or no worker is running
+_local_statuses: Dict[str, Dict] = {}
+_local_lock = threading.Lock()
+
+
+def _course_key(bucket_name: str, username: str, course_id: str) -> str:
+    return f"{bucket_name}:{username}:{course_id}"
+
+
+def _lock_key(course_key: str) -> str:
+    return f"indexing:lock:{course_key}"
+
+
+def _status_key(course_key: str) -> str:
+    return f"indexing:status:{course_key}"
+
+
+def get_indexing_room(username: str, course_id: str) -> str:
+    """Socket.IO room receiving the indexing_progress events of a course."""
+    return f"indexing:{username}:{course_id}"
+
+
+def is_indexing_active(status: Optional[Dict]) -> bool:
+    return status is not None and status.get("state") in ACTIVE_STATES
+
+
+def _new_status(bucket_name: str, username: str, course_id: str) -> Dict:
+    now = time.time()
+    return {
+        "job_id": uuid.uuid4().hex,
+        "bucket": bucket_name,
+        "username": username,
+        "course_id": course_id,
+        "state": STATE_QUEUED,
+        "stage": None,
+        "chunks": 0,
+        "files": 0,
+        "error": None,
+        "enqueued_at": now,
+        "updated_at": now,
+    }
+
+
+def get_indexing_status(bucket_name: str, username: str, course_id: str) -> Optional[Dict]:
+    """:return: Status of the course's latest build, or None if none is known"""
+    course_key = _course_key(bucket_name, username, course_id)
+    client = get_redis_client()
+    if client is not None:
+        try:
+            data = client.get(_status_key(course_key))
+            return json.loads(data) if data else None
+        except Exception as e:
+            logger.warning(f"Could not read indexing status of {course_key}: {e}")
+    with _local_lock:
+        status = _local_statuses.get(course_key)
+        return dict(status) if status else None
+
+
+def _has_live_worker(client) -> bool:
+    return bool(client.exists(INDEXING_WORKER_HEARTBEAT_KEY))
+
+
+def _start_build_thread(status: Dict, client) -> None:
+    threading.Thread(target=run_indexing_job, args=(dict(status), client), daemon=True,
+                     name=f"indexing-{status['job_id'][:8]}").start()
+
+
+def enqueue_course_indexing(bucket_name: str, username: str, course_id: str) -> Dict:
+    """
+    Queue a full index build of a course for the indexing workers and return at once.
+    A course that is already queued or building is not queued again; its running job
+    is returned with "deduplicated" set. Without Redis, or while no worker is running,
+    the build runs in a background thread of this process instead.
+    :return: Status of the job building the course
+    """
+    course_key = _course_key(bucket_name, username, course_id)
+    client = get_redis_client()
+    if client is not None:
+        status = _new_status(bucket_name, username, course_id)
+        try:
+            if not client.set(_lock_key(course_key), status["job_id"], nx=True, ex=INDEXING_LOCK_TTL):
+                existing = get_indexing_status(bucket_name, username, course_id)
+                if is_indexing_active(existing):
+                    return {**existing, "deduplicated": True}
+                # The lock holder has not written its status yet
+                return {**status, "job_id": None, "deduplicated": True}
+            queued = _has_live_worker(client)
+            pipe = client.pipeline()
+            pipe.set(_status_key(course_key), json.dumps(status), ex=INDEXING_STATUS_TTL)
+            if queued:
+                pipe.rpush(INDEXING_QUEUE_KEY, json.dumps(status))
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"Redis unavailable for the indexing queue, building {course_key} in process: {e}")
+        else:
+            if queued:
+                logger.info(f"Queued indexing job {status['job_id']} for {course_key}")
+            else:
+                # The lock and status stay in Redis, so other web processes still see the build
+                logger.warning(f"No indexing worker is running, building {course_key} in process")
+                _start_build_thread(status, client)
+            _publish(status)
+            return {**status, "deduplicated": False}
+
+    with _local_lock:
+        existing = _local_statuses.get(course_key)
+        if is_indexing_active(existing):
+            return {**existing, "deduplicated": True}
+        status = _new_status(bucket_name, username, course_id)
+        _local_statuses[course_key] = status
+    _start_build_thread(status, None)
+    return {**status, "deduplicated": False}
+
+
+def _publish(status: Dict) -> None:
+    emit_indexing_progress(get_indexing_room(status["username"], status["course_id"]), status)
+
+
+def _save_status(status: Dict, client) -> None:
+    status["updated_at"] = time.time()
+    course_key = _course_key(status["bucket"], status["username"], status["course_id"])
+    if client is None:
+        with _local_lock:
+            _local_statuses[course_key] = dict(status)
+    else:
+        try:
+            pipe = client.pipeline()
+            pipe.set(_status_key(course_key), json.dumps(status), ex=INDEXING_STATUS_TTL)
+            if status["state"] in ACTIVE_STATES:
+                pipe.expire(_lock_key(course_key), INDEXING_LOCK_TTL)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"Could not save indexing status of {course_key}: {e}")
+    _publish(status)
+
+
+def run_indexing_job(job: Dict, client=None) -> bool:
+    """
+    Build the index of the course named by a queued job, saving and emitting its status
+    as the build progresses, then release the course for new builds.
+    :param client: Redis client holding the job's lock and status, or None for in-process jobs
+    :return: True if the new index was published
+    """
+    status = dict(job)
+    status.update(state=STATE_BUILDING, stage="starting")
+    _save_status(status, client)
+
+    def on_progress(stage, info):
+        status.update(stage=stage, **info)
+        _save_status(status, client)
+
+    started = time.time()
+    try:
+        success = process_course_context_s3(status["bucket"], status["username"], status["course_id"],
+                                            os.getenv("OPENAI_API_KEY"), progress_callback=on_progress)
+        error = None if success else "Index build failed"
+        if success:
+            # Chunk IDs change with every build, so the slides' supporting chunks are recomputed
+            on_progress("slide_context", {})
+            slide_context.refresh_slide_context(status["bucket"], status["username"], status["course_id"],
+                                                os.getenv("OPENAI_API_KEY"))
+    except Exception as e:
+        logger.exception(f"Indexing job {status['job_id']} failed")
+        success, error = False, str(e)
+
+    status.update(state=STATE_DONE if success else STATE_FAILED, error=error,
+                  duration_seconds=round(time.time() - started, 2))
+    _save_status(status, client)
+    if client is not None:
+        course_key = _course_key(status["bucket"], status["username"], status["course_id"])
+        redis_utils.release_redis_lock(client, _lock_key(course_key), status["job_id"])
+    logger.info(f"Indexing job {status['job_id']} {status['state']} in {status['duration_seconds']}s")
+    return success
+
+
+def run_worker(max_jobs: Optional[int] = None) -> None:
+    """
+    Process queued index builds until interrupted, or until max_jobs have run.
+    Run one or more workers next to the web processes with `python -m utils.indexing_queue`.
+    """
+    if not redis_utils.REDIS_AVAILABLE:
+        raise RuntimeError("The indexing worker requires the redis package")
+    # A dedicated connection: the shared client's short socket timeout would cut off BLPOP
+    client = redis_utils.redis.Redis(host=redis_utils.REDIS_HOST, port=redis_utils.REDIS_PORT,
+                                     db=redis_utils.REDIS_DB,
+                                     socket_timeout=INDEXING_WORKER_POLL_SECONDS + 5)
+    stop = threading.Event()
+    threading.Thread(target=_beat, args=(client, stop), daemon=True, name="indexing-heartbeat").start()
+    logger.info(f"Indexing worker waiting for jobs on {INDEXING_QUEUE_KEY}")
+    jobs_run = 0
+    try:
+        while max_jobs is None or jobs_run < max_jobs:
+            item = client.blpop(INDEXING_QUEUE_KEY, timeout=INDEXING_WORKER_POLL_SECONDS)
+            if item is None:
+                continue
+            try:
+                job = json.loads(item[1])
+            except ValueError:
+                logger.error(f"Dropping malformed indexing job: {item[1]!r}")
+                continue
+            run_indexing_job(job, client)
+            jobs_run += 1
+    finally:
+        stop.set()
+
+
+def _beat(client, stop: threading.Event) -> None:
+    """Keep the worker heartbeat alive, also while a long build runs."""
+    while True:
+        try:
+            client.set(INDEXING_WORKER_HEARTBEAT_KEY, str(os.getpid()), ex=INDEXING_WORKER_HEARTBEAT_TTL)
+        except Exception as e:
+            logger.warning(f"Could not refresh the indexing worker heartbeat: {e}")
+        if stop.wait(INDEXING_WORKER_HEARTBEAT_TTL / 3):
+            return
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    run_worker()
@@ -1,151 +1,482 @@
-import tiktoken
 import openai
 # import faiss  # Comment out the direct import
 import numpy as np
-from difflib import SequenceMatcher
 import time
-import io
-import json
-import boto3
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
 from utils.s3_utils import (
     get_course_s3_folder,
+    delete_file_from_s3,
     upload_json_to_s3,
     upload_faiss_index_to_s3,
-    ACCESS_KEY,
-    SECRET_KEY,
-    REGION_NAME
+    upload_local_file_to_s3,
+    upload_bytes_to_s3,
+    get_json_from_s3,
+    iter_objects_in_prefix,
+    iter_text_file_lines_from_s3
 )
+from utils.s3_fetcher import FetchStats, iter_fetched_objects
+from utils.course_cache import invalidate_course_state, load_course_state_from_s3
+from utils.embedding_engine import EmbeddingEngine, EMBEDDING_MODEL, EMBEDDING_REQUEST_DIMENSION
+from utils.embedding_cache import EmbeddingCache, EMBEDDING_CACHE_ENABLED
+from utils.chunker import iter_document_chunks
+from utils.bm25_index import BM25Index
+from utils.chunk_store import ChunkStore, ChunkStoreWriter, encode_chunk_store
+from utils.chunk_provenance import ChunkProvenance, PROVENANCE_NAME
+from utils.numpy_vector_store import NumpyVectorStore, VECTOR_STORE_NAME
+from utils.index_manifest import new_index_version, get_version_prefix, publish_index_manifest, read_index_manifest
+import utils.index_factory as index_factory
+import utils.packed_index as packed_index
+import utils.slide_context as slide_context
+from utils.pdf_text import extract_pdf_text_to_s3, pdf_text_key
+from utils.redis_utils import redis_lock
 
 # Try to import faiss, make it optional
 try:
     import faiss
     FAISS_AVAILABLE = True
 except ImportError:
-    print("Warning: FAISS not available in load_and_process_index. Vector index functionality will be disabled.")
+    print("Warning: FAISS not available in load_and_process_index. Vectors will be stored for NumPy search.")
     FAISS_AVAILABLE = False
     faiss = None
 
+# Full builds and incremental updates of a course hold its write lock from reading the
+# published index (or the course files) until the next version is published, so no writer
+# publishes a version derived from one that another writer has since replaced
+COURSE_WRITE_LOCK_TTL = int(os.getenv("COURSE_WRITE_LOCK_TTL", "300"))
+COURSE_WRITE_LOCK_WAIT = float(os.getenv("COURSE_WRITE_LOCK_WAIT", "900"))
 
-def process_course_context_s3(bucket_name, username, coursename, api_key, max_tokens=2000):
-    """Standalone function to process course files from S3 and upload indices back to S3"""
-    start_time = time.time()
+_course_write_locks = {}
+_course_write_locks_guard = threading.Lock()
 
-    # Initialize S3 client
-    s3 = boto3.client('s3',
-                      aws_access_key_id=ACCESS_KEY,
-                      aws_secret_access_key=SECRET_KEY,
-                      region_name=REGION_NAME)
 
-    # 1. Load and combine text files from S3
-    course_prefix = get_course_s3_folder(username, coursename)
-    all_text = []
+def add_chunks_to_inverted_index(inverted_index, chunks, start_id=0):
+    """Index quote lines of chunks, whose IDs start at start_id."""
+    for i, chunk in enumerate(chunks, start=start_id):
+        quotes = [line for line in chunk.split('\n') if line.startswith('"')]
+        for quote in quotes:
+            inverted_index[quote.lower()] = i
+    return inverted_index
 
-    try:
-        # List and read text files
-        response = s3.list_objects_v2(Bucket=bucket_name, Prefix=course_prefix)
-        for obj in response.get('Contents', []):
-            if obj['Key'].endswith('.txt'):
-                file_obj = s3.get_object(Bucket=bucket_name, Key=obj['Key'])
-                all_text.append(file_obj['Body'].read().decode('utf-8'))
 
-        if not all_text:
-            raise ValueError("No text files found in course directory")
+def _new_embedding_engine(bucket_name, api_key):
+    openai_client = openai.OpenAI(api_key=api_key)
+    cache = EmbeddingCache(EMBEDDING_MODEL, EMBEDDING_REQUEST_DIMENSION, bucket_name) if EMBEDDING_CACHE_ENABLED else None
+    return EmbeddingEngine(openai_client, cache=cache)
+
+
+def _add_chunk_embeddings(faiss_index, engine, chunks, start_id):
+    """Embed Chunk objects, prefixed with their section titles, under IDs starting at start_id."""
+    embeddings_np = engine.embed([chunk.embedding_text for chunk in chunks])
+    faiss_index.add_with_ids(embeddings_np, np.arange(start_id, start_id + len(chunks), dtype='int64'))
+
+
+def _upload_index_artifacts(bucket_name, prefix, faiss_index, inverted_index, bm25_index, sources, provenance):
+    """
+    Upload everything but chunks.bin, which callers upload first, under a version prefix.
+    :return: True if every artifact was uploaded
+    """
+    uploaded = True
+    # Upload the vector index: a FAISS index, plus its NumPy export for processes without FAISS
+    if faiss_index is None:
+        print("Warning: Vector index not created. Skipping vector index upload.")
+    elif isinstance(faiss_index, NumpyVectorStore):
+        uploaded &= upload_bytes_to_s3(faiss_index.to_bytes(), bucket_name, f"{prefix}{VECTOR_STORE_NAME}")
+    else:
+        uploaded &= upload_faiss_index_to_s3(faiss_index, bucket_name, f"{prefix}faiss.index")
+        if index_factory.NUMPY_VECTOR_EXPORT:
+            uploaded &= upload_bytes_to_s3(index_factory.to_numpy_store(faiss_index).to_bytes(),
+                                           bucket_name, f"{prefix}{VECTOR_STORE_NAME}")
+
+    # Upload inverted index
+    uploaded &= upload_json_to_s3(inverted_index, bucket_name, f"{prefix}inverted_index.json")
+
+    # Upload BM25 keyword index
+    uploaded &= upload_json_to_s3(bm25_index.to_json(), bucket_name, f"{prefix}bm25_index.json")
+
+    # Upload the source, lines and section of every chunk
+    uploaded &= upload_bytes_to_s3(provenance.to_bytes(), bucket_name, f"{prefix}{PROVENANCE_NAME}")
+
+    # Upload per-file chunk ranges and the index layout
+    index_info = {"sources": sources}
+    if faiss_index is not None:
+        index_info.update(index_factory.describe_index(faiss_index))
+    uploaded &= upload_json_to_s3(index_info, bucket_name, f"{prefix}index_sources.json")
+    return uploaded
+
+
+def _publish_manifest(bucket_name, base_key, version, num_chunks, packed_shard=None):
+    """
+    Flip the course's manifest to a fully uploaded version, making it visible to readers.
+    :param packed_shard: Packed index shard holding the version, for courses stored packed
+    """
+    info = {"num_chunks": num_chunks}
+    if packed_shard is not None:
+        info["packed_shard"] = packed_shard
+    if not publish_index_manifest(bucket_name, base_key, version, info):
+        print(f"Error publishing index version {version} of {base_key}")
+        return False
+    print(f"Published index version {version} of {base_key}")
+    return True
+
 
-        combined_text = '\n'.join(all_text)
-        del all_text  # Free memory early
+def _leave_previous_shard(bucket_name, base_key, previous, packed_shard=None):
+    """Drop the course from the shard its previous manifest named, if it is no longer stored there."""
+    previous_shard = (previous or {}).get("packed_shard")
+    if previous_shard is not None and previous_shard != packed_shard:
+        # The course outgrew the packed index, or moved to another shard
+        packed_index.remove_course(bucket_name, previous_shard, base_key)
 
+
+def _publish_version(bucket_name, base_key, version, num_chunks):
+    """Publish a version stored under the course's own version prefix."""
+    previous = read_index_manifest(bucket_name, base_key)
+    if not _publish_manifest(bucket_name, base_key, version, num_chunks):
+        return False
+    _leave_previous_shard(bucket_name, base_key, previous)
+    return True
+
+
+def _publish_packed(bucket_name, base_key, version, chunks, faiss_index, inverted_index, bm25_index, sources,
+                    provenance):
+    """
+    Store a small course in its packed index shard rather than under its own version prefix.
+    :return: True if the course was packed and published; False leaves it for an unpacked upload
+    """
+    previous = read_index_manifest(bucket_name, base_key)
+    vectors = index_factory.to_numpy_store(faiss_index, index_factory.ENCODING_FP32)
+    shard = packed_index.publish_course(
+        bucket_name, base_key, version, chunks, vectors, inverted_index, bm25_index, sources, provenance,
+        lambda shard: _publish_manifest(bucket_name, base_key, version, len(chunks), shard))
+    if shard is None:
+        return False
+    # Outside the shard lock, so no writer holds two shard locks at once
+    _leave_previous_shard(bucket_name, base_key, previous, shard)
+    return True
+
+
+@contextmanager
+def _locked_course(bucket_name, username, coursename):
+    """
+    Hold the write lock of a course: within this process with a lock, and across processes
+    through Redis when reachable. Raises TimeoutError after COURSE_WRITE_LOCK_WAIT seconds.
+    :return: The RedisLock held, whose refresh() long builds call as they progress
+    """
+    course_key = f"{bucket_name}:{username}:{coursename}"
+    with _course_write_locks_guard:
+        local_lock = _course_write_locks.setdefault(course_key, threading.Lock())
+    if not local_lock.acquire(timeout=COURSE_WRITE_LOCK_WAIT):
+        raise TimeoutError(f"Timed out waiting for the index write lock of {course_key}")
+    try:
+        with redis_lock(f"indexing:write:{course_key}", COURSE_WRITE_LOCK_TTL, COURSE_WRITE_LOCK_WAIT) as lock:
+            yield lock
+    finally:
+        local_lock.release()
+
+
+def _report_progress(progress_callback, stage, **info):
+    if progress_callback is None:
+        return
+    try:
+        progress_callback(stage, info)
     except Exception as e:
-        print(f"Error loading files from S3: {str(e)}")
+        # Progress reporting must never fail a build
+        print(f"Error reporting indexing progress: {str(e)}")
+
+
+def process_course_context_s3(bucket_name, username, coursename, api_key, max_tokens=2000, progress_callback=None):
+    """
+    Standalone function to process course files from S3 and upload indices back to S3.
+    Files are streamed line by line through the chunker and embedded in fixed-size
+    batches, and chunk texts are spooled to a temporary file, so peak memory is
+    about one embedding batch rather than the whole corpus.
+    :param progress_callback: Optional callable(stage, info) invoked as the build moves
+        through the "chunking", "uploading" and "published" stages
+    """
+    try:
+        with _locked_course(bucket_name, username, coursename) as lock:
+            def on_progress(stage, info):
+                lock.refresh()
+                if progress_callback is not None:
+                    progress_callback(stage, info)
+
+            return _build_course_index(bucket_name, username, coursename, api_key, max_tokens, on_progress)
+    except TimeoutError as e:
+        print(f"Error building the index of course {coursename}: {str(e)}")
         return False
 
-    # 2. Split into chunks with memory efficiency
-    encoder = tiktoken.encoding_for_model("gpt-4")
-    chunks = []
-    current_chunk = []
-    current_token_count = 0
-
-    for line in combined_text.split('\n'):
-        line_tokens = len(encoder.encode(line + '\n'))
-        if current_token_count + line_tokens > max_tokens:
-            if current_chunk:
-                chunks.append('\n'.join(current_chunk))
-                current_chunk = []
-                current_token_count = 0
-            # Handle long lines that exceed max_tokens
-            while line_tokens > max_tokens:
-                chunks.append(line[:len(line) // 2])
-                line = line[len(line) // 2:]
-                line_tokens = len(encoder.encode(line + '\n'))
-            current_chunk.append(line)
-            current_token_count = line_tokens
-        else:
-            current_chunk.append(line)
-            current_token_count += line_tokens
-
-    if current_chunk:
-        chunks.append('\n'.join(current_chunk))
-    del combined_text  # Free memory
-
-    # 3. Generate embeddings and build FAISS index (only if FAISS is available)
-    faiss_index = None
-    if FAISS_AVAILABLE:
-        dimension = 3072  # text-embedding-3-large dimension
-        faiss_index = faiss.IndexFlatL2(dimension)
-        embeddings = []
-
-        openai_client = openai.OpenAI(api_key=api_key)
-
-        # Process chunks in batches to control memory usage
-        batch_size = 100
-        for i in range(0, len(chunks), batch_size):
-            batch = chunks[i:i + batch_size]
-            try:
-                response = openai_client.embeddings.create(
-                    model="text-embedding-3-large",
-                    input=batch
-                )
-                batch_embeddings = [e.embedding for e in response.data]
-                embeddings.extend(batch_embeddings)
-            except Exception as e:
-                print(f"Error generating embeddings: {str(e)}")
-                embeddings.extend([np.zeros(dimension).tolist()] * len(batch))
-
-            # Clear memory between batches
-            del batch
-            del response
-
-        # Convert to numpy array and add to FAISS
-        embeddings_np = np.array(embeddings).astype('float32')
-        faiss_index.add(embeddings_np)
-        del embeddings
-        del embeddings_np
-    else:
-        print("Warning: FAISS not available. Skipping vector index creation.")
 
-    # 4. Build inverted index
+def _build_course_index(bucket_name, username, coursename, api_key, max_tokens, progress_callback):
+    start_time = time.time()
+    course_prefix = get_course_s3_folder(username, coursename)
+    # Artifacts are written under a new version prefix and published by the manifest last,
+    # so readers never pair chunks of one build with indices of another
+    version = new_index_version()
+    version_prefix = get_version_prefix(course_prefix, version)
+
+    # Vectors are streamed into an exact float32 index; the configured index type and
+    # storage encoding are trained once all vectors are known. Without FAISS this is a NumPy store.
+    engine = _new_embedding_engine(bucket_name, api_key)
+    faiss_index = index_factory.new_index(index_factory.INDEX_TYPE_FLAT, engine.dimension,
+                                          encoding=index_factory.ENCODING_FP32, pca_dimension=0)
+    # Enough chunks per batch to keep every concurrent embedding request full
+    stream_batch_size = engine.max_batch_inputs * max(1, engine.max_workers)
+
     inverted_index = {}
-    for i, chunk in enumerate(chunks):
-        quotes = [line for line in chunk.split('\n') if line.startswith('"')]
-        for quote in quotes:
-            inverted_index[quote.lower()] = i
+    bm25_index = BM25Index()
+    sources = {}
+    provenance = ChunkProvenance()
+    chunk_count = 0
+    batch = []
+    batch_start = 0
+    fetch_stats = FetchStats()
+
+    chunks_writer = ChunkStoreWriter()
+    chunks_file = tempfile.NamedTemporaryFile(suffix='.bin', delete=False)
+    chunks_file.close()
+    try:
+        # 1. Stream text files from S3 through the chunker and embedding batcher.
+        # Files are chunked separately so every source owns a contiguous chunk ID range.
+        try:
+            # Files download in parallel but reach the chunker in listing order, so chunk IDs are deterministic
+            for fetched in iter_fetched_objects(bucket_name, iter_objects_in_prefix(bucket_name, course_prefix,
+                                                                                    suffix='.txt')):
+                fetch_stats.add(fetched)
+                key = fetched.key
+                file_start = chunk_count
+                file_chunks = []
+                for chunk in iter_document_chunks(fetched.iter_lines(), max_tokens):
+                    chunks_writer.add(chunk.text)
+                    add_chunks_to_inverted_index(inverted_index, [chunk.text], chunk_count)
+                    bm25_index.add_documents([chunk.text], chunk_count)
+                    file_chunks.append(chunk)
+                    chunk_count += 1
+
+                    batch.append(chunk)
+                    if len(batch) >= stream_batch_size:
+                        _add_chunk_embeddings(faiss_index, engine, batch, batch_start)
+                        batch_start = chunk_count
+                        batch = []
+                        _report_progress(progress_callback, "chunking", chunks=chunk_count, files=len(sources))
+                sources[key] = {"start": file_start, "end": chunk_count}
+                provenance.add_chunks(key, file_start, file_chunks)
+                _report_progress(progress_callback, "chunking", chunks=chunk_count, files=len(sources))
+
+            if not sources:
+                raise ValueError("No text files found in course directory")
+            print(f"Fetched course files: {fetch_stats.summary()}")
+
+            if batch:
+                _add_chunk_embeddings(faiss_index, engine, batch, batch_start)
+                batch = []
+            faiss_index = index_factory.rebuild_index(faiss_index)
+            print(f"Built index over {faiss_index.ntotal} chunks: {index_factory.describe_index(faiss_index)}")
+            chunks_writer.finish(chunks_file.name)
+
+        except Exception as e:
+            print(f"Error loading files from S3: {str(e)}")
+            return False
+
+        # 2. Upload all artifacts to S3, then publish them
+        _report_progress(progress_callback, "uploading", chunks=chunk_count, files=len(sources))
+        packed = packed_index.should_pack(chunk_count) and _publish_packed(
+            bucket_name, course_prefix, version, list(ChunkStore.open_file(chunks_file.name)), faiss_index,
+            inverted_index, bm25_index, sources, provenance)
+        if not packed:
+            uploaded = upload_local_file_to_s3(chunks_file.name, bucket_name, f"{version_prefix}chunks.bin")
+            uploaded = uploaded and _upload_index_artifacts(bucket_name, version_prefix, faiss_index,
+                                                            inverted_index, bm25_index, sources, provenance)
+            if not uploaded:
+                print(f"Error uploading index version {version}; the previous version stays published")
+                return False
+            if not _publish_version(bucket_name, course_prefix, version, chunk_count):
+                return False
+    finally:
+        chunks_writer.close()
+        os.remove(chunks_file.name)
+
+    # Readers must pick up the new artifacts on their next load
+    invalidate_course_state(username, coursename)
+
+    _report_progress(progress_callback, "published", chunks=chunk_count, files=len(sources), version=version)
+    print(f"Processed {chunk_count} chunks from {len(sources)} files in {time.time() - start_time:.2f} seconds")
+    return True
+
+
+def _load_index_for_update(bucket_name, username, coursename):
+    """Load a course's index artifacts for modification, or None if the course was never indexed."""
+    state = load_course_state_from_s3(bucket_name, username, coursename, mmap=False)
+    if state is None or state.faiss_index is None:
+        return None
+    # Updates rewrite every chunk, so read them all into a mutable list
+    state.chunks = list(state.chunks)
+    if state.packed_shard is not None:
+        course = packed_index.open_packed_course(bucket_name, state.packed_shard,
+                                                 get_course_s3_folder(username, coursename))
+        return state, dict(course.sources) if course is not None else {}
+    sources_data = get_json_from_s3(bucket_name, f"{state.prefix}index_sources.json") or {}
+    return state, sources_data.get("sources", {})
+
+
+def _upload_new_version(bucket_name, base_key, state, sources):
+    """Upload an updated course state as a new version and publish it."""
+    version = new_index_version()
+    if packed_index.should_pack(len(state.chunks)) and _publish_packed(
+            bucket_name, base_key, version, state.chunks, state.faiss_index, state.inverted_index,
+            state.bm25_index, sources, state.provenance):
+        return True
+    if state.packed_shard is not None and FAISS_AVAILABLE:
+        # Packed courses keep their vectors in a NumPy store; unpacked ones get the configured FAISS index
+        ids = index_factory.get_ids(state.faiss_index)
+        state.faiss_index = index_factory.build_index(index_factory.reconstruct_vectors(state.faiss_index, ids), ids)
+    version_prefix = get_version_prefix(base_key, version)
+    uploaded = upload_bytes_to_s3(encode_chunk_store(state.chunks), bucket_name, f"{version_prefix}chunks.bin")
+    uploaded = uploaded and _upload_index_artifacts(bucket_name, version_prefix, state.faiss_index,
+                                                    state.inverted_index, state.bm25_index, sources,
+                                                    state.provenance)
+    if not uploaded:
+        print(f"Error uploading index version {version}; the previous version stays published")
+        return False
+    return _publish_version(bucket_name, base_key, version, len(state.chunks))
+
+
+def _remove_source(state, sources, s3_key):
+    """Drop the vectors, inverted-index, BM25 and provenance entries and chunk texts of one source file."""
+    chunk_range = sources.pop(s3_key)
+    start, end = chunk_range["start"], chunk_range["end"]
+    state.faiss_index = index_factory.remove_id_range(state.faiss_index, start, end)
+    state.inverted_index = {
+        quote: chunk_id for quote, chunk_id in state.inverted_index.items() if not start <= chunk_id < end
+    }
+    state.bm25_index.remove_range(start, end)
+    state.provenance.remove_range(start, end)
+    # Chunk IDs are positions in the chunk store, so removed chunks are left as empty placeholders
+    for chunk_id in range(start, end):
+        state.chunks[chunk_id] = ""
+
+
+def add_file_to_course_index(bucket_name, username, coursename, s3_key, api_key, max_tokens=2000):
+    """
+    Embed one newly uploaded text or PDF file and append its chunks to an existing course index.
+    PDFs are indexed through their extracted text. Re-adding a file that is already indexed
+    replaces its previous chunks.
+    :return: True if the index was updated, False otherwise
+    """
+    if s3_key.endswith('.pdf'):
+        text_key = extract_pdf_text_to_s3(bucket_name, s3_key)
+        if text_key is None:
+            print(f"Skipping incremental indexing of {s3_key}: no text could be extracted")
+            return False
+        s3_key = text_key
+    elif not s3_key.endswith('.txt'):
+        print(f"Skipping incremental indexing for unsupported file {s3_key}")
+        return False
+
+    try:
+        with _locked_course(bucket_name, username, coursename) as lock:
+            added = _add_file(bucket_name, username, coursename, s3_key, api_key, max_tokens, lock)
+    except TimeoutError as e:
+        print(f"Error indexing {s3_key}: {str(e)}")
+        return False
+    if added is None:
+        # The embedding size was reconfigured since the index was built. Imported here since
+        # indexing jobs run through this module.
+        from utils.indexing_queue import enqueue_course_indexing
+        enqueue_course_indexing(bucket_name, username, coursename)
+        return False
+    if added:
+        # Slide contexts name the chunk IDs of one index version
+        slide_context.refresh_slide_context(bucket_name, username, coursename, api_key)
+    return added
+
 
-    # 5. Upload all artifacts to S3
+def _add_file(bucket_name, username, coursename, s3_key, api_key, max_tokens, lock):
+    """:return: True if the index was updated, False if not, None if it must be rebuilt"""
+    start_time = time.time()
     base_key = get_course_s3_folder(username, coursename)
+    loaded = _load_index_for_update(bucket_name, username, coursename)
+    if loaded is None:
+        print(f"No existing index for course {coursename}, skipping incremental update of {s3_key}")
+        return False
+    state, sources = loaded
+    state.faiss_index = index_factory.ensure_explicit_ids(state.faiss_index)
+    engine = _new_embedding_engine(bucket_name, api_key)
+    if state.faiss_index.d != engine.dimension:
+        print(f"Index of course {coursename} has dimension {state.faiss_index.d}, "
+              f"embeddings have {engine.dimension}; queueing a rebuild of the whole course index")
+        return None
 
-    # Upload chunks
-    upload_json_to_s3(chunks, bucket_name, f"{base_key}chunks.json")
-    del chunks
+    try:
+        file_chunks = list(iter_document_chunks(iter_text_file_lines_from_s3(bucket_name, s3_key), max_tokens))
+    except Exception as e:
+        print(f"Error reading {s3_key}: {str(e)}")
+        return False
 
-    # Upload FAISS index (only if available)
-    if FAISS_AVAILABLE and faiss_index is not None:
-        upload_faiss_index_to_s3(faiss_index, bucket_name, f"{base_key}faiss.index")
-        del faiss_index
-    else:
-        print("Warning: FAISS index not created or FAISS not available. Skipping FAISS index upload.")
+    if s3_key in sources:
+        _remove_source(state, sources, s3_key)
 
-    # Upload inverted index
-    upload_json_to_s3(inverted_index, bucket_name, f"{base_key}inverted_index.json")
-    del inverted_index
+    start_id = len(state.chunks)
+    # Embedded in the batches of a full build, refreshing the write lock so a long
+    # file cannot outlast its TTL
+    batch_size = engine.max_batch_inputs * max(1, engine.max_workers)
+    for offset in range(0, len(file_chunks), batch_size):
+        _add_chunk_embeddings(state.faiss_index, engine, file_chunks[offset:offset + batch_size], start_id + offset)
+        lock.refresh()
+    chunk_texts = [chunk.text for chunk in file_chunks]
+    state.chunks.extend(chunk_texts)
+    add_chunks_to_inverted_index(state.inverted_index, chunk_texts, start_id)
+    state.bm25_index.add_documents(chunk_texts, start_id)
+    state.provenance.add_chunks(s3_key, start_id, file_chunks)
+    sources[s3_key] = {"start": start_id, "end": start_id + len(file_chunks)}
+
+    if not _upload_new_version(bucket_name, base_key, state, sources):
+        return False
+    invalidate_course_state(username, coursename)
+
+    print(f"Added {len(file_chunks)} chunks from {s3_key} in {time.time() - start_time:.2f} seconds")
+    return True
+
+
+def remove_file_from_course_index(bucket_name, username, coursename, s3_key, api_key=None):
+    """
+    Remove the chunks of a deleted text or PDF file from an existing course index.
+    :param api_key: OpenAI key for recomputing the slide context, OPENAI_API_KEY by default
+    :return: True if the index was updated, False otherwise
+    """
+    if s3_key.endswith('.pdf'):
+        # The extracted text would otherwise come back with the next full build
+        s3_key = pdf_text_key(s3_key)
+        delete_file_from_s3(bucket_name, s3_key)
+    try:
+        with _locked_course(bucket_name, username, coursename):
+            removed = _remove_file(bucket_name, username, coursename, s3_key)
+    except TimeoutError as e:
+        print(f"Error removing {s3_key} from the index: {str(e)}")
+        return False
+    if removed:
+        slide_context.refresh_slide_context(bucket_name, username, coursename,
+                                            api_key or os.getenv("OPENAI_API_KEY"))
+    return removed
+
+
+def _remove_file(bucket_name, username, coursename, s3_key):
+    base_key = get_course_s3_folder(username, coursename)
+    loaded = _load_index_for_update(bucket_name, username, coursename)
+    if loaded is None:
+        return False
+    state, sources = loaded
+    if s3_key not in sources:
+        print(f"{s3_key} is not tracked in the index of course {coursename}")
+        return False
+
+    state.faiss_index = index_factory.ensure_explicit_ids(state.faiss_index)
+    _remove_source(state, sources, s3_key)
+
+    if not _upload_new_version(bucket_name, base_key, state, sources):
+        return False
+    invalidate_course_state(username, coursename)
 
-    print(f"Total processing time: {time.time() - start_time:.2f} seconds")
+    print(f"Removed {s3_key} from the index of course {coursename}")
     return True
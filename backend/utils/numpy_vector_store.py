@@ -0,0 +1,254 @@
+import io
+import os
+from typing import Optional, Tuple
+
+import numpy as np
+
+import utils.s3_utils as s3_utils
+from utils.artifact_cache import ARTIFACT_CACHE_ENABLED, get_local_artifact_path
+
+# Artifact holding a course's vectors for processes without FAISS
+VECTOR_STORE_NAME = "vectors.npy"
+# Storage of the vectors: "fp16" halves the artifact and memory at a negligible cost in ranking
+# precision, but converting blocks back to float32 makes searches ~10x slower than "fp32"
+NUMPY_VECTOR_ENCODING = os.getenv("NUMPY_VECTOR_ENCODING", "fp32")
+# Stored vectors scored per matrix product; small blocks keep float16 conversions in cache
+NUMPY_SEARCH_BLOCK_ROWS = int(os.getenv("NUMPY_SEARCH_BLOCK_ROWS", "2048"))
+
+_DTYPES = {"fp32": np.dtype('<f4'), "fp16": np.dtype('<f2')}
+_NPY_MAGIC = b"\x93NUMPY"
+# Distance and ID FAISS reports for result slots it could not fill
+_MISSING_DISTANCE = np.finfo('float32').max
+_MISSING_ID = -1
+
+
+def is_vector_store_file(path: str) -> bool:
+    """Whether a local index file holds a NumpyVectorStore rather than a FAISS index."""
+    with open(path, 'rb') as f:
+        return f.read(len(_NPY_MAGIC)) == _NPY_MAGIC
+
+
+class NumpyVectorStore:
+    """
+    Exact L2 vector search in NumPy, used where FAISS cannot be installed. Implements
+    the part of the FAISS index interface the retrieval code uses (d, ntotal,
+    add_with_ids, search, search_and_reconstruct, reconstruct), so it can stand in
+    for a flat FAISS index.
+
+    Vectors are float32 or float16 rows of one matrix, row i holding the vector of
+    chunk ID i, so the .npy file is the whole store and can be memory-mapped. Like
+    chunk texts, vectors of removed chunks leave a placeholder row, filled with NaN.
+    """
+
+    def __init__(self, d: int, encoding: str = NUMPY_VECTOR_ENCODING, vectors: Optional[np.ndarray] = None):
+        if encoding not in _DTYPES:
+            raise ValueError(f"Unsupported vector encoding for the NumPy store: {encoding}")
+        self.d = d
+        self.encoding = encoding
+        self._vectors = vectors if vectors is not None else np.zeros((0, d), dtype=_DTYPES[encoding])
+        # Rows are a prefix of this buffer, grown geometrically so streamed batches append in amortized O(1)
+        self._buffer = None
+        self._reset_caches()
+
+    def _reset_caches(self):
+        self._norms = None
+
+    def _squared_norms(self) -> np.ndarray:
+        """Squared norm of every row, infinite for placeholder rows so they never rank."""
+        if self._norms is None:
+            norms = np.empty(len(self._vectors), dtype='float32')
+            for start in range(0, len(self._vectors), NUMPY_SEARCH_BLOCK_ROWS):
+                block = self._vectors[start:start + NUMPY_SEARCH_BLOCK_ROWS].astype('float32', copy=False)
+                norms[start:start + len(block)] = np.einsum('ij,ij->i', block, block)
+            norms[np.isnan(norms)] = np.inf
+            self._norms = norms
+        return self._norms
+
+    @property
+    def ntotal(self) -> int:
+        return int(np.isfinite(self._squared_norms()).sum())
+
+    @property
+    def ids(self) -> np.ndarray:
+        return np.flatnonzero(np.isfinite(self._squared_norms())).astype('int64')
+
+    @property
+    def nbytes(self) -> int:
+        return self._vectors.nbytes
+
+    def _make_writeable(self) -> None:
+        # Memory-mapped stores are read-only; modifying one works on a private copy
+        if not self._vectors.flags.writeable:
+            self._vectors = np.array(self._vectors)
+            self._buffer = None
+
+    def add_with_ids(self, x: np.ndarray, ids: np.ndarray) -> None:
+        x = np.asarray(x, dtype='float32').reshape(-1, self.d)
+        ids = np.asarray(ids, dtype='int64')
+        if not len(ids):
+            return
+        if ids.min() < 0:
+            raise ValueError("Vector IDs must be non-negative")
+        count = len(self._vectors)
+        needed = max(count, int(ids.max()) + 1)
+        if needed > count:
+            if self._buffer is None or len(self._buffer) < needed:
+                buffer = np.empty((max(needed, 2 * count), self.d), dtype=self._vectors.dtype)
+                buffer[:count] = self._vectors
+                self._buffer = buffer
+            # IDs skipped over are placeholders until they are added
+            self._buffer[count:needed] = np.nan
+            self._vectors = self._buffer[:needed]
+        else:
+            self._make_writeable()
+        self._vectors[ids] = x
+        self._reset_caches()
+
+    def add(self, x: np.ndarray) -> None:
+        start = len(self._vectors)
+        self.add_with_ids(x, np.arange(start, start + len(x), dtype='int64'))
+
+    def add_store(self, other: "NumpyVectorStore", start: int) -> None:
+        """Copy every row of another store to IDs from start; its placeholder rows stay placeholders."""
+        self.add_with_ids(other._vectors, np.arange(start, start + len(other._vectors), dtype='int64'))
+
+    def remove_id_range(self, start: int, end: int) -> int:
+        """Remove IDs in [start, end), leaving placeholder rows. :return: Number of vectors removed"""
+        start, end = max(0, start), min(end, len(self._vectors))
+        if start >= end:
+            return 0
+        removed = int(np.isfinite(self._squared_norms()[start:end]).sum())
+        self._make_writeable()
+        self._vectors[start:end] = np.nan
+        self._reset_caches()
+        return removed
+
+    def slice(self, start: int, end: int) -> "NumpyVectorStore":
+        """
+        Rows [start, end) as a read-only store of their own, numbered from 0, sharing this
+        store's memory. Modifying the slice works on a private copy.
+        """
+        vectors = self._vectors[start:end]
+        vectors.flags.writeable = False
+        return NumpyVectorStore(self.d, self.encoding, vectors)
+
+    def astype(self, encoding: str) -> "NumpyVectorStore":
+        """Copy of the store with its vectors in another encoding."""
+        return NumpyVectorStore(self.d, encoding, self._vectors.astype(_DTYPES[encoding]))
+
+    def _iter_blocks(self, ids: Optional[np.ndarray]):
+        """:return: Generator of (row IDs, float32 rows), over every row or only the given IDs"""
+        if ids is None:
+            for start in range(0, len(self._vectors), NUMPY_SEARCH_BLOCK_ROWS):
+                block = self._vectors[start:start + NUMPY_SEARCH_BLOCK_ROWS]
+                yield np.arange(start, start + len(block), dtype='int64'), block.astype('float32', copy=False)
+            return
+        ids = np.asarray(ids, dtype='int64')
+        ids = ids[(ids >= 0) & (ids < len(self._vectors))]
+        for start in range(0, len(ids), NUMPY_SEARCH_BLOCK_ROWS):
+            block_ids = ids[start:start + NUMPY_SEARCH_BLOCK_ROWS]
+            yield block_ids, self._vectors[block_ids].astype('float32', copy=False)
+
+    def search(self, x: np.ndarray, k: int, ids: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Exact k nearest neighbours by squared L2 distance, nearest first.
+        :param ids: Optional chunk IDs to search among; only their rows are read and scored
+        :return: (distances, IDs), each of shape (number of queries, k)
+        """
+        x = np.asarray(x, dtype='float32').reshape(-1, self.d)
+        num_queries = len(x)
+        best_distances = np.zeros((num_queries, 0), dtype='float32')
+        best_ids = np.zeros((num_queries, 0), dtype='int64')
+        if k <= 0:
+            return best_distances, best_ids
+        query_norms = np.einsum('ij,ij->i', x, x)[:, None]
+        norms = self._squared_norms()
+
+        # Score one block of stored vectors at a time and keep the running top k
+        for row_ids, block in self._iter_blocks(ids):
+            block_norms = norms[row_ids]
+            products = x @ block.T
+            if not np.isfinite(block_norms).all():
+                # Placeholder rows score NaN; their infinite norm keeps them out of the results
+                products = np.nan_to_num(products)
+            block_ids = np.broadcast_to(row_ids, products.shape)
+            distances = np.hstack([best_distances, query_norms - 2.0 * products + block_norms])
+            ids_so_far = np.hstack([best_ids, block_ids])
+            if distances.shape[1] > k:
+                top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+                distances = np.take_along_axis(distances, top, axis=1)
+                ids_so_far = np.take_along_axis(ids_so_far, top, axis=1)
+            best_distances, best_ids = distances, ids_so_far
+
+        order = np.argsort(best_distances, axis=1, kind='stable')
+        best_distances = np.maximum(np.take_along_axis(best_distances, order, axis=1), 0.0).astype('float32')
+        best_ids = np.take_along_axis(best_ids, order, axis=1)
+        if best_ids.shape[1] < k:
+            missing = k - best_ids.shape[1]
+            best_distances = np.hstack([best_distances, np.full((num_queries, missing), np.inf, dtype='float32')])
+            best_ids = np.hstack([best_ids, np.full((num_queries, missing), _MISSING_ID, dtype='int64')])
+        # Like FAISS, slots without a stored vector get ID -1
+        unfilled = ~np.isfinite(best_distances)
+        best_distances[unfilled] = _MISSING_DISTANCE
+        best_ids[unfilled] = _MISSING_ID
+        return best_distances, best_ids
+
+    def search_and_reconstruct(self, x: np.ndarray, k: int,
+                               ids: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """:return: (distances, IDs, stored vectors as float32 of shape (queries, k, d))"""
+        distances, ids = self.search(x, k, ids)
+        vectors = np.zeros(ids.shape + (self.d,), dtype='float32')
+        found = ids >= 0
+        if found.any():
+            vectors[found] = self._vectors[ids[found]]
+        return distances, ids, vectors
+
+    def reconstruct(self, key: int) -> np.ndarray:
+        if not 0 <= key < len(self._vectors) or not np.isfinite(self._squared_norms()[key]):
+            raise KeyError(f"ID {key} not found in the vector store")
+        return self._vectors[key].astype('float32')
+
+    def to_bytes(self) -> bytes:
+        buffer = io.BytesIO()
+        np.save(buffer, self._vectors, allow_pickle=False)
+        return buffer.getvalue()
+
+    def save(self, path: str) -> None:
+        """Write the store atomically, so processes that have the old file mapped keep a valid copy."""
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.save(f, self._vectors, allow_pickle=False)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def _from_array(cls, vectors: np.ndarray) -> "NumpyVectorStore":
+        encoding = next((name for name, dtype in _DTYPES.items() if dtype == vectors.dtype), None)
+        if vectors.ndim != 2 or encoding is None:
+            raise ValueError("Not a vector store array")
+        return cls(vectors.shape[1], encoding, vectors)
+
+    @classmethod
+    def open(cls, path: str, mmap: bool = False) -> "NumpyVectorStore":
+        """Load a saved store; with mmap=True vectors are paged in from the file on use."""
+        return cls._from_array(np.load(path, mmap_mode='r' if mmap else None, allow_pickle=False))
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "NumpyVectorStore":
+        return cls._from_array(np.load(io.BytesIO(data), allow_pickle=False))
+
+
+def load_vector_store_from_s3(bucket_name: str, key: str, immutable: bool = False,
+                              mmap: bool = False) -> Tuple[Optional[NumpyVectorStore], int]:
+    """
+    Open a vectors.npy object, through the local artifact cache where it can be memory-mapped.
+    :return: (NumpyVectorStore or None if the object does not exist, bytes it occupies)
+    """
+    if ARTIFACT_CACHE_ENABLED:
+        path = get_local_artifact_path(bucket_name, key, immutable=immutable)
+        if path is None:
+            return None, 0
+        return NumpyVectorStore.open(path, mmap=mmap), os.path.getsize(path)
+    data = s3_utils.read_binary_from_s3_if_exists(bucket_name, key)
+    if data is None:
+        return None, 0
+    return NumpyVectorStore.from_bytes(data), len(data)
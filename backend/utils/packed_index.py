@@ -0,0 +1,453 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import utils.s3_utils as s3_utils
+from utils.artifact_cache import ARTIFACT_CACHE_ENABLED, read_artifact_bytes, remove_local_artifacts
+from utils.bm25_index import BM25Index
+from utils.chunk_provenance import ChunkProvenance
+from utils.chunk_store import ChunkStore, encode_chunk_store, load_chunk_store_from_s3
+from utils.index_manifest import (get_version_prefix, manifest_artifact_prefix, new_index_version,
+                                  publish_index_manifest, read_index_manifest)
+from utils.numpy_vector_store import (NUMPY_VECTOR_ENCODING, NumpyVectorStore, VECTOR_STORE_NAME,
+                                      load_vector_store_from_s3)
+from utils.redis_utils import redis_lock
+
+logger = logging.getLogger(__name__)
+
+# Store courses of at most PACKED_INDEX_MAX_CHUNKS chunks in shared shards instead of their own artifacts
+PACKED_INDEX_ENABLED = os.getenv("PACKED_INDEX_ENABLED", "false").lower() == "true"
+PACKED_INDEX_MAX_CHUNKS = int(os.getenv("PACKED_INDEX_MAX_CHUNKS", "50"))
+# Courses are spread over this many shards by a hash of their folder; every build of a
+# packed course republishes its shard's directory, so more shards mean smaller directories but more loads
+PACKED_INDEX_SHARDS = int(os.getenv("PACKED_INDEX_SHARDS", "16"))
+PACKED_INDEX_PREFIX = "packed_index/"
+# A shard's live segments are merged into one once there are more than this many of them,
+# or once rows of removed and replaced courses are PACKED_SHARD_COMPACT_RATIO of their rows
+PACKED_SHARD_MAX_SEGMENTS = int(os.getenv("PACKED_SHARD_MAX_SEGMENTS", "8"))
+PACKED_SHARD_COMPACT_RATIO = float(os.getenv("PACKED_SHARD_COMPACT_RATIO", "0.5"))
+# Seconds a build waits for another process to finish writing the same shard
+PACKED_SHARD_LOCK_WAIT = float(os.getenv("PACKED_SHARD_LOCK_WAIT", "60"))
+PACKED_SHARD_LOCK_TTL = 300
+PACKED_SHARD_DIRECTORY_NAME = "shard_directory.json"
+PACKED_SEGMENTS_FOLDER = "segments/"
+PACKED_COURSES_FOLDER = "courses/"
+PACKED_SEGMENT_ARTIFACT_NAMES = ("chunks.bin", VECTOR_STORE_NAME)
+
+_shards: Dict[Tuple[str, int], "PackedShard"] = {}
+_segments: Dict[Tuple[str, int, str], "PackedSegment"] = {}
+_shards_lock = threading.Lock()
+_write_locks = [threading.Lock() for _ in range(max(1, PACKED_INDEX_SHARDS))]
+
+
+def should_pack(num_chunks: int) -> bool:
+    """Whether a course of num_chunks chunks (including placeholders of removed ones) is stored in a shard."""
+    return PACKED_INDEX_ENABLED and 0 < num_chunks <= PACKED_INDEX_MAX_CHUNKS
+
+
+def shard_of(course_key: str) -> int:
+    """Shard a course folder such as user_data/{user}/{course}/ is stored in."""
+    digest = hashlib.sha256(course_key.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % max(1, PACKED_INDEX_SHARDS)
+
+
+def get_shard_key(shard: int) -> str:
+    return f"{PACKED_INDEX_PREFIX}shard_{shard:03d}/"
+
+
+def _segment_prefix(shard: int, segment: str) -> str:
+    return f"{get_shard_key(shard)}{PACKED_SEGMENTS_FOLDER}{segment}/"
+
+
+def _course_metadata_key(shard: int, course_key: str, version: str) -> str:
+    folder = hashlib.sha256(course_key.encode('utf-8')).hexdigest()[:16]
+    return f"{get_shard_key(shard)}{PACKED_COURSES_FOLDER}{folder}/{version}.json"
+
+
+class PackedShard:
+    """
+    Directory of a shard version. Chunks and vectors live in immutable segments, each a
+    chunk store and a vector store, and every course owns the contiguous row range
+    [start, end) of one segment. A course's small indices live in a metadata object of
+    its own, so publishing a course writes its segment, its metadata and this directory,
+    never the bytes of the shard's other courses.
+    """
+
+    def __init__(self, courses: Dict[str, Dict], segments: Dict[str, Dict], dimension: Optional[int],
+                 retired: Optional[List[str]] = None, version: Optional[str] = None):
+        self.courses = courses
+        self.segments = segments
+        self.dimension = dimension
+        # Keys this version stopped referencing; the previous version still reads them
+        self.retired = retired or []
+        self.version = version
+
+    @property
+    def num_rows(self) -> int:
+        return sum(segment["rows"] for segment in self.segments.values())
+
+    @property
+    def live_rows(self) -> int:
+        return sum(course["end"] - course["start"] for course in self.courses.values())
+
+    def to_json(self) -> Dict:
+        return {"dimension": self.dimension, "segments": self.segments, "courses": self.courses,
+                "retired": self.retired}
+
+    @classmethod
+    def from_json(cls, data: Dict, version: Optional[str] = None) -> "PackedShard":
+        return cls(data["courses"], data["segments"], data.get("dimension"), data.get("retired"), version)
+
+
+class PackedSegment:
+    """Chunk texts and vectors of one segment; never modified once uploaded."""
+
+    def __init__(self, chunks: ChunkStore, vectors: Optional[NumpyVectorStore]):
+        self.chunks = chunks
+        self.vectors = vectors
+
+
+class PackedCourse:
+    """One course of a shard, with chunk and vector IDs numbered from 0 like an unpacked course."""
+
+    def __init__(self, chunks: ChunkStore, vectors: Optional[NumpyVectorStore], inverted_index: Dict[str, int],
+                 bm25_index: BM25Index, provenance: ChunkProvenance, sources: Dict[str, Dict], version: str,
+                 shard_version: Optional[str] = None):
+        self.chunks = chunks
+        self.vectors = vectors
+        self.inverted_index = inverted_index
+        self.bm25_index = bm25_index
+        self.provenance = provenance
+        self.sources = sources
+        self.version = version
+        # Shard version the chunk and vector views belong to
+        self.shard_version = shard_version
+
+
+def _load_directory(bucket_name: str, shard: int, prefix: str, version: str) -> Optional[PackedShard]:
+    data = read_artifact_bytes(bucket_name, f"{prefix}{PACKED_SHARD_DIRECTORY_NAME}", immutable=True)
+    if data is None:
+        logger.error(f"Packed index shard {shard} version {version} has no directory")
+        return None
+    return PackedShard.from_json(json.loads(data), version)
+
+
+def _load_segment(bucket_name: str, shard: int, segment: str, mmap: bool = True) -> Optional[PackedSegment]:
+    prefix = _segment_prefix(shard, segment)
+    chunks = load_chunk_store_from_s3(bucket_name, f"{prefix}chunks.bin", immutable=True)
+    if chunks is None:
+        logger.error(f"Segment {segment} of packed index shard {shard} is missing")
+        return None
+    vectors, _ = load_vector_store_from_s3(bucket_name, f"{prefix}{VECTOR_STORE_NAME}", immutable=True, mmap=mmap)
+    return PackedSegment(chunks, vectors)
+
+
+def get_shard_version(bucket_name: str, shard: int) -> Optional[str]:
+    """Version the shard's manifest currently names, or None if the shard was never written."""
+    base_key = get_shard_key(shard)
+    return manifest_artifact_prefix(base_key, read_index_manifest(bucket_name, base_key))[1]
+
+
+def get_shard(bucket_name: str, shard: int) -> Optional[PackedShard]:
+    """
+    The directory of a shard's current version, loaded once per process and version.
+    :return: PackedShard, or None if the shard was never written
+    """
+    base_key = get_shard_key(shard)
+    prefix, version = manifest_artifact_prefix(base_key, read_index_manifest(bucket_name, base_key))
+    if version is None:
+        return None
+    key = (bucket_name, shard)
+    with _shards_lock:
+        cached = _shards.get(key)
+    if cached is not None and cached.version == version:
+        return cached
+
+    loaded = _load_directory(bucket_name, shard, prefix, version)
+    if loaded is None:
+        return cached
+    with _shards_lock:
+        _shards[key] = loaded
+        dropped = [segment for (bucket, shard_id, segment) in _segments
+                   if bucket == bucket_name and shard_id == shard and segment not in loaded.segments]
+        for segment in dropped:
+            del _segments[(bucket_name, shard, segment)]
+    if ARTIFACT_CACHE_ENABLED:
+        # Courses still reading dropped segments keep their memory maps
+        stale = [f"{_segment_prefix(shard, segment)}{name}"
+                 for segment in dropped for name in PACKED_SEGMENT_ARTIFACT_NAMES]
+        if cached is not None:
+            stale.append(f"{get_version_prefix(base_key, cached.version)}{PACKED_SHARD_DIRECTORY_NAME}")
+        remove_local_artifacts(bucket_name, stale)
+    logger.info(f"Loaded packed index shard {shard} version {version}: {len(loaded.courses)} courses "
+                f"in {len(loaded.segments)} segments")
+    return loaded
+
+
+def _get_segment(bucket_name: str, shard: int, segment: str) -> Optional[PackedSegment]:
+    """A segment of a shard, loaded once per process; segments are never modified."""
+    key = (bucket_name, shard, segment)
+    with _shards_lock:
+        cached = _segments.get(key)
+    if cached is not None:
+        return cached
+    start_time = time.time()
+    loaded = _load_segment(bucket_name, shard, segment)
+    if loaded is None:
+        return None
+    with _shards_lock:
+        loaded = _segments.setdefault(key, loaded)
+    logger.info(f"Loaded segment {segment} of packed index shard {shard}: {len(loaded.chunks)} chunks "
+                f"in {time.time() - start_time:.2f} seconds")
+    return loaded
+
+
+def open_packed_course(bucket_name: str, shard: int, course_key: str) -> Optional[PackedCourse]:
+    """
+    A course's part of its shard: chunk texts and vectors are views of the rows [start, end)
+    of its segment, so searching the course only scores its own vectors.
+    :return: PackedCourse, or None if the shard does not hold the course
+    """
+    packed_shard = get_shard(bucket_name, shard)
+    course = packed_shard.courses.get(course_key) if packed_shard is not None else None
+    if course is None:
+        return None
+    segment = _get_segment(bucket_name, shard, course["segment"])
+    metadata_data = read_artifact_bytes(bucket_name, course["metadata"], immutable=True)
+    if segment is None or metadata_data is None:
+        logger.error(f"Packed index shard {shard} version {packed_shard.version} is incomplete for {course_key}")
+        return None
+    metadata = json.loads(metadata_data)
+    start, end = course["start"], course["end"]
+    vectors = segment.vectors.slice(start, end) if segment.vectors is not None else None
+    return PackedCourse(segment.chunks.slice(start, end), vectors, dict(metadata["inverted_index"]),
+                        BM25Index.from_json(metadata["bm25_index"]), ChunkProvenance.from_json(metadata["provenance"]),
+                        metadata["sources"], course["version"], packed_shard.version)
+
+
+@contextmanager
+def _locked_shard(shard: int):
+    """Serialize writers of a shard: across threads with a lock, across processes through Redis when reachable."""
+    with _write_locks[shard % len(_write_locks)]:
+        with redis_lock(f"{PACKED_INDEX_PREFIX}lock:{shard}", PACKED_SHARD_LOCK_TTL, PACKED_SHARD_LOCK_WAIT):
+            yield
+
+
+def _load_shard_for_update(bucket_name: str, shard: int) -> Tuple[PackedShard, List[str]]:
+    """
+    The directory of the shard's current version in mutable form, or an empty directory.
+    :return: (directory, keys the current version retired), the latter to be deleted once
+        the next version is published, when no retained version references them any more
+    """
+    base_key = get_shard_key(shard)
+    prefix, version = manifest_artifact_prefix(base_key, read_index_manifest(bucket_name, base_key))
+    loaded = _load_directory(bucket_name, shard, prefix, version) if version is not None else None
+    if loaded is None:
+        return PackedShard({}, {}, None), []
+    expired = loaded.retired
+    loaded.retired = []
+    return loaded, expired
+
+
+def _upload_segment(bucket_name: str, shard: int, chunks: Sequence[str], vectors: NumpyVectorStore) -> Optional[str]:
+    """Upload rows as a new segment. :return: The segment's name, or None if the upload failed"""
+    segment = new_index_version()
+    prefix = _segment_prefix(shard, segment)
+    uploaded = s3_utils.upload_bytes_to_s3(encode_chunk_store(chunks), bucket_name, f"{prefix}chunks.bin")
+    uploaded = uploaded and s3_utils.upload_bytes_to_s3(vectors.to_bytes(), bucket_name,
+                                                        f"{prefix}{VECTOR_STORE_NAME}")
+    if not uploaded:
+        _delete_keys(bucket_name, [prefix])
+        return None
+    return segment
+
+
+def _delete_keys(bucket_name: str, keys: Sequence[str]) -> None:
+    """Delete segments, named by their prefix, and course metadata objects."""
+    for key in keys:
+        if key.endswith('/'):
+            s3_utils.delete_folder_from_s3(bucket_name, key)
+        else:
+            s3_utils.delete_file_from_s3(bucket_name, key)
+
+
+def _drop_course(packed_shard: PackedShard, shard: int, course_key: str) -> None:
+    """Stop referencing a course's rows and metadata, and its segment once no course uses it."""
+    course = packed_shard.courses.pop(course_key, None)
+    if course is None:
+        return
+    packed_shard.retired.append(course["metadata"])
+    if not any(other["segment"] == course["segment"] for other in packed_shard.courses.values()):
+        packed_shard.segments.pop(course["segment"], None)
+        packed_shard.retired.append(_segment_prefix(shard, course["segment"]))
+
+
+def _needs_compaction(packed_shard: PackedShard) -> bool:
+    return (len(packed_shard.segments) > PACKED_SHARD_MAX_SEGMENTS
+            or packed_shard.live_rows < (1 - PACKED_SHARD_COMPACT_RATIO) * packed_shard.num_rows)
+
+
+def _compact(bucket_name: str, shard: int, packed_shard: PackedShard) -> bool:
+    """
+    Merge the rows of the shard's courses into one new segment, keeping each course's rows
+    contiguous. Course metadata objects are left as they are.
+    :return: True if the merged segment was uploaded
+    """
+    chunks: List[str] = []
+    vectors = NumpyVectorStore(packed_shard.dimension, NUMPY_VECTOR_ENCODING)
+    placements = {}
+    loaded_segments = {}
+    for course_key, course in sorted(packed_shard.courses.items(), key=lambda item: (item[1]["segment"],
+                                                                                     item[1]["start"])):
+        name = course["segment"]
+        if name not in loaded_segments:
+            loaded_segments[name] = _load_segment(bucket_name, shard, name)
+            if loaded_segments[name] is None or loaded_segments[name].vectors is None:
+                return False
+        segment = loaded_segments[name]
+        start, end = course["start"], course["end"]
+        new_start = len(chunks)
+        chunks.extend(segment.chunks[start:end])
+        vectors.add_store(segment.vectors.slice(start, end), new_start)
+        placements[course_key] = (new_start, new_start + end - start)
+
+    merged = _upload_segment(bucket_name, shard, chunks, vectors)
+    if merged is None:
+        return False
+    logger.info(f"Compacted packed index shard {shard} from {len(packed_shard.segments)} segments of "
+                f"{packed_shard.num_rows} rows to one of {len(chunks)} rows")
+    packed_shard.retired.extend(_segment_prefix(shard, name) for name in packed_shard.segments)
+    packed_shard.segments = {merged: {"rows": len(chunks)}}
+    for course_key, (start, end) in placements.items():
+        packed_shard.courses[course_key].update(segment=merged, start=start, end=end)
+    return True
+
+
+def _upload_shard(bucket_name: str, shard: int, packed_shard: PackedShard, expired: List[str]) -> bool:
+    """
+    Upload the shard's directory as a new version and publish it, then delete the keys the
+    replaced version had retired.
+    """
+    base_key = get_shard_key(shard)
+    version = new_index_version()
+    prefix = get_version_prefix(base_key, version)
+    if not s3_utils.upload_json_to_s3(packed_shard.to_json(), bucket_name, f"{prefix}{PACKED_SHARD_DIRECTORY_NAME}"):
+        logger.error(f"Error uploading packed index shard {shard} version {version}")
+        return False
+    if not publish_index_manifest(bucket_name, base_key, version,
+                                  {"num_chunks": packed_shard.live_rows, "courses": len(packed_shard.courses)}):
+        return False
+    packed_shard.version = version
+    _delete_keys(bucket_name, expired)
+    return True
+
+
+def publish_course(bucket_name: str, course_key: str, version: str, chunks: Sequence[str],
+                   vectors: NumpyVectorStore, inverted_index: Dict[str, int], bm25_index: BM25Index,
+                   sources: Dict[str, Dict], provenance: ChunkProvenance,
+                   publish_manifest: Callable[[int], bool]) -> Optional[int]:
+    """
+    Write a course into its shard as a new segment and metadata object, replacing the
+    course's previous ones, and publish the shard, then the course's own manifest naming
+    it, both under the shard lock so the two always agree on the course's version.
+    :param vectors: The course's vectors, row i holding chunk ID i
+    :param publish_manifest: Called with the shard to publish the course's manifest; returns success
+    :return: The shard, or None if the course could not be packed, in which case callers
+        store its artifacts unpacked
+    """
+    shard = shard_of(course_key)
+    try:
+        with _locked_shard(shard):
+            packed_shard, expired = _load_shard_for_update(bucket_name, shard)
+            _drop_course(packed_shard, shard, course_key)
+            if not packed_shard.courses:
+                packed_shard.dimension = vectors.d
+            if packed_shard.dimension != vectors.d:
+                logger.warning(f"Packed index shard {shard} has dimension {packed_shard.dimension}, "
+                               f"course {course_key} has {vectors.d}; not packing the course")
+                return None
+
+            # Chunk IDs of the course map to segment rows; removed chunks keep their empty rows
+            if vectors.encoding != NUMPY_VECTOR_ENCODING:
+                vectors = vectors.astype(NUMPY_VECTOR_ENCODING)
+            segment = _upload_segment(bucket_name, shard, chunks, vectors)
+            if segment is None:
+                return None
+            metadata_key = _course_metadata_key(shard, course_key, version)
+            metadata = {
+                "inverted_index": inverted_index,
+                "bm25_index": bm25_index.to_json(),
+                "provenance": provenance.to_json(),
+                "sources": sources,
+            }
+            if not s3_utils.upload_json_to_s3(metadata, bucket_name, metadata_key):
+                _delete_keys(bucket_name, [_segment_prefix(shard, segment)])
+                return None
+            packed_shard.segments[segment] = {"rows": len(chunks)}
+            packed_shard.courses[course_key] = {
+                "segment": segment,
+                "start": 0,
+                "end": len(chunks),
+                "version": version,
+                "metadata": metadata_key,
+            }
+            if _needs_compaction(packed_shard) and not _compact(bucket_name, shard, packed_shard):
+                logger.warning(f"Could not compact packed index shard {shard}; publishing it uncompacted")
+            if not _upload_shard(bucket_name, shard, packed_shard, expired):
+                _delete_keys(bucket_name, [_segment_prefix(shard, segment), metadata_key])
+                return None
+            if not publish_manifest(shard):
+                # Callers store the course unpacked instead, so its rows must not stay behind
+                expired, packed_shard.retired = packed_shard.retired, []
+                _drop_course(packed_shard, shard, course_key)
+                _upload_shard(bucket_name, shard, packed_shard, expired)
+                return None
+    except Exception as e:
+        logger.exception(f"Could not pack course {course_key} into shard {shard}: {e}")
+        return None
+    logger.info(f"Packed {len(chunks)} chunks of {course_key} into shard {shard}")
+    return shard
+
+
+def remove_course(bucket_name: str, shard: int, course_key: str, purge: bool = False) -> bool:
+    """
+    Drop a course from a shard, e.g. once it has grown past PACKED_INDEX_MAX_CHUNKS.
+    :param purge: Delete the course's rows and metadata now rather than once the shard is next
+        published, rewriting the segment it shares with other courses if any
+    """
+    try:
+        with _locked_shard(shard):
+            packed_shard, expired = _load_shard_for_update(bucket_name, shard)
+            course = packed_shard.courses.get(course_key)
+            if course is None:
+                return True
+            _drop_course(packed_shard, shard, course_key)
+            shared = course["segment"] in packed_shard.segments
+            if packed_shard.courses and (_needs_compaction(packed_shard) or (purge and shared)):
+                if not _compact(bucket_name, shard, packed_shard) and purge:
+                    return False
+            if not _upload_shard(bucket_name, shard, packed_shard, expired):
+                return False
+            if purge:
+                _delete_keys(bucket_name, [course["metadata"], _segment_prefix(shard, course["segment"])])
+            return True
+    except Exception as e:
+        logger.exception(f"Could not remove course {course_key} from shard {shard}: {e}")
+        return False
+
+
+def remove_deleted_course(bucket_name: str, course_key: str) -> bool:
+    """
+    Drop a course that is being deleted from the shard its manifest names. Call before deleting
+    the course folder, which holds the manifest; the shard keeps the course's rows otherwise.
+    :return: False if the course is packed and could not be removed from its shard
+    """
+    manifest = read_index_manifest(bucket_name, course_key) or {}
+    if manifest.get("packed_shard") is None:
+        return True
+    return remove_course(bucket_name, manifest["packed_shard"], course_key, purge=True)
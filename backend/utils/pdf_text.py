@@ -0,0 +1,47 @@
+import io
+from typing import Optional
+
+from utils.s3_utils import read_binary_from_s3, upload_bytes_to_s3
+
+# Try to import pypdf, make it optional
+try:
+    from pypdf import PdfReader
+    PDF_TEXT_AVAILABLE = True
+except ImportError:
+    print("Warning: pypdf not available. Uploaded PDFs will not be indexed.")
+    PDF_TEXT_AVAILABLE = False
+    PdfReader = None
+
+
+def pdf_text_key(pdf_key: str) -> str:
+    """
+    Key of the text extracted from a PDF. It sits next to the PDF, so full course builds,
+    which index every .txt file of the course, pick it up like any other text file.
+    """
+    return f"{pdf_key}.txt"
+
+
+def extract_pdf_text_to_s3(bucket_name: str, pdf_key: str) -> Optional[str]:
+    """
+    Extract the text of an uploaded PDF and store it at pdf_text_key(pdf_key).
+    :return: The key of the extracted text, or None if the PDF has no extractable text
+    """
+    if not PDF_TEXT_AVAILABLE:
+        return None
+    data = read_binary_from_s3(bucket_name, pdf_key)
+    if data is None:
+        return None
+    try:
+        reader = PdfReader(io.BytesIO(data))
+        pages = [page.extract_text() or "" for page in reader.pages]
+    except Exception as e:
+        print(f"Error extracting text from {pdf_key}: {str(e)}")
+        return None
+    text = "\n\n".join(page.strip() for page in pages if page.strip())
+    if not text:
+        print(f"No extractable text in {pdf_key}")
+        return None
+    text_key = pdf_text_key(pdf_key)
+    if not upload_bytes_to_s3(text.encode('utf-8'), bucket_name, text_key, content_type='text/plain; charset=utf-8'):
+        return None
+    return text_key
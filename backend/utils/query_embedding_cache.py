@@ -0,0 +1,179 @@
+import os
+import time
+import asyncio
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from utils.embedding_engine import EMBEDDING_MODEL, aembed_query, embed_query
+from utils.redis_utils import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "2048"))
+QUERY_EMBEDDING_CACHE_TTL = int(os.getenv("QUERY_EMBEDDING_CACHE_TTL", str(24 * 3600)))
+# Share embeddings between workers through the Redis instance used for slide navigation
+QUERY_EMBEDDING_CACHE_REDIS = os.getenv("QUERY_EMBEDDING_CACHE_REDIS", "false").lower() == "true"
+QUERY_EMBEDDING_REDIS_PREFIX = "query_embedding:"
+
+
+def normalize_query(query: str) -> str:
+    """Lowercase, collapse whitespace and drop trailing punctuation."""
+    return " ".join(query.lower().split()).rstrip("?!. ")
+
+
+class QueryEmbeddingCache:
+    """
+    LRU cache of query embeddings with a time-to-live, keyed by
+    (model, dimension, normalized query). Misses in process memory fall back to
+    an optional shared Redis tier before calling the embeddings API.
+    """
+
+    def __init__(self, max_entries: int = QUERY_EMBEDDING_CACHE_SIZE, ttl: int = QUERY_EMBEDDING_CACHE_TTL,
+                 redis_client=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.redis_client = redis_client
+        self._entries: "OrderedDict[Tuple[str, int, str], Tuple[np.ndarray, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _redis_key(self, key: Tuple[str, int, str]) -> str:
+        model, dimension, query = key
+        digest = hashlib.sha256(query.encode('utf-8')).hexdigest()
+        return f"{QUERY_EMBEDDING_REDIS_PREFIX}{model}:{dimension}:{digest}"
+
+    def _get_local(self, key) -> Optional[np.ndarray]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            vector, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                self.expirations += 1
+                return None
+            self._entries.move_to_end(key)
+            return vector
+
+    def _put_local(self, key, vector: np.ndarray) -> None:
+        with self._lock:
+            self._entries[key] = (vector, time.time() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def _get_redis(self, key, dimension: int) -> Optional[np.ndarray]:
+        if self.redis_client is None:
+            return None
+        try:
+            blob = self.redis_client.get(self._redis_key(key))
+        except Exception as e:
+            logger.warning(f"Query embedding cache Redis read failed: {e}")
+            return None
+        if blob is None or len(blob) != dimension * 4:
+            return None
+        return np.frombuffer(blob, dtype='<f4').reshape(1, -1)
+
+    def _put_redis(self, key, vector: np.ndarray) -> None:
+        if self.redis_client is None:
+            return
+        try:
+            self.redis_client.setex(self._redis_key(key), self.ttl, vector.astype('<f4').tobytes())
+        except Exception as e:
+            logger.warning(f"Query embedding cache Redis write failed: {e}")
+
+    def _lookup(self, key, dimension: int) -> Optional[np.ndarray]:
+        """Check process memory, then Redis, counting the outcome."""
+        vector = self._get_local(key)
+        if vector is not None:
+            with self._lock:
+                self.hits += 1
+            return vector
+
+        vector = self._get_redis(key, dimension)
+        with self._lock:
+            if vector is not None:
+                self.redis_hits += 1
+            else:
+                self.misses += 1
+        if vector is not None:
+            self._put_local(key, vector)
+        return vector
+
+    def _store(self, key, vector: np.ndarray) -> None:
+        self._put_local(key, vector)
+        self._put_redis(key, vector)
+
+    def get_embedding(self, client, query: str, dimension: int, model: str = EMBEDDING_MODEL) -> np.ndarray:
+        """Return the (1, dimension) embedding of query, calling the API only on a miss in every tier."""
+        key = (model, dimension, normalize_query(query))
+        vector = self._lookup(key, dimension)
+        if vector is None:
+            vector = embed_query(client, query, dimension, model)
+            self._store(key, vector)
+        return vector
+
+    async def aget_embedding(self, async_client, query: str, dimension: int,
+                             model: str = EMBEDDING_MODEL) -> np.ndarray:
+        """Async variant of get_embedding; Redis round trips run in a worker thread."""
+        key = (model, dimension, normalize_query(query))
+        vector = self._get_local(key)
+        if vector is not None:
+            with self._lock:
+                self.hits += 1
+            return vector
+        vector = await asyncio.to_thread(self._lookup, key, dimension)
+        if vector is None:
+            vector = await aembed_query(async_client, query, dimension, model)
+            await asyncio.to_thread(self._store, key, vector)
+        return vector
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.redis_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                "redis_enabled": self.redis_client is not None,
+                "hits": self.hits,
+                "redis_hits": self.redis_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_rate": (self.hits + self.redis_hits) / lookups if lookups else 0.0,
+            }
+
+
+_query_embedding_cache = QueryEmbeddingCache(
+    redis_client=get_redis_client() if QUERY_EMBEDDING_CACHE_REDIS else None
+)
+
+
+def get_query_embedding_cache() -> QueryEmbeddingCache:
+    """Return the process-wide query embedding cache."""
+    return _query_embedding_cache
+
+
+def get_query_embedding(client, query: str, dimension: int) -> np.ndarray:
+    """Embed a retrieval query through the process-wide cache."""
+    return _query_embedding_cache.get_embedding(client, query, dimension)
+
+
+async def aget_query_embedding(async_client, query: str, dimension: int) -> np.ndarray:
+    """Async variant of get_query_embedding."""
+    return await _query_embedding_cache.aget_embedding(async_client, query, dimension)
@@ -0,0 +1,89 @@
+import os
+import sys
+import heapq
+from collections import Counter
+from difflib import SequenceMatcher
+from typing import Dict, Iterable, List, Optional, Set
+
+QUOTE_NGRAM_SIZE = 3
+# Number of n-gram candidates scored with SequenceMatcher per query
+QUOTE_MATCH_CANDIDATES = int(os.getenv("QUOTE_MATCH_CANDIDATES", "32"))
+
+
+def _ngrams(text: str, n: int) -> Set[str]:
+    padded = f" {text} "
+    if len(padded) <= n:
+        return {padded}
+    return {padded[i:i + n] for i in range(len(padded) - n + 1)}
+
+
+class QuoteIndex:
+    """
+    Character n-gram index over the quotes of an inverted index. A query first
+    shortlists the quotes sharing the most n-grams with it, and only those are
+    scored with SequenceMatcher.ratio(), so thresholds keep their meaning from
+    the previous full scan.
+    """
+
+    def __init__(self, quotes: Iterable[str] = (), n: int = QUOTE_NGRAM_SIZE):
+        self.n = n
+        self.quotes: List[str] = []
+        self.gram_counts: List[int] = []
+        self.postings: Dict[str, List[int]] = {}
+        for quote in quotes:
+            self.add(quote)
+
+    def add(self, quote: str) -> None:
+        quote_id = len(self.quotes)
+        grams = _ngrams(quote, self.n)
+        self.quotes.append(quote)
+        self.gram_counts.append(len(grams))
+        for gram in grams:
+            self.postings.setdefault(gram, []).append(quote_id)
+
+    @property
+    def nbytes(self) -> int:
+        """Approximate resident size, used for course cache accounting."""
+        size = sys.getsizeof(self.postings) + sys.getsizeof(self.gram_counts)
+        for gram, ids in self.postings.items():
+            size += sys.getsizeof(gram) + sys.getsizeof(ids) + 8 * len(ids)
+        return size
+
+    def candidates(self, query: str, threshold: float, limit: int = QUOTE_MATCH_CANDIDATES) -> List[int]:
+        """IDs of the quotes with the highest n-gram Dice coefficient against query."""
+        query_grams = _ngrams(query, self.n)
+        shared = Counter()
+        for gram in query_grams:
+            ids = self.postings.get(gram)
+            if ids:
+                shared.update(ids)
+
+        scored = []
+        for quote_id, count in shared.items():
+            # ratio() is at most 2 * min(len) / (sum of lens), so skip quotes whose
+            # length alone rules out reaching the threshold
+            quote_length = len(self.quotes[quote_id])
+            if 2 * min(len(query), quote_length) < threshold * (len(query) + quote_length):
+                continue
+            scored.append((2 * count / (len(query_grams) + self.gram_counts[quote_id]), quote_id))
+        return [quote_id for _, quote_id in heapq.nlargest(limit, scored)]
+
+    def best_match(self, query: str, threshold: float, limit: int = QUOTE_MATCH_CANDIDATES) -> Optional[str]:
+        """
+        Return the shortlisted quote with the highest SequenceMatcher ratio against
+        query, if it reaches threshold. Ties go to the earliest indexed quote, as in
+        a scan over the inverted index.
+        """
+        best_quote = None
+        best_score = 0
+        for quote_id in sorted(self.candidates(query, threshold, limit)):
+            matcher = SequenceMatcher(None, query, self.quotes[quote_id])
+            # Cheap upper bounds on ratio() before the quadratic match
+            floor = max(threshold, best_score)
+            if matcher.real_quick_ratio() < floor or matcher.quick_ratio() < floor:
+                continue
+            similarity = matcher.ratio()
+            if similarity > best_score and similarity >= threshold:
+                best_score = similarity
+                best_quote = self.quotes[quote_id]
+        return best_quote
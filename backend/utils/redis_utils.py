@@ -0,0 +1,118 @@
+import os
+import time
+import uuid
+import logging
+import threading
+from contextlib import contextmanager
+
+# Try to import redis, make it optional
+try:
+    import redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+# Shared with slides_navigation, which keeps slide positions in this instance
+REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+REDIS_DB = int(os.getenv("REDIS_DB", "0"))
+
+_redis_client = None
+_redis_lock = threading.Lock()
+
+
+def get_redis_client():
+    """Return the shared Redis client, or None if redis is not installed."""
+    global _redis_client
+    if not REDIS_AVAILABLE:
+        return None
+    if _redis_client is None:
+        with _redis_lock:
+            if _redis_client is None:
+                # Short timeouts: callers treat Redis as an optional cache tier
+                _redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB,
+                                            socket_timeout=0.5, socket_connect_timeout=0.5)
+    return _redis_client
+
+
+# Deletes a lock only if it still holds the given token, so an expired holder cannot free a successor's lock
+_RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+# Extends a lock's expiry only if it still holds the given token, so a holder whose lock
+# expired cannot extend a successor's
+_REFRESH_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+def release_redis_lock(client, key: str, token: str) -> bool:
+    """Release a lock taken with SET NX under token. Returns False if Redis could not be reached."""
+    try:
+        client.eval(_RELEASE_LOCK_SCRIPT, 1, key, token)
+        return True
+    except Exception as e:
+        logger.warning(f"Could not release the Redis lock {key}: {e}")
+        return False
+
+
+class RedisLock:
+    """A held redis_lock; client is None when the lock could not be taken in Redis."""
+
+    def __init__(self, client, key: str, token: str, ttl: int):
+        self.client = client
+        self.key = key
+        self.token = token
+        self.ttl = ttl
+
+    def refresh(self) -> None:
+        """Push the lock's expiry ttl seconds ahead, for holders that may outlast it."""
+        if self.client is None:
+            return
+        try:
+            if not self.client.eval(_REFRESH_LOCK_SCRIPT, 1, self.key, self.token, self.ttl):
+                logger.warning(f"Redis lock {self.key} expired and was taken by another holder")
+        except Exception as e:
+            logger.warning(f"Could not refresh the Redis lock {self.key}: {e}")
+
+
+@contextmanager
+def redis_lock(key: str, ttl: int, wait: float):
+    """
+    Run the block while holding a lock shared by every process using this Redis instance.
+    Waits up to wait seconds for the current holder, then raises TimeoutError. The lock
+    expires after ttl seconds so a crashed holder cannot block others forever. When Redis
+    is unreachable the block runs without it; callers that also race within one process
+    add a threading lock of their own.
+    :return: The RedisLock held for the block
+    """
+    token = uuid.uuid4().hex
+    client = None
+    try:
+        client = get_redis_client()
+        deadline = time.time() + wait
+        while client is not None and not client.set(key, token, nx=True, ex=ttl):
+            if time.time() > deadline:
+                raise TimeoutError(f"Timed out waiting for the Redis lock {key}")
+            time.sleep(0.1)
+    except TimeoutError:
+        raise
+    except Exception as e:
+        logger.warning(f"Redis unavailable for the lock {key}, locking within this process only: {e}")
+        client = None
+    try:
+        yield RedisLock(client, key, token, ttl)
+    finally:
+        if client is not None:
+            release_redis_lock(client, key, token)
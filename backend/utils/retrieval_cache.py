@@ -0,0 +1,129 @@
+import os
+import json
+import asyncio
+import hashlib
+import logging
+import threading
+from typing import Dict, List, Optional, Sequence, Union
+
+from utils.chunker import SECTION_PATH_SEPARATOR
+from utils.query_embedding_cache import normalize_query
+from utils.redis_utils import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+# Share retrieval results between workers through the Redis instance used for slide navigation
+RETRIEVAL_CACHE_ENABLED = os.getenv("RETRIEVAL_CACHE_ENABLED", "false").lower() == "true"
+RETRIEVAL_CACHE_TTL = int(os.getenv("RETRIEVAL_CACHE_TTL", str(24 * 3600)))
+RETRIEVAL_CACHE_REDIS_PREFIX = "retrieval:"
+
+
+def local_index_version(index_path: str) -> Optional[str]:
+    """
+    Version of a course index stored on local disk, from the modification time and size
+    of its index file; rewriting the index changes it. None if the file does not exist.
+    """
+    try:
+        stat = os.stat(index_path)
+    except OSError:
+        return None
+    return f"local-{stat.st_mtime_ns}-{stat.st_size}"
+
+
+class RetrievalCache:
+    """
+    Redis cache of retrieval results shared by every worker process, mapping
+    (course, index version, normalized query, k, token budget, scope) to the chunk IDs
+    of the assembled context. Only IDs are stored; workers read the texts from their
+    own course state. The index version is part of the key, so entries of an index
+    that was rebuilt are never read again and expire after the TTL.
+    """
+
+    def __init__(self, redis_client=None, ttl: int = RETRIEVAL_CACHE_TTL):
+        self.redis_client = redis_client
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.redis_client is not None
+
+    @staticmethod
+    def _redis_key(course_key: str, index_version: str, query: str, k: int, token_budget: int,
+                   source: Optional[str] = None, section: Union[str, Sequence[str], None] = None) -> str:
+        if isinstance(section, str):
+            section = section.split(SECTION_PATH_SEPARATOR) if section else []
+        request = json.dumps([normalize_query(query), k, token_budget, source,
+                              list(section) if section is not None else None], ensure_ascii=False)
+        course_digest = hashlib.sha256(course_key.encode('utf-8')).hexdigest()[:16]
+        request_digest = hashlib.sha256(request.encode('utf-8')).hexdigest()
+        return f"{RETRIEVAL_CACHE_REDIS_PREFIX}{course_digest}:{index_version}:{request_digest}"
+
+    def _count(self, outcome: str) -> None:
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def get(self, course_key: str, index_version: Optional[str], query: str, k: int, token_budget: int,
+            source: Optional[str] = None, section=None) -> Optional[List[int]]:
+        """:return: Cached chunk IDs, best first, or None on a miss or without a known index version"""
+        if self.redis_client is None or index_version is None:
+            return None
+        try:
+            blob = self.redis_client.get(self._redis_key(course_key, index_version, query, k, token_budget,
+                                                         source, section))
+        except Exception as e:
+            logger.warning(f"Retrieval cache Redis read failed: {e}")
+            self._count("errors")
+            return None
+        if blob is None:
+            self._count("misses")
+            return None
+        self._count("hits")
+        return [int(chunk_id) for chunk_id in json.loads(blob)]
+
+    def put(self, course_key: str, index_version: Optional[str], query: str, k: int, token_budget: int,
+            chunk_ids: Sequence[int], source: Optional[str] = None, section=None) -> None:
+        if self.redis_client is None or index_version is None:
+            return
+        try:
+            self.redis_client.setex(self._redis_key(course_key, index_version, query, k, token_budget,
+                                                    source, section),
+                                    self.ttl, json.dumps([int(chunk_id) for chunk_id in chunk_ids]))
+        except Exception as e:
+            logger.warning(f"Retrieval cache Redis write failed: {e}")
+            self._count("errors")
+
+    async def aget(self, *args, **kwargs) -> Optional[List[int]]:
+        """Async variant of get; the Redis round trip runs in a worker thread."""
+        if self.redis_client is None:
+            return None
+        return await asyncio.to_thread(self.get, *args, **kwargs)
+
+    async def aput(self, *args, **kwargs) -> None:
+        """Async variant of put."""
+        if self.redis_client is None:
+            return
+        await asyncio.to_thread(self.put, *args, **kwargs)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "errors": self.errors,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+_retrieval_cache = RetrievalCache(redis_client=get_redis_client() if RETRIEVAL_CACHE_ENABLED else None)
+
+
+def get_retrieval_cache() -> RetrievalCache:
+    """Return the process-wide retrieval result cache."""
+    return _retrieval_cache
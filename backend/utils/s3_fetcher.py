@@ -0,0 +1,94 @@
+import os
+import time
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, List, Optional
+
+import utils.s3_utils as s3_utils
+
+logger = logging.getLogger(__name__)
+
+# Concurrent downloads; more threads than pooled connections would only queue for a connection
+S3_FETCH_WORKERS = int(os.getenv("S3_FETCH_WORKERS", str(s3_utils.S3_MAX_POOL_CONNECTIONS)))
+# Objects downloaded ahead of the consumer, bounding memory to about this many object bodies
+S3_FETCH_PREFETCH = int(os.getenv("S3_FETCH_PREFETCH", str(S3_FETCH_WORKERS)))
+
+
+class FetchedObject:
+    """Body of a downloaded S3 object, with how long the download took."""
+
+    def __init__(self, key: str, data: bytes, latency_seconds: float):
+        self.key = key
+        self.data = data
+        self.latency_seconds = latency_seconds
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.data)
+
+    def iter_lines(self) -> Iterator[str]:
+        """UTF-8 lines without their trailing newline, as iter_text_file_lines_from_s3 yields them."""
+        return iter(self.data.decode('utf-8').split('\n'))
+
+
+def fetch_s3_object(bucket_name: str, key: str) -> FetchedObject:
+    """Download an object, raising on failure."""
+    start = time.perf_counter()
+    data = s3_utils.s3_client.get_object(Bucket=bucket_name, Key=key)['Body'].read()
+    fetched = FetchedObject(key, data, time.perf_counter() - start)
+    logger.debug(f"Fetched {bucket_name}/{key}: {fetched.nbytes} bytes in {fetched.latency_seconds * 1000:.1f} ms")
+    return fetched
+
+
+def iter_fetched_objects(bucket_name: str, keys: Iterable[str], max_workers: int = S3_FETCH_WORKERS,
+                         prefetch: Optional[int] = None) -> Iterator[FetchedObject]:
+    """
+    Download objects in parallel and yield them in the order of keys.
+    Keys are consumed lazily, and at most prefetch objects are in flight or waiting
+    for the consumer. A failed download is raised when its turn comes.
+    :param keys: Object keys, e.g. from iter_objects_in_prefix
+    :param max_workers: Concurrent downloads
+    :param prefetch: Objects fetched ahead of the consumer, defaulting to S3_FETCH_PREFETCH
+    :return: Generator of FetchedObject
+    """
+    max_workers = max(1, max_workers)
+    window = max(max_workers, prefetch or S3_FETCH_PREFETCH)
+    keys = iter(keys)
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="s3-fetch")
+    pending = deque()
+    try:
+        for key in keys:
+            pending.append(executor.submit(fetch_s3_object, bucket_name, key))
+            if len(pending) >= window:
+                break
+        while pending:
+            fetched = pending.popleft().result()
+            for key in keys:
+                pending.append(executor.submit(fetch_s3_object, bucket_name, key))
+                break
+            yield fetched
+    finally:
+        # A consumer that stops early must not wait for downloads it will never read
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+class FetchStats:
+    """Per-object download latency and bytes, kept without the object bodies."""
+
+    def __init__(self):
+        self.objects: List[dict] = []
+
+    def add(self, fetched: FetchedObject) -> None:
+        self.objects.append({"key": fetched.key, "bytes": fetched.nbytes,
+                             "latency_ms": round(fetched.latency_seconds * 1000, 1)})
+
+    def summary(self) -> str:
+        if not self.objects:
+            return "no objects fetched"
+        latencies = sorted(obj["latency_ms"] for obj in self.objects)
+        total_bytes = sum(obj["bytes"] for obj in self.objects)
+        return (f"{len(self.objects)} objects, {total_bytes / (1024 * 1024):.2f} MB, per-object latency "
+                f"p50 {latencies[len(latencies) // 2]:.0f} ms / max {latencies[-1]:.0f} ms")
@@ -1,11 +1,14 @@
 import boto3
 import json
 import io
+import codecs
 # import faiss  # Comment out the direct import
+import shutil
 import tempfile
 from datetime import datetime
 import os
 
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
 # Try to import faiss, make it optional
@@ -13,7 +16,7 @@ try:
     import faiss
     FAISS_AVAILABLE = True
 except ImportError:
-    print("Warning: FAISS not available. Vector index functionality will be disabled.")
+    print("Warning: FAISS not available. FAISS index uploads are disabled.")
     FAISS_AVAILABLE = False
     faiss = None
 
@@ -23,12 +26,15 @@ ACCESS_KEY = os.getenv("AWS_ACCESS_KEY_ID")
 SECRET_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
 REGION_NAME = "ca-central-1"
 S3_BUCKET_NAME = "jasmintechs-tutorion"
+# HTTP connections the client keeps open; bounds useful concurrency of parallel downloads
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", "10"))
 
 s3_client = boto3.client(
     's3',
     aws_access_key_id=ACCESS_KEY,
     aws_secret_access_key=SECRET_KEY,
-    region_name=REGION_NAME
+    region_name=REGION_NAME,
+    config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS)
 )
 
 
@@ -135,6 +141,44 @@ def read_text_file_from_s3(bucket_name, key):
         return None
 
 
+def iter_objects_in_prefix(bucket_name, prefix, suffix=None):
+    """
+    Lazily list object keys under a prefix, following pagination.
+    :param bucket_name: Name of the S3 bucket
+    :param prefix: Folder path prefix to list objects from
+    :param suffix: Optional key suffix filter, e.g. '.txt'
+    :return: Generator of object keys
+    """
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if suffix is None or obj['Key'].endswith(suffix):
+                yield obj['Key']
+
+
+def iter_text_file_lines_from_s3(bucket_name, key, read_size=1024 * 1024):
+    """
+    Stream a UTF-8 text file from S3 line by line without holding the whole body in memory.
+    Lines are yielded without their trailing newline.
+    :param bucket_name: Name of the S3 bucket
+    :param key: Full path to the file in S3
+    :param read_size: Number of bytes read from the response body at a time
+    :return: Generator of lines
+    """
+    body = s3_client.get_object(Bucket=bucket_name, Key=key)['Body']
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    pending = ''
+    while True:
+        data = body.read(read_size)
+        if not data:
+            break
+        pending += decoder.decode(data)
+        lines = pending.split('\n')
+        pending = lines.pop()
+        yield from lines
+    yield pending + decoder.decode(b'', final=True)
+
+
 def delete_file_from_s3(bucket_name, s3_key):
     """
     Delete a file from S3 bucket.
@@ -247,6 +291,119 @@ def upload_faiss_index_to_s3(index, bucket_name, s3_key):
         return False
 
 
+def upload_bytes_to_s3(data, bucket_name, s3_key, content_type='application/octet-stream'):
+    """
+    Upload raw bytes to S3 bucket.
+    :param data: Bytes to upload
+    :param bucket_name: Name of the S3 bucket
+    :param s3_key: Key under which the bytes will be saved in S3
+    :param content_type: Content type stored with the object
+    :return: True if successful, False otherwise
+    """
+    try:
+        s3_client.put_object(
+            Bucket=bucket_name,
+            Key=s3_key,
+            Body=data,
+            ContentType=content_type
+        )
+        return True
+    except Exception as e:
+        print(f"Error uploading bytes to {bucket_name}/{s3_key}: {e}")
+        return False
+
+
+def read_binary_from_s3_if_exists(bucket_name, key):
+    """Read binary data from S3, returning None without logging if the key does not exist"""
+    try:
+        response = s3_client.get_object(Bucket=bucket_name, Key=key)
+        return response['Body'].read()
+    except ClientError as e:
+        if e.response["Error"]["Code"] not in ("NoSuchKey", "404"):
+            print(f"Error reading binary from {bucket_name}/{key}: {e}")
+        return None
+    except Exception as e:
+        print(f"Error reading binary from {bucket_name}/{key}: {e}")
+        return None
+
+
+def download_s3_object(bucket_name, key, local_path, if_none_match=None):
+    """
+    Stream an S3 object to a local file with a single GET, so the file and the ETag
+    returned always belong to the same version of the object.
+    :param if_none_match: ETag of a copy the caller already has; nothing is downloaded
+        while the object still has this ETag
+    :return: (ETag without quotes, whether local_path was written), or (None, False) if the
+        object does not exist or could not be downloaded
+    """
+    try:
+        conditions = {"IfNoneMatch": f'"{if_none_match}"'} if if_none_match else {}
+        response = s3_client.get_object(Bucket=bucket_name, Key=key, **conditions)
+    except ClientError as e:
+        code = e.response["Error"]["Code"]
+        if code in ("304", "NotModified"):
+            return if_none_match, False
+        if code not in ("NoSuchKey", "404"):
+            print(f"Error downloading {bucket_name}/{key}: {e}")
+        return None, False
+    except Exception as e:
+        print(f"Error downloading {bucket_name}/{key}: {e}")
+        return None, False
+    try:
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        with open(local_path, 'wb') as f:
+            shutil.copyfileobj(response['Body'], f, 1024 * 1024)
+    except Exception as e:
+        print(f"Error downloading {bucket_name}/{key}: {e}")
+        if os.path.exists(local_path):
+            os.remove(local_path)
+        return None, False
+    return response['ETag'].strip('"'), True
+
+
+def read_s3_byte_range(bucket_name, key, start, end, etag=None):
+    """
+    Read bytes [start, end) of an S3 object with a ranged GET.
+    :param bucket_name: Name of the S3 bucket
+    :param key: Key of the object
+    :param start: First byte to read
+    :param end: Byte after the last one to read; ranges past the end of the object are truncated
+    :param etag: If given, the read fails unless the object still has this ETag
+    :return: Tuple of (bytes, ETag without quotes), or None if the object does not exist or changed
+    """
+    if end <= start:
+        return b"", etag
+    kwargs = {"IfMatch": f'"{etag}"'} if etag else {}
+    try:
+        response = s3_client.get_object(Bucket=bucket_name, Key=key, Range=f"bytes={start}-{end - 1}", **kwargs)
+        return response['Body'].read(), response['ETag'].strip('"')
+    except ClientError as e:
+        if e.response["Error"]["Code"] not in ("NoSuchKey", "404"):
+            print(f"Error reading bytes {start}-{end - 1} of {bucket_name}/{key}: {e}")
+        return None
+    except Exception as e:
+        print(f"Error reading bytes {start}-{end - 1} of {bucket_name}/{key}: {e}")
+        return None
+
+
+def upload_local_file_to_s3(local_path, bucket_name, s3_key, content_type='application/octet-stream'):
+    """
+    Upload a file from local disk to S3 bucket, using multipart upload for large files.
+    :param local_path: Path of the local file
+    :param bucket_name: Name of the S3 bucket
+    :param s3_key: Key under which the file will be saved in S3
+    :param content_type: Content type stored with the object
+    :return: True if successful, False otherwise
+    """
+    try:
+        s3_client.upload_file(local_path, bucket_name, s3_key, ExtraArgs={'ContentType': content_type})
+        print(f"File uploaded successfully to {bucket_name}/{s3_key}")
+        return True
+    except Exception as e:
+        print(f"Error uploading {local_path} to {bucket_name}/{s3_key}: {e}")
+        return False
+
+
 def get_s3_user_courses_info(username):
     """
     Get the course information for a user from S3.
@@ -0,0 +1,188 @@
+import os
+import json
+import time
+import logging
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import openai
+
+import utils.s3_utils as s3_utils
+from utils.course_cache import CourseState, get_course_state
+from utils.bm25_index import BM25Index, HYBRID_CANDIDATES, reciprocal_rank_fusion
+from utils.context_assembler import AssembledContext, CONTEXT_TOKEN_BUDGET, assemble_context
+from utils.embedding_engine import EmbeddingEngine, EMBEDDING_MODEL
+from utils.embedding_cache import EmbeddingCache, EMBEDDING_CACHE_ENABLED
+
+logger = logging.getLogger(__name__)
+
+# Per-slide supporting chunk IDs, stored next to slides.json
+SLIDE_CONTEXT_NAME = "slide_context.json"
+# Supporting chunks precomputed for every slide
+SLIDE_CONTEXT_TOP_K = int(os.getenv("SLIDE_CONTEXT_TOP_K", "8"))
+# A question has drifted off its slide when the best keyword match in the whole course lies
+# outside the slide's chunks and scores at least this many times the best match among them
+SLIDE_DRIFT_SCORE_RATIO = float(os.getenv("SLIDE_DRIFT_SCORE_RATIO", "1.5"))
+# Seconds a process reuses a course's slide context before reading it from S3 again
+SLIDE_CONTEXT_CACHE_SECONDS = float(os.getenv("SLIDE_CONTEXT_CACHE_SECONDS", "60"))
+# Characters of each slide embedded to find its supporting chunks
+SLIDE_TEXT_MAX_CHARS = 4000
+SLIDE_TEXT_FIELDS = ("section_title", "subtopic_title", "title", "slide_markdown", "transcript")
+
+_slide_contexts: Dict[Tuple[str, str], Tuple[float, Optional[Dict]]] = {}
+_slide_contexts_lock = threading.Lock()
+
+
+def _slide_context_key(username: str, course_id: str) -> str:
+    return s3_utils.get_s3_file_path(username, course_id, SLIDE_CONTEXT_NAME)
+
+
+def slide_text(slide: Dict) -> str:
+    """Text a slide is matched to course chunks by: its titles, content and transcript."""
+    parts = [str(slide[field]).strip() for field in SLIDE_TEXT_FIELDS if slide.get(field)]
+    return "\n\n".join(part for part in parts if part)[:SLIDE_TEXT_MAX_CHARS]
+
+
+def build_slide_context(slides: Sequence[Dict], state: CourseState, engine: EmbeddingEngine,
+                        top_k: int = SLIDE_CONTEXT_TOP_K) -> Dict:
+    """
+    Find the top_k supporting chunks of every slide, ranking chunks by vector search
+    and BM25 on the slide text fused by reciprocal rank, as questions are ranked.
+    :return: Slide context: chunk ID lists in slide order, with the index version they refer to
+    """
+    texts = [slide_text(slide) for slide in slides]
+    ranked: List[List[int]] = [[] for _ in slides]
+    positions = [i for i, text in enumerate(texts) if text]
+    if positions:
+        vectors = engine.embed([texts[i] for i in positions])
+        if vectors.shape[1] != state.faiss_index.d:
+            raise ValueError(f"Slide embeddings have dimension {vectors.shape[1]}, "
+                             f"the course index {state.faiss_index.d}")
+        candidates = max(top_k, HYBRID_CANDIDATES)
+        _, indices = state.faiss_index.search(vectors, candidates)
+        for row, i in enumerate(positions):
+            vector_ranking = [int(chunk_id) for chunk_id in indices[row] if chunk_id >= 0]
+            lexical_ranking = [chunk_id for chunk_id, _ in state.bm25_index.search(texts[i], candidates)]
+            ranked[i] = reciprocal_rank_fusion([vector_ranking, lexical_ranking])[:top_k]
+    return {
+        "index_version": state.version,
+        "num_chunks": len(state.chunks),
+        "top_k": top_k,
+        "slides": ranked,
+        "created_at": time.time(),
+    }
+
+
+def refresh_slide_context(bucket_name: str, username: str, course_id: str, api_key: str,
+                          slides: Optional[Sequence[Dict]] = None) -> bool:
+    """
+    Precompute and upload the supporting chunks of every slide of a course. Call after
+    slides.json is written and after every new version of the course index, since chunk IDs
+    refer to one index version.
+    :param slides: The course's slides, read from slides.json if not given
+    :return: True if a slide context was uploaded. Failures are logged, not raised, since
+        questions fall back to a full search without one
+    """
+    try:
+        return _refresh_slide_context(bucket_name, username, course_id, api_key, slides)
+    except Exception as e:
+        logger.exception(f"Could not precompute the slide context of course {course_id}: {e}")
+        return False
+
+
+def _refresh_slide_context(bucket_name: str, username: str, course_id: str, api_key: str,
+                           slides: Optional[Sequence[Dict]]) -> bool:
+    start_time = time.time()
+    if slides is None:
+        data = s3_utils.read_binary_from_s3_if_exists(bucket_name,
+                                                      s3_utils.get_s3_file_path(username, course_id, "slides.json"))
+        slides = json.loads(data) if data else None
+    if not isinstance(slides, list) or not slides:
+        logger.info(f"No slides for course {course_id}, skipping slide context")
+        return False
+    state = get_course_state(username, course_id, bucket_name)
+    if state is None or state.faiss_index is None:
+        logger.info(f"Course {course_id} has no index yet, skipping slide context")
+        return False
+
+    dimension = state.faiss_index.d
+    cache = EmbeddingCache(EMBEDDING_MODEL, dimension, bucket_name) if EMBEDDING_CACHE_ENABLED else None
+    engine = EmbeddingEngine(openai.OpenAI(api_key=api_key), dimension=dimension, cache=cache)
+    context = build_slide_context(slides, state, engine)
+    if not s3_utils.upload_json_to_s3(context, bucket_name, _slide_context_key(username, course_id)):
+        return False
+    with _slide_contexts_lock:
+        _slide_contexts[(username, course_id)] = (time.time(), context)
+    logger.info(f"Precomputed context of {len(slides)} slides of course {course_id} "
+                f"in {time.time() - start_time:.2f} seconds")
+    return True
+
+
+def _load_slide_context(bucket_name: str, username: str, course_id: str) -> Optional[Dict]:
+    key = (username, course_id)
+    now = time.time()
+    with _slide_contexts_lock:
+        cached = _slide_contexts.get(key)
+    if cached is not None and now - cached[0] < SLIDE_CONTEXT_CACHE_SECONDS:
+        return cached[1]
+    data = s3_utils.read_binary_from_s3_if_exists(bucket_name, _slide_context_key(username, course_id))
+    try:
+        context = json.loads(data) if data else None
+    except ValueError as e:
+        logger.warning(f"Ignoring unreadable slide context of course {course_id}: {e}")
+        context = None
+    # Courses without one are remembered too, so each question does not ask S3 again
+    with _slide_contexts_lock:
+        _slide_contexts[key] = (now, context)
+    return context
+
+
+def is_off_slide(bm25_index: BM25Index, query: str, slide_chunk_ids: Sequence[int]) -> bool:
+    """
+    Whether a question asks about something other than its slide, judged by keyword
+    matches alone so no query embedding is needed. Questions without indexed terms
+    ("can you say that again?") refer to the slide.
+    """
+    results = bm25_index.search(query, HYBRID_CANDIDATES)
+    if not results:
+        return False
+    on_slide = set(slide_chunk_ids)
+    if results[0][0] in on_slide:
+        return False
+    best_on_slide = max((score for chunk_id, score in results if chunk_id in on_slide), default=None)
+    if best_on_slide is None:
+        slide_results = bm25_index.search(query, 1, np.asarray(slide_chunk_ids, dtype='int64'))
+        best_on_slide = slide_results[0][1] if slide_results else 0.0
+    return results[0][1] >= SLIDE_DRIFT_SCORE_RATIO * best_on_slide
+
+
+def get_slide_context(username: str, course_id: str, slide_index: int, query: str, max_chunks: int = 5,
+                      token_budget: int = CONTEXT_TOKEN_BUDGET,
+                      bucket_name: str = s3_utils.S3_BUCKET_NAME) -> Optional[AssembledContext]:
+    """
+    Context for a question asked on a slide, from the slide's precomputed chunks,
+    reordered by keyword relevance to the question. Needs no query embedding or
+    vector search.
+    :return: AssembledContext, or None when the question drifted off the slide or no
+        current slide context exists, in which case callers run a full search
+    """
+    context = _load_slide_context(bucket_name, username, course_id)
+    if context is None or not 0 <= slide_index < len(context.get("slides", [])):
+        return None
+    slide_chunk_ids = context["slides"][slide_index]
+    state = get_course_state(username, course_id, bucket_name)
+    if not slide_chunk_ids or state is None:
+        return None
+    # Courses indexed before manifests have no version; a rebuild still changes the chunk count
+    if state.version != context.get("index_version") or len(state.chunks) != context.get("num_chunks"):
+        logger.info(f"Slide context of course {course_id} predates index version {state.version}")
+        return None
+    if is_off_slide(state.bm25_index, query, slide_chunk_ids):
+        logger.info(f"Question drifted off slide {slide_index} of course {course_id}")
+        return None
+
+    lexical_ranking = [chunk_id for chunk_id, _ in
+                       state.bm25_index.search(query, len(slide_chunk_ids), np.asarray(slide_chunk_ids))]
+    ranked_ids = reciprocal_rank_fusion([lexical_ranking, slide_chunk_ids])
+    return assemble_context(state.chunks, ranked_ids, max_chunks, token_budget)
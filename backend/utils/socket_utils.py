@@ -1,9 +1,18 @@
 # Create this new file
+import os
+import threading
 
 # This module will hold a reference to the socketio instance
 # to avoid circular imports
 _socketio = None
 
+# Message queue URL (e.g. redis://localhost:6379/0) shared by the app's Socket.IO server and
+# processes outside it, such as indexing workers, so they can emit to connected clients
+SOCKETIO_MESSAGE_QUEUE = os.getenv("SOCKETIO_MESSAGE_QUEUE", "")
+
+_external_socketio = None
+_external_lock = threading.Lock()
+
 def init_socketio(socketio_instance):
     """Initialize the socketio reference"""
     global _socketio
@@ -21,4 +30,24 @@ def emit_assistant_activity(assistant_id):
     if _socketio:
         _socketio.emit('assistant_activity', room=assistant_id)
     else:
-        print("Warning: socketio not initialized yet")
\ No newline at end of file
+        print("Warning: socketio not initialized yet")
+
+def _get_emitter():
+    """The app's socketio instance, or a write-only emitter on the message queue in other processes"""
+    global _external_socketio
+    if _socketio or not SOCKETIO_MESSAGE_QUEUE:
+        return _socketio
+    if _external_socketio is None:
+        with _external_lock:
+            if _external_socketio is None:
+                from flask_socketio import SocketIO
+                _external_socketio = SocketIO(message_queue=SOCKETIO_MESSAGE_QUEUE)
+    return _external_socketio
+
+def emit_indexing_progress(room, status):
+    """Emit course indexing progress to the clients watching the course"""
+    socketio = _get_emitter()
+    if socketio:
+        socketio.emit('indexing_progress', status, room=room)
+    else:
+        print("Warning: socketio not initialized yet")